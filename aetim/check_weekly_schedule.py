@@ -7,11 +7,19 @@
 import os
 import sys
 import json
-from datetime import datetime
-from zoneinfo import ZoneInfo
-from utils import load_config
+from datetime import datetime, timedelta
+from utils import get_app_config
 from job_events import list_recent_events
 
+def _compute_next_run(weekday, hour, minute, tz):
+    """計算下次執行時間，回傳 (now, next_run)"""
+    now = datetime.now(tz)
+    days_ahead = weekday - now.weekday()
+    if days_ahead < 0 or (days_ahead == 0 and (now.hour > hour or (now.hour == hour and now.minute >= minute))):
+        days_ahead += 7
+    next_run = now.replace(hour=hour, minute=minute, second=0, microsecond=0) + timedelta(days=days_ahead)
+    return now, next_run
+
 def check_weekly_schedule():
     """檢查週報排程狀態"""
     print("=" * 60)
@@ -22,16 +30,12 @@ def check_weekly_schedule():
     # 1. 檢查設定
     print("【1. 檢查排程設定】")
     try:
-        config = load_config()
-        reporting = config.get('reporting', {})
-        weekly = reporting.get('weekly_report', {})
-        enabled = weekly.get('enabled', False)
-        schedule_struct = weekly.get('schedule_struct', {})
-        
-        day = str(schedule_struct.get('day_of_week', '')).lower()
-        hour = schedule_struct.get('hour', None)
-        minute = schedule_struct.get('minute', None)
-        timezone_str = schedule_struct.get('timezone', 'Asia/Taipei')
+        app_config = get_app_config()
+        enabled = app_config.weekly_enabled
+        day = app_config.weekly_day_name
+        hour = app_config.weekly_hour
+        minute = app_config.weekly_minute
+        timezone_str = app_config.weekly_tz_name
         
         print(f"  啟用狀態: {'✓ 已啟用' if enabled else '✗ 未啟用'}")
         if enabled:
@@ -74,20 +78,9 @@ def check_weekly_schedule():
     
     # 3. 計算下次執行時間
     print("【3. 下次執行時間】")
+    now = next_run = None
     if enabled and day and hour is not None and minute is not None:
-        from datetime import timedelta
-        taipei_tz = ZoneInfo(timezone_str)
-        now = datetime.now(taipei_tz)
-        
-        days_map = {'mon': 0, 'tue': 1, 'wed': 2, 'thu': 3, 'fri': 4, 'sat': 5, 'sun': 6}
-        target_weekday = days_map.get(day, 0)
-        current_weekday = now.weekday()
-        
-        days_ahead = target_weekday - current_weekday
-        if days_ahead < 0 or (days_ahead == 0 and (now.hour > hour or (now.hour == hour and now.minute >= minute))):
-            days_ahead += 7
-        
-        next_run = now.replace(hour=hour, minute=minute, second=0, microsecond=0) + timedelta(days=days_ahead)
+        now, next_run = _compute_next_run(app_config.weekly_day, hour, minute, app_config.weekly_tz)
         print(f"  當前時間: {now.strftime('%Y-%m-%d %H:%M:%S %Z')}")
         print(f"  下次執行: {next_run.strftime('%Y-%m-%d %H:%M:%S %Z')}")
         
@@ -135,17 +128,7 @@ def check_weekly_schedule():
     if not scheduler_running:
         issues.append("排程器未運行 - 需要啟動排程器服務")
     
-    if enabled and day and hour is not None and minute is not None:
-        from datetime import timedelta
-        taipei_tz = ZoneInfo(timezone_str)
-        now = datetime.now(taipei_tz)
-        days_map = {'mon': 0, 'tue': 1, 'wed': 2, 'thu': 3, 'fri': 4, 'sat': 5, 'sun': 6}
-        target_weekday = days_map.get(day, 0)
-        current_weekday = now.weekday()
-        days_ahead = target_weekday - current_weekday
-        if days_ahead < 0 or (days_ahead == 0 and (now.hour > hour or (now.hour == hour and now.minute >= minute))):
-            days_ahead += 7
-        next_run = now.replace(hour=hour, minute=minute, second=0, microsecond=0) + timedelta(days=days_ahead)
+    if next_run is not None:
         if next_run < now:
             issues.append("設定的執行時間已過 - 排程器可能未正確觸發")
     
@@ -1,35 +1,122 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import feedparser
 import json
 import sqlite3
-from datetime import datetime
-import pandas as pd
-from utils import get_db_connection, load_config
+from datetime import datetime, timedelta, timezone
+from utils import get_db_connection, load_config, get_app_config, ensure_raw_intel_indexes, get_feed_cache_headers, save_feed_cache
 import time 
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
-# --- 輔助函式：檢查情資是否已存在 ---
-def is_intel_exists(db_conn, unique_id):
+try:
+    import ijson  # 選用：串流解析 CISA KEV JSON，降低記憶體峰值
+except ImportError:
+    ijson = None
+
+try:
+    import orjson  # 選用：以 C 擴充加速 JSON 序列化與解析
+except ImportError:
+    orjson = None
+
+# JSON 解析錯誤類型（含 ijson 的串流解析錯誤）
+_JSON_ERRORS = (json.JSONDecodeError,) + ((ijson.JSONError,) if ijson else ())
+
+# --- 共用 HTTP Session：重用 TCP/TLS 連線並對暫時性錯誤自動重試 ---
+_SESSION = requests.Session()
+_SESSION.headers.update({'User-Agent': 'AETIM-Collector/1.0'})
+_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=8,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504], raise_on_status=False)
+))
+
+# --- 寫入 T_Raw_Intel 的 SQL（模組層級常數，各收集器共用）---
+# 去重交由唯一索引處理（見 utils.RAW_INTEL_UNIQUE_INDEXES）
+_SQL_INSERT_CVE = """
+    INSERT OR IGNORE INTO T_Raw_Intel (source, type, title, url, cve_id, raw_data, status)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+_SQL_INSERT_ADVISORY = """
+    INSERT OR IGNORE INTO T_Raw_Intel (source, type, title, url, raw_data, status)
+    VALUES (?, ?, ?, ?, ?, 'new')
+"""
+_SQL_INSERT_NVD = """
+    INSERT OR IGNORE INTO T_Raw_Intel (source, type, title, cve_id, cvss_score, raw_data, status)
+    VALUES (?, ?, ?, ?, ?, ?, 'new')
+"""
+
+# --- 輔助函式：NVD CVSS 分數 ---
+def _extract_cvss(cve):
     """
-    檢查情資是否已存在 T_Raw_Intel 中 (依 title 或 cve_id)
+    取出 CVSS v3.1 基本分數；結構不完整時返回 0.0
+    （正常資料佔絕大多數，直接索引並以例外處理缺漏，比逐層檢查快）
     """
     try:
-        cursor = db_conn.cursor()
-        cursor.execute("SELECT 1 FROM T_Raw_Intel WHERE title = ? OR cve_id = ?", (unique_id, unique_id))
-        return cursor.fetchone() is not None
-    except sqlite3.Error as e:
-        print(f"檢查情資是否存在時出錯：{e}")
-        return True
+        return cve['metrics']['cvssMetricV31'][0]['cvssData']['baseScore']
+    except (KeyError, IndexError, TypeError):
+        return 0.0
+
+# --- 輔助函式：大量寫入 ---
+def _bulk_insert(db_conn, sql, rows):
+    """
+    以單一交易批次寫入（一次 executemany、一次提交）
+    
+    Args:
+        db_conn: 資料庫連線
+        sql: INSERT 語句
+        rows: 參數序列
+    
+    Returns:
+        int: 實際寫入的筆數
+    """
+    with db_conn:
+        cursor = db_conn.executemany(sql, rows)
+    return max(cursor.rowcount, 0)
+
+# --- 輔助函式：JSON 序列化/解析（優先使用 orjson，未安裝時退回標準函式庫）---
+def _to_json(obj):
+    """序列化 raw_data（緊湊格式，保留非 ASCII 字元）"""
+    if orjson is not None:
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+
+def _from_json(content):
+    """解析 HTTP 回應內容（bytes）"""
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+def _iter_kev_vulnerabilities(response):
+    """
+    逐筆產生 CISA KEV 漏洞記錄
+    有安裝 ijson 時邊下載邊解析，否則退回一次載入整份 JSON
+    
+    Args:
+        response: 以 stream=True 取得的 HTTP 回應
+    """
+    if ijson is not None:
+        response.raw.decode_content = True  # 交由 urllib3 處理 gzip 解壓
+        yield from ijson.items(response.raw, 'vulnerabilities.item', use_float=True)
+        return
+    
+    data = _from_json(response.content)
+    # 檢查資料格式是否正確
+    if not isinstance(data, dict):
+        raise ValueError(f"CISA KEV 資料格式錯誤：預期 dict，得到 {type(data)}")
+    yield from data.get('vulnerabilities', [])
 
 # --- P0 (緊急) 收集器 ---
-def fetch_cisa_kev(db_conn, config, use_backup=False):
+def fetch_cisa_kev(db_conn, config):
     """
     PIR-04, PIR-01: 抓取 CISA 已知遭利用漏洞 (KEV)
     
+    主要 URL 回傳 404 時依序嘗試備用 URL。
+    
     Args:
         db_conn: 資料庫連線
         config: 設定檔
-        use_backup: 是否使用備用 URL（內部使用，避免遞迴）
     """
     print("--- [Collector] 執行：CISA KEV (P0) ---")
     
@@ -39,84 +126,82 @@ def fetch_cisa_kev(db_conn, config, use_backup=False):
         "https://www.cisa.gov/known-exploited-vulnerabilities-catalog/known-exploited-vulnerabilities.json",
     ]
     
-    # 決定使用的 URL
-    if use_backup:
-        # 如果已經嘗試過主要 URL，使用第一個備用 URL
-        url = backup_urls[0]
-        print(f"[除錯] 使用備用 URL：{url}")
-    else:
-        url = config['threat_feeds']['cisa_kev']
-        print(f"[除錯] 使用主要 URL：{url}")
+    # 依序嘗試：主要 URL → 備用 URL（去除重複，保留順序）
+    candidate_urls = list(dict.fromkeys([get_app_config(config).cisa_kev_url, *backup_urls]))
     
+    response = None
     try:
-        response = requests.get(url, timeout=15, headers={'User-Agent': 'AETIM-Collector/1.0'})
-        response.raise_for_status() 
-        data = response.json()
-        new_vulns_found = 0
+        for i, url in enumerate(candidate_urls):
+            print(f"[除錯] 使用{'主要' if i == 0 else '備用'} URL：{url}")
+            response = _SESSION.get(url, headers=get_feed_cache_headers(db_conn, url), timeout=15, stream=True)
+            if response.status_code != 404:
+                break
+            print(f"錯誤：CISA KEV URL 不存在 (404)：{url}")
+            response.close()
+            response = None
         
-        # 檢查資料格式是否正確
-        if not isinstance(data, dict):
-            raise ValueError(f"CISA KEV 資料格式錯誤：預期 dict，得到 {type(data)}")
+        if response is None:
+            print(f"提示：請檢查 CISA KEV Catalog 官方網站確認正確的 JSON feed URL。")
+            print(f"已嘗試的 URL：")
+            for tried_url in candidate_urls:
+                print(f"  - {tried_url}")
+            return
         
-        vulnerabilities = data.get('vulnerabilities', [])
-        if not vulnerabilities:
-            print("警告：CISA KEV 資料為空，可能 URL 已變更或資料格式有變。")
-            print(f"[除錯] 回傳資料結構：{list(data.keys())}")
+        if response.status_code == 304:
+            print("--- [Collector] CISA KEV 未變更 (304 Not Modified)，略過處理。 ---")
             return
+        response.raise_for_status() 
+        ensure_raw_intel_indexes(db_conn)
         
-        print(f"[除錯] 找到 {len(vulnerabilities)} 筆漏洞記錄")
+        # 一次取出既有的 CVE ID，改在記憶體中比對，避免逐筆查詢資料庫
+        # （此查詢僅掃描部分唯一索引 idx_raw_intel_cve，不讀取資料列；
+        #   KEV 每日多數項目皆已存在，Bloom filter 幾乎都會命中而需回查，反而較慢）
+        existing = {r[0] for r in db_conn.execute(
+            "SELECT cve_id FROM T_Raw_Intel WHERE cve_id IS NOT NULL"
+        )}
         
-        for vuln in vulnerabilities:
+        total_vulns = 0
+        rows = []
+        for vuln in _iter_kev_vulnerabilities(response):
+            total_vulns += 1
             cve_id = vuln.get('cveID')
-            if not cve_id:
-                continue  # 跳過沒有 CVE ID 的記錄
-                
-            title = f"CISA KEV: {cve_id} - {vuln.get('vulnerabilityName', 'N/A')}"
+            if not cve_id or cve_id in existing:
+                continue  # 跳過沒有 CVE ID 或已存在的記錄
+            existing.add(cve_id)  # 避免同一批次內重複寫入
             
-            if not is_intel_exists(db_conn, cve_id):
-                raw_data = json.dumps(vuln)
-                cursor = db_conn.cursor()
-                cursor.execute(
-                    """
-                    INSERT INTO T_Raw_Intel (source, type, title, url, cve_id, raw_data, status)
-                    VALUES (?, ?, ?, ?, ?, ?, 'new')
-                    """,
-                    ('CISA_KEV', 'CVE', title, vuln.get('knownRansomwareUse', 'N/A'), cve_id, raw_data)
-                )
-                new_vulns_found += 1
-                
-        db_conn.commit()
+            title = f"CISA KEV: {cve_id} - {vuln.get('vulnerabilityName', 'N/A')}"
+            rows.append(
+                ('CISA_KEV', 'CVE', title, vuln.get('knownRansomwareUse', 'N/A'), cve_id, _to_json(vuln), 'new')
+            )
+        
+        if total_vulns == 0:
+            print("警告：CISA KEV 資料為空，可能 URL 已變更或資料格式有變。")
+            return
+        
+        print(f"[除錯] 找到 {total_vulns} 筆漏洞記錄")
+        
+        # 單一交易批次寫入（唯一索引負責去重）
+        new_vulns_found = _bulk_insert(db_conn, _SQL_INSERT_CVE, rows)
+        save_feed_cache(db_conn, url, response)
         print(f"--- [Collector] CISA KEV 完成。發現 {new_vulns_found} 筆新情資。 ---")
         if new_vulns_found == 0:
             print("提示：所有漏洞已在資料庫中，或沒有新的漏洞。")
         
     except requests.HTTPError as e:
-        if e.response.status_code == 404:
-            if not use_backup:
-                print(f"錯誤：主要 CISA KEV URL 不存在 (404)。嘗試備用 URL...")
-                # 嘗試備用 URL（只嘗試一次）
-                try:
-                    return fetch_cisa_kev(db_conn, config, use_backup=True)
-                except Exception as backup_e:
-                    print(f"錯誤：備用 URL 也失敗：{backup_e}")
-            else:
-                print(f"錯誤：備用 URL 也不存在 (404)")
-            print(f"提示：請檢查 CISA KEV Catalog 官方網站確認正確的 JSON feed URL。")
-            print(f"可能的 URL：")
-            for backup_url in backup_urls:
-                print(f"  - {backup_url}")
-        else:
-            print(f"錯誤：抓取 CISA KEV 失敗 (HTTP {e.response.status_code})：{e}")
+        print(f"錯誤：抓取 CISA KEV 失敗 (HTTP {e.response.status_code})：{e}")
     except requests.RequestException as e:
         print(f"錯誤：抓取 CISA KEV 失敗（網路錯誤）：{e}")
         print(f"提示：請檢查網路連線或防火牆設定。")
-    except json.JSONDecodeError as e:
+    except _JSON_ERRORS as e:
         print(f"錯誤：解析 CISA KEV JSON 失敗：{e}")
-        print(f"[除錯] 回應內容（前 500 字元）：{response.text[:500]}")
     except Exception as e:
         print(f"錯誤：CISA KEV 收集器發生未預期錯誤：{e}")
         import traceback
         traceback.print_exc()
+    finally:
+        # stream=True 的回應需明確關閉，才會將連線歸還 Session 連線池
+        if response is not None:
+            response.close()
 
 # --- P1/P2 (高/中) 收集器 ---
 def fetch_rss_feeds(db_conn, config):
@@ -124,43 +209,55 @@ def fetch_rss_feeds(db_conn, config):
     PIR-02, PIR-03, PIR-05: 抓取 TWCERT, VMware, MSRC 的 RSS Feeds
     """
     print("--- [Collector] 執行：RSS Feeds (P1/P2) ---")
-    feeds = {
-        'VMware': config['threat_feeds']['vmware_vmsa'],
-        'MSRC': config['threat_feeds']['msrc_rss'],
-        'TWCERT_Alert': config['threat_feeds']['twcert_rss'],
-        'TWCERT_CC': config['threat_feeds']['twcert_cc_rss'],
-    }
+    feeds = dict(get_app_config(config).rss_feeds)
+    if not feeds:
+        print("警告：未設定任何 RSS feed，略過。")
+        return
+    
+    ensure_raw_intel_indexes(db_conn)
     
-    new_entries_found = 0
+    def _parse(item):
+        source_name, url = item
+        try:
+            return source_name, url, feedparser.parse(url), None
+        except Exception as e:
+            return source_name, url, None, e
+    
+    # 並行下載與解析各 RSS（網路 I/O 為主），寫入仍在主執行緒依序進行
+    with ThreadPoolExecutor(max_workers=len(feeds)) as executor:
+        results = list(executor.map(_parse, feeds.items()))
+    
+    # 一次取出既有標題，改在記憶體中比對，已存在的項目不再進入批次
+    placeholders = ','.join('?' * len(feeds))
+    existing_titles = {r[0] for r in db_conn.execute(
+        f"SELECT title FROM T_Raw_Intel WHERE source IN ({placeholders})", tuple(feeds)
+    )}
     
-    for source_name, url in feeds.items():
+    rows = []
+    for source_name, url, feed, error in results:
+        if error is not None:
+            print(f"錯誤：處理 RSS feed '{source_name}' ({url}) 失敗：{error}")
+            continue
         try:
-            feed = feedparser.parse(url)
+            feed_rows = []
+            feed_titles = set()
             for entry in feed.entries:
                 title = entry.title
-                link = entry.link
-                
-                if not is_intel_exists(db_conn, title):
-                    raw_data = json.dumps({
-                        'summary': entry.get('summary', 'N/A'),
-                        'published': entry.get('published', 'N/A')
-                    })
-                    
-                    cursor = db_conn.cursor()
-                    cursor.execute(
-                        """
-                        INSERT INTO T_Raw_Intel (source, type, title, url, raw_data, status)
-                        VALUES (?, ?, ?, ?, ?, 'new')
-                        """,
-                        (source_name, 'Advisory', title, link, raw_data)
-                    )
-                    new_entries_found += 1
-                    
+                if title in existing_titles or title in feed_titles:
+                    continue
+                feed_titles.add(title)
+                raw_data = _to_json({
+                    'summary': entry.get('summary', 'N/A'),
+                    'published': entry.get('published', 'N/A')
+                })
+                feed_rows.append((source_name, 'Advisory', title, entry.link, raw_data))
+            rows.extend(feed_rows)
+            existing_titles |= feed_titles  # 避免跨 feed 重複寫入
         except Exception as e:
             print(f"錯誤：處理 RSS feed '{source_name}' ({url}) 失敗：{e}")
 
-    if new_entries_found > 0:
-        db_conn.commit()
+    # 所有 feed 合併後一次寫入（單一交易）
+    new_entries_found = _bulk_insert(db_conn, _SQL_INSERT_ADVISORY, rows)
     print(f"--- [Collector] RSS Feeds 完成。發現 {new_entries_found} 筆新情資。 ---")
 
 
@@ -172,22 +269,25 @@ def fetch_nvd(db_conn, config):
     """
     print("--- [Collector] 執行：NVD (P1) ---")
     base_url = "https://services.nvd.nist.gov/rest/json/cves/2.0"
-    api_key = config['api_keys'].get('nvd', '')
+    app_config = get_app_config(config)
+    api_key = app_config.nvd_api_key
     headers = {'apiKey': api_key} if api_key else {}
     
-    keywords = [k.lower() for k in config['pir_keywords']]
+    keyword_re = app_config.keyword_pattern
+    keywords = [k.lower() for k in app_config.pir_keywords]
     new_vulns_found = 0
+    ensure_raw_intel_indexes(db_conn)
     
     # --- (修正點) 建立正確的 NVD 日期格式 ---
     # 格式: YYYY-MM-DDTHH:mm:ss.SSSZ
     try:
-        end_time = datetime.utcnow()
-        start_time = end_time - pd.Timedelta(days=1)
+        end_time = datetime.now(timezone.utc)
+        start_time = end_time - timedelta(days=1)
         
-        # .isoformat() 產生 '...T...123456'
-        # 我們需要切到毫秒 ([:-3]) 並加上 'Z'
-        nvd_start_time = start_time.isoformat()[:-3] + 'Z'
-        nvd_end_time = end_time.isoformat()[:-3] + 'Z'
+        # 以固定格式輸出，毫秒固定為 .000 並加上 'Z'
+        # （isoformat() 在 microsecond 為 0 時不輸出小數，切片會出錯）
+        nvd_start_time = start_time.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        nvd_end_time = end_time.strftime('%Y-%m-%dT%H:%M:%S.000Z')
     except Exception as e:
         print(f"錯誤：建立 NVD 日期格式失敗：{e}", file=sys.stderr)
         return
@@ -200,59 +300,58 @@ def fetch_nvd(db_conn, config):
     
     try:
         print(f"[NVD Debug] 正在抓取 {nvd_start_time} 至 {nvd_end_time} 的所有 CVEs...")
-        response = requests.get(base_url, headers=headers, params=params, timeout=60) 
+        # 查詢時間窗每次不同，不使用條件式請求（ETag/Last-Modified 僅對同一查詢有效）
+        response = _SESSION.get(base_url, headers=headers, params=params, timeout=60)
         
         print(f"[NVD Debug] 抓取完成. 狀態: {response.status_code}")
         response.raise_for_status()
-        data = response.json()
+        data = _from_json(response.content)
         
         all_vulns = data.get('vulnerabilities', [])
         print(f"[NVD Debug] 獲得 {len(all_vulns)} 筆 CVEs. 準備開始本地端過濾...")
         
+        # 與 CISA KEV 相同，先在記憶體中排除既有 CVE；
+        # 唯一索引因既有重複資料而無法建立時，仍不會重複寫入
+        existing = {r[0] for r in db_conn.execute(
+            "SELECT cve_id FROM T_Raw_Intel WHERE cve_id IS NOT NULL"
+        )}
+        
+        rows = []
         for vuln in all_vulns:
-            # --- (防呆點) 確保 cve 是字典 ---
-            cve = vuln.get('cve')
-            if not isinstance(cve, dict):
+            # --- (防呆點) cve 缺漏或非 dict 時索引會拋出例外 ---
+            try:
+                cve = vuln['cve']
+                cve_id = cve['id']
+            except KeyError:
+                cve_id = None
+            except TypeError:
                 print(f"[NVD Debug] 跳過一筆格式錯誤的 CVE (cve 非 dict)")
                 continue
-
-            cve_id = cve.get('id')
             if not cve_id:
                 print(f"[NVD Debug] 跳過一筆沒有 CVE ID 的資料")
                 continue
+            if cve_id in existing:
+                continue
                 
-            cve_data_as_string = json.dumps(cve).lower()
+            # 只序列化一次：同時用於關鍵字比對與寫入 raw_data
+            raw_data = _to_json(cve)
+            hay = raw_data.lower()
             
+            # 先以單一正規表示式快速排除不相符的資料；
+            # 命中時再依 PIR 設定順序取第一個出現的關鍵字（與逐一比對的結果一致）
             matched_keyword = None
-            for keyword in keywords:
-                if keyword in cve_data_as_string:
-                    matched_keyword = keyword
-                    break 
+            if keyword_re and keyword_re.search(hay):
+                matched_keyword = next((k for k in keywords if k in hay), None)
             
             if matched_keyword:
-                if not is_intel_exists(db_conn, cve_id):
-                    cvss_score = 0.0
-                    
-                    # --- (防呆點) 確保 metrics 結構正確 ---
-                    metrics_data = cve.get('metrics', {}).get('cvssMetricV31', [])
-                    if isinstance(metrics_data, list) and len(metrics_data) > 0:
-                        cvss_data = metrics_data[0].get('cvssData', {})
-                        if isinstance(cvss_data, dict):
-                            cvss_score = cvss_data.get('baseScore', 0.0)
-                    
-                    title = f"NVD: {cve_id} (Keyword: {matched_keyword})"
-                    raw_data = json.dumps(cve)
-                    
-                    cursor = db_conn.cursor()
-                    cursor.execute(
-                        """
-                        INSERT INTO T_Raw_Intel (source, type, title, cve_id, cvss_score, raw_data, status)
-                        VALUES (?, ?, ?, ?, ?, ?, 'new')
-                        """,
-                        ('NVD', 'CVE', title, cve_id, cvss_score, raw_data)
-                    )
-                    new_vulns_found += 1
-                    print(f"[NVD Debug] 發現相符 CVE: {cve_id} (關鍵字: {matched_keyword})")
+                cvss_score = _extract_cvss(cve)
+                title = f"NVD: {cve_id} (Keyword: {matched_keyword})"
+                rows.append(('NVD', 'CVE', title, cve_id, cvss_score, raw_data))
+                existing.add(cve_id)  # 避免同一批次內重複寫入
+                print(f"[NVD Debug] 發現相符 CVE: {cve_id} (關鍵字: {matched_keyword})")
+        
+        # 單一交易批次寫入（已存在者由唯一索引忽略）
+        new_vulns_found = _bulk_insert(db_conn, _SQL_INSERT_NVD, rows)
         
         is_key_valid = (api_key and api_key != 'YOUR_NVD_API_KEY_HERE')
         sleep_duration = 6 if is_key_valid else 10 
@@ -266,8 +365,6 @@ def fetch_nvd(db_conn, config):
     except json.JSONDecodeError as e:
         print(f"錯誤 (JSON)：解析 NVD JSON 失敗：{e}", file=sys.stderr)
             
-    if new_vulns_found > 0:
-        db_conn.commit()
     print(f"--- [Collector] NVD 完成。發現 {new_vulns_found} 筆新情資。 ---")
 
 
@@ -11,14 +11,108 @@ AETIM 關聯與風險評分引擎 (Correlation & Scoring Engine)
 5. 寫入 T_Validated_Threats 資料表
 """
 
+import os
 import sys
 import json
+import heapq
+import traceback
+import logging
 import sqlite3
+import numpy as np
 import pandas as pd
 import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import List, Dict, Tuple, Optional
-from utils import get_db_connection, load_config
+from utils import get_db_connection, load_config, ensure_raw_intel_indexes, configure_logging
+
+# 逐筆比對/評分的細節輸出走 DEBUG 等級（預設不輸出，也不會格式化字串）；
+# 需要時於呼叫端設定 logging.getLogger('aetim.correlation').setLevel(logging.DEBUG) 並加上 handler
+logger = logging.getLogger('aetim.correlation')
+
+try:
+    import orjson  # 選用：加速 raw_data JSON 解析
+except ImportError:
+    orjson = None
+
+try:
+    from rapidfuzz import process, fuzz  # 選用：以 token set 模糊比對補足字序不同的產品名稱
+except ImportError:
+    process = fuzz = None
+
+# 模糊比對門檻（token_set_ratio，0-100）
+FUZZY_SCORE_CUTOFF = 80
+
+# 情資比對平行化：只有 RapidFuzz cdist 會釋放 GIL，pandas 的 object 字串運算與 map(lambda) 仍持有 GIL，
+# 因此執行緒數以 CPU 數為上限；平行時 cdist 各自只用單一執行緒，避免與執行緒池疊加超額使用 CPU
+# 除錯時可設為 False 改回單執行緒（此時 cdist 改用所有 CPU）
+PARALLEL_MATCHING = True
+MATCH_WORKERS = os.cpu_count() or 1
+
+# 寫入驗證後威脅的 SQL
+_SQL_INSERT_THREAT = """
+    INSERT INTO T_Validated_Threats
+    (intel_id, asset_id, risk_score, status, notes, timestamp)
+    VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+"""
+
+# CPE 2.3 字串的廠商與產品欄位：cpe:2.3:<part>:<vendor>:<product>:...
+_CPE_RE = re.compile(r'cpe:2\.3:[aho]:([^:]*):([^:]*):')
+
+# 產品關鍵字（情資文字中搜尋常見產品名稱；模組載入時建立一次，皆為不可變結構）
+DESCRIPTION_KEYWORDS = frozenset(('windows server', 'sql server', 'vmware', 'esxi', 'microsoft', 'delphi', 'eep'))
+SUMMARY_KEYWORDS = frozenset(('windows server', 'sql server', 'vmware', 'esxi', 'microsoft'))
+TITLE_KEYWORDS = (
+    ('windows server', ('windows server 2008', 'windows server 2016', 'windows server 2022')),
+    ('sql server', ('sql server', 'mssql')),
+    ('vmware', ('vmware esxi', 'vmware', 'esxi')),
+    ('microsoft', ('microsoft',)),
+)
+
+
+def _build_keyword_matcher(keywords):
+    """
+    將關鍵字清單編譯為單一正規表示式（lookahead 取得每個位置起最長的關鍵字，可重疊），
+    並預先算出每個關鍵字所包含的其他關鍵字，讓一次掃描即可得到與逐一 `keyword in text` 相同的結果
+    """
+    keywords = sorted(set(keywords), key=len, reverse=True)
+    pattern = re.compile('(?=(' + '|'.join(re.escape(k) for k in keywords) + '))')
+    contained = {k: [other for other in keywords if other in k] for k in keywords}
+    return pattern, contained
+
+
+def _find_keywords(matcher, text: str) -> List[str]:
+    """以預先編譯的 matcher 找出 text（已轉小寫）中出現的所有關鍵字"""
+    pattern, contained = matcher
+    found = []
+    for hit in set(pattern.findall(text)):
+        found.extend(contained[hit])
+    return found
+
+
+_DESCRIPTION_MATCHER = _build_keyword_matcher(DESCRIPTION_KEYWORDS)
+_SUMMARY_MATCHER = _build_keyword_matcher(SUMMARY_KEYWORDS)
+_TITLE_MATCHER = _build_keyword_matcher(v for _, variants in TITLE_KEYWORDS for v in variants)
+_TITLE_CATEGORY = {v: category for category, variants in TITLE_KEYWORDS for v in variants}
+
+
+def parse_raw_data(raw_data) -> Optional[Dict]:
+    """
+    解析情資的 raw_data JSON 字串
+    
+    Args:
+        raw_data: T_Raw_Intel.raw_data 欄位值
+    
+    Returns:
+        解析後的 dict；空值、格式錯誤或非物件時返回 None
+    """
+    if not raw_data or not isinstance(raw_data, (str, bytes)):
+        return None
+    try:
+        parsed = orjson.loads(raw_data) if orjson is not None else json.loads(raw_data)
+    except json.JSONDecodeError:  # orjson.JSONDecodeError 亦為其子類別
+        return None
+    return parsed if isinstance(parsed, dict) else None
 
 
 def extract_product_name_from_intel(intel_data: Dict) -> List[str]:
@@ -33,195 +127,248 @@ def extract_product_name_from_intel(intel_data: Dict) -> List[str]:
     """
     product_names = []
     
+    # 只處理 CVE 情資（缺少 type 時視為 CVE，維持直接呼叫的相容性）
+    if str(intel_data.get('type') or 'CVE').upper() != 'CVE':
+        return product_names
+    
     # 嘗試從不同來源提取產品名稱
     # 1. 從 raw_data JSON 中提取
-    if intel_data.get('raw_data'):
-        try:
-            raw_data = json.loads(intel_data['raw_data'])
-            
-            # CISA KEV 格式
-            if 'vulnerabilityName' in raw_data:
-                product_names.append(raw_data['vulnerabilityName'])
-            if 'product' in raw_data:
-                product_names.append(raw_data['product'])
-            if 'vendorProject' in raw_data:
-                product_names.append(raw_data['vendorProject'])
-            
-            # NVD 格式
-            if 'cve' in raw_data:
-                cve_data = raw_data['cve']
-                # 從 configurations 中提取
-                if 'configurations' in cve_data:
-                    for config in cve_data['configurations']:
-                        if 'nodes' in config:
-                            for node in config['nodes']:
-                                if 'cpeMatch' in node:
-                                    for cpe in node['cpeMatch']:
-                                        if 'criteria' in cpe:
-                                            # CPE 格式：cpe:2.3:a:microsoft:sql_server:2017:*:*:*:*:*:*:*
-                                            # 提取產品名稱
-                                            cpe_parts = cpe['criteria'].split(':')
-                                            if len(cpe_parts) >= 4:
-                                                vendor = cpe_parts[3]
-                                                product = cpe_parts[4]
-                                                if product and product != '*':
-                                                    product_names.append(f"{vendor} {product}")
-                                                if vendor and vendor != '*':
-                                                    product_names.append(vendor)
-                
-                # 從 descriptions 中提取關鍵字
-                if 'descriptions' in cve_data:
-                    for desc in cve_data['descriptions']:
-                        if desc.get('lang') == 'en':
-                            text = desc.get('value', '').lower()
-                            # 搜尋常見產品名稱
-                            keywords = ['windows server', 'sql server', 'vmware', 'esxi', 
-                                       'microsoft', 'delphi', 'eep']
-                            for keyword in keywords:
-                                if keyword in text:
-                                    product_names.append(keyword)
-            
-            # RSS Feed 格式
-            if 'summary' in raw_data:
-                summary = raw_data['summary'].lower()
-                keywords = ['windows server', 'sql server', 'vmware', 'esxi', 'microsoft']
-                for keyword in keywords:
-                    if keyword in summary:
-                        product_names.append(keyword)
-        
-        except json.JSONDecodeError:
-            pass
+    raw_data = parse_raw_data(intel_data.get('raw_data'))
+    if raw_data:
+        # CISA KEV 格式
+        if 'vulnerabilityName' in raw_data:
+            product_names.append(raw_data['vulnerabilityName'])
+        if 'product' in raw_data:
+            product_names.append(raw_data['product'])
+        if 'vendorProject' in raw_data:
+            product_names.append(raw_data['vendorProject'])
+
+        # NVD 格式
+        if 'cve' in raw_data:
+            cve_data = raw_data['cve']
+            # 從 configurations 中提取
+            if 'configurations' in cve_data:
+                for config in cve_data['configurations']:
+                    if 'nodes' in config:
+                        for node in config['nodes']:
+                            if 'cpeMatch' in node:
+                                for cpe in node['cpeMatch']:
+                                    if 'criteria' in cpe:
+                                        # CPE 格式：cpe:2.3:a:microsoft:sql_server:2017:*:*:*:*:*:*:*
+                                        # 提取廠商與產品名稱
+                                        m = _CPE_RE.match(cpe['criteria'])
+                                        if m:
+                                            vendor, product = m.groups()
+                                            if product and product != '*':
+                                                product_names.append(f"{vendor} {product}")
+                                            if vendor and vendor != '*':
+                                                product_names.append(vendor)
+
+            # 從 descriptions 中提取關鍵字
+            if 'descriptions' in cve_data:
+                for desc in cve_data['descriptions']:
+                    if desc.get('lang') == 'en':
+                        text = desc.get('value', '').lower()
+                        # 搜尋常見產品名稱
+                        product_names.extend(_find_keywords(_DESCRIPTION_MATCHER, text))
+
+        # RSS Feed 格式
+        if 'summary' in raw_data:
+            summary = raw_data['summary'].lower()
+            product_names.extend(_find_keywords(_SUMMARY_MATCHER, summary))
     
     # 2. 從 title 中提取關鍵字
-    if intel_data.get('title'):
-        title = intel_data['title'].lower()
-        # 提取可能的產品名稱
-        keywords = {
-            'windows server': ['windows server 2008', 'windows server 2016', 'windows server 2022'],
-            'sql server': ['sql server', 'mssql'],
-            'vmware': ['vmware esxi', 'vmware', 'esxi'],
-            'microsoft': ['microsoft'],
-        }
-        for category, variants in keywords.items():
-            for variant in variants:
-                if variant in title:
-                    product_names.append(variant)
-                    product_names.append(category)
+    title = intel_data.get('title')
+    if title and isinstance(title, str):
+        title = title.lower()
+        # 提取可能的產品名稱（變體與其分類）
+        for variant in _find_keywords(_TITLE_MATCHER, title):
+            product_names.append(variant)
+            product_names.append(_TITLE_CATEGORY[variant])
     
     # 去重並返回
-    return list(set([p.lower().strip() for p in product_names if p]))
+    return list({p.lower().strip() for p in product_names if p})
+
+
+def prepare_asset_match_columns(df_assets: pd.DataFrame) -> pd.DataFrame:
+    """
+    預先建立小寫的 OS / 應用程式欄位（_os_lc, _app_lc），每次分析只做一次
+    
+    Args:
+        df_assets: 資產 DataFrame
+    
+    Returns:
+        同一個 DataFrame（已加入比對欄位）
+    """
+    df_assets['_os_lc'] = df_assets['os_version'].fillna('').astype(str).str.lower()
+    df_assets['_app_lc'] = df_assets['applications'].fillna('').astype(str).str.lower()
+    df_assets['_asset_lc'] = df_assets['_os_lc'] + ' ' + df_assets['_app_lc']
+    return df_assets
 
 
 def match_cve_with_assets(intel_data: Dict, df_assets: pd.DataFrame) -> List[int]:
     """
-    比對 CVE 情資與資產清單
+    比對 CVE 情資與資產清單（向量化字串比對）
     
     Args:
         intel_data: 情資資料
-        df_assets: 資產 DataFrame
+        df_assets: 資產 DataFrame（需含 prepare_asset_match_columns 建立的 _os_lc / _app_lc）
     
     Returns:
         匹配的資產 ID 列表
     """
-    matched_asset_ids = []
-    
     # 提取產品名稱
     product_names = extract_product_name_from_intel(intel_data)
     
     if not product_names:
-        return matched_asset_ids
+        return []
     
-    # 對每個資產進行比對
-    for _, asset in df_assets.iterrows():
-        asset_id = asset['id']
-        os_version = str(asset.get('os_version', '')).lower()
-        applications = str(asset.get('applications', '')).lower()
-        
-        # 模糊字串比對
-        for product_name in product_names:
-            # 檢查產品名稱是否在 OS 或應用程式中
-            if (product_name in os_version or product_name in applications or
-                os_version in product_name or applications in product_name):
-                matched_asset_ids.append(asset_id)
-                print(f"[比對] 找到匹配：{product_name} <-> 資產 ID {asset_id} ({asset.get('hostname', 'N/A')})")
-                break  # 找到匹配後跳出內層迴圈，避免重複加入
+    if '_os_lc' not in df_assets.columns:
+        prepare_asset_match_columns(df_assets)
+    os_lc = df_assets['_os_lc']
+    app_lc = df_assets['_app_lc']
+    
+    # 產品名稱出現在 OS 或應用程式中：單一正規表示式一次掃描整欄
+    pattern = '|'.join(re.escape(p) for p in product_names)
+    mask = os_lc.str.contains(pattern, regex=True, na=False) | app_lc.str.contains(pattern, regex=True, na=False)
+    
+    # 反向包含：OS 或應用程式整段字串出現在某個產品名稱中（空字串不視為匹配）
+    joined = '\x00'.join(product_names)
+    mask |= os_lc.map(lambda v: bool(v) and v in joined) | app_lc.map(lambda v: bool(v) and v in joined)
+    
+    # 字序不同或重複詞（如 "Microsoft SQL Server 2017" vs "sql server"）：RapidFuzz token set 比對
+    if process is not None:
+        scores = process.cdist(
+            product_names, df_assets['_asset_lc'].tolist(),
+            scorer=fuzz.token_set_ratio, score_cutoff=FUZZY_SCORE_CUTOFF,
+            workers=1 if PARALLEL_MATCHING else -1
+        )
+        mask |= (scores >= FUZZY_SCORE_CUTOFF).any(axis=0)
     
-    return list(set(matched_asset_ids))  # 去重
+    matched_asset_ids = df_assets.loc[mask, 'id'].tolist()
+    if matched_asset_ids:
+        logger.debug("[比對] 產品 %s 匹配 %d 個資產：%s", product_names[:5], len(matched_asset_ids), matched_asset_ids[:10])
+    
+    return matched_asset_ids
 
 
-def calculate_risk_score(intel_data: Dict, asset_data: Dict) -> float:
+# 業務關鍵性 / 資料敏感度視為「高」的值
+HIGH_LEVELS = ['高', 'HIGH', 'CRITICAL']
+DEFAULT_BASE_SCORE = 7.0  # CVSS 空值或無效時的預設中等風險
+
+
+# 低基數欄位：載入後轉為 category（以整數代碼儲存，字串轉換只需處理少數類別值）
+ASSET_CATEGORY_COLUMNS = ('is_public', 'business_criticality', 'data_sensitivity')
+INTEL_CATEGORY_COLUMNS = ('source', 'type')
+
+
+def _to_category(df: pd.DataFrame, columns) -> pd.DataFrame:
+    for col in columns:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    return df
+
+
+def _upper_series(df: pd.DataFrame, column: str) -> pd.Series:
+    if column not in df.columns:
+        return pd.Series('', index=df.index)
+    s = df[column]
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        # 只轉換類別值，再依代碼展開；代碼 -1（空值）對應到最後補上的 ''
+        lut = np.append(np.asarray(s.cat.categories.astype(str).str.upper(), dtype=object), '')
+        return pd.Series(lut[s.cat.codes.to_numpy()], index=df.index)
+    return s.fillna('').astype(str).str.upper()
+
+
+def _lower_series(df: pd.DataFrame, column: str) -> pd.Series:
+    return df[column].fillna('').astype(str).str.lower() if column in df.columns else pd.Series('', index=df.index)
+
+
+def calculate_risk_scores(df_matches: pd.DataFrame) -> np.ndarray:
     """
-    計算風險分數（基於 CVSS 和情境加權）
+    以向量化方式計算多組 (情資, 資產) 的風險分數（基於 CVSS 和情境加權）
     
     Args:
-        intel_data: 情資資料
-        asset_data: 資產資料
+        df_matches: 每列一組匹配，需含情資欄位 cvss_score、source 與資產欄位
+                    is_public、business_criticality、data_sensitivity、os_version、applications
+                    （若已有 _os_lc / _app_lc 則直接使用）
     
     Returns:
-        風險分數（0-10）
+        風險分數陣列（0-10，四捨五入至小數兩位）
     """
-    # 基礎分數：CVSS 分數，如果沒有則使用預設值 7.0
-    cvss_score = intel_data.get('cvss_score')
-    
-    # 處理 None 值或無效值
-    if cvss_score is None or cvss_score == '' or cvss_score == 'None':
-        base_score = 7.0  # 預設中等風險
-        print(f"[評分] CVSS 分數為空或無效，使用預設值：{base_score}")
-    else:
-        try:
-            base_score = float(cvss_score)
-            if base_score == 0.0 or base_score < 0 or base_score > 10:
-                base_score = 7.0  # 預設中等風險
-                print(f"[評分] CVSS 分數無效 ({cvss_score})，使用預設值：{base_score}")
-            else:
-                print(f"[評分] 基礎分數 (CVSS)：{base_score}")
-        except (ValueError, TypeError) as e:
-            print(f"[評分] CVSS 分數轉換失敗 ({cvss_score})：{e}，使用預設值")
-            base_score = 7.0  # 預設中等風險
+    # 基礎分數：CVSS 分數，空值、無法轉換或不在 (0, 10] 範圍內則使用預設值
+    cvss = pd.to_numeric(df_matches['cvss_score'], errors='coerce').to_numpy(dtype=float)
+    score = np.where((cvss > 0) & (cvss <= 10), cvss, DEFAULT_BASE_SCORE)
     
-    # 情境加權（根據 PIR 需求）
-    multipliers = []
+    os_lc = df_matches['_os_lc'] if '_os_lc' in df_matches.columns else _lower_series(df_matches, 'os_version')
+    app_lc = df_matches['_app_lc'] if '_app_lc' in df_matches.columns else _lower_series(df_matches, 'applications')
     
     # 1. 是否對外暴露（Is_Public == 'Y'）
-    if asset_data.get('is_public', '').upper() == 'Y':
-        base_score *= 1.5
-        multipliers.append("對外暴露 (x1.5)")
-        print(f"[評分] 套用加權：對外暴露 (x1.5) -> {base_score}")
-    
+    is_public = (_upper_series(df_matches, 'is_public') == 'Y').to_numpy()
     # 2. 業務關鍵性（高）
-    if asset_data.get('business_criticality', '').upper() in ['高', 'HIGH', 'CRITICAL']:
-        base_score *= 1.3
-        multipliers.append("業務關鍵性-高 (x1.3)")
-        print(f"[評分] 套用加權：業務關鍵性-高 (x1.3) -> {base_score}")
-    
+    is_critical = _upper_series(df_matches, 'business_criticality').isin(HIGH_LEVELS).to_numpy()
     # 3. CISA KEV（已被積極利用）
-    if intel_data.get('source', '') == 'CISA_KEV':
-        base_score *= 2.0
-        multipliers.append("CISA KEV (x2.0)")
-        print(f"[評分] 套用加權：CISA KEV (x2.0) -> {base_score}")
-    
+    is_kev = (df_matches['source'] == 'CISA_KEV').to_numpy()
     # 4. 老舊系統（Windows Server 2008）
-    os_version = str(asset_data.get('os_version', '')).lower()
-    if '2008' in os_version or '2008' in str(asset_data.get('applications', '')).lower():
-        base_score *= 1.2
-        multipliers.append("老舊系統 (x1.2)")
-        print(f"[評分] 套用加權：老舊系統 (x1.2) -> {base_score}")
-    
+    is_legacy = (os_lc.str.contains('2008', regex=False) | app_lc.str.contains('2008', regex=False)).to_numpy()
     # 5. 資料敏感度高
-    if asset_data.get('data_sensitivity', '').upper() in ['高', 'HIGH', 'CRITICAL']:
-        base_score *= 1.1
-        multipliers.append("資料敏感度高 (x1.1)")
-        print(f"[評分] 套用加權：資料敏感度高 (x1.1) -> {base_score}")
+    is_sensitive = _upper_series(df_matches, 'data_sensitivity').isin(HIGH_LEVELS).to_numpy()
+    
+    # 情境加權（根據 PIR 需求）：依原本順序逐項相乘，確保與逐筆計算的浮點結果一致
+    for flag, weight in ((is_public, 1.5), (is_critical, 1.3), (is_kev, 2.0), (is_legacy, 1.2), (is_sensitive, 1.1)):
+        score = np.where(flag, score * weight, score)
     
     # 限制最大分數為 10.0
-    final_score = min(10.0, base_score)
+    return np.round(np.minimum(10.0, score), 2)
+
+
+def calculate_risk_score(intel_data: Dict, asset_data: Dict) -> float:
+    """
+    計算單組情資與資產的風險分數（calculate_risk_scores 的單筆版本）
+    
+    Args:
+        intel_data: 情資資料
+        asset_data: 資產資料
+    
+    Returns:
+        風險分數（0-10）
+    """
+    row = dict(asset_data)
+    row['cvss_score'] = intel_data.get('cvss_score')
+    row['source'] = intel_data.get('source', '')
+    return float(calculate_risk_scores(pd.DataFrame([row]))[0])
+
+
+def _match_intel(intel_data: Dict, df_assets: pd.DataFrame) -> List[int]:
+    """
+    比對單筆情資與資產（只讀取 df_assets，可於執行緒池中呼叫）
+    
+    Args:
+        intel_data: 情資資料
+        df_assets: 已建立比對欄位的資產 DataFrame
+    
+    Returns:
+        匹配的資產 ID 列表
+    """
+    intel_type = intel_data.get('type', '').upper() if intel_data.get('type') else ''
+    
+    logger.debug("[處理] 情資 ID %s: %.50s（來源：%s, 類型：%s, CVSS：%s）",
+                 intel_data.get('id'), intel_data.get('title', 'N/A'), intel_data.get('source', 'N/A'),
+                 intel_type, intel_data.get('cvss_score', 'N/A'))
+    
+    # 比對邏輯 A：CVE 比對
+    if intel_type == 'CVE':
+        matched_asset_ids = match_cve_with_assets(intel_data, df_assets)
+        if matched_asset_ids:
+            logger.debug("[比對] 找到 %d 個匹配的資產", len(matched_asset_ids))
+        return matched_asset_ids
     
-    if multipliers:
-        print(f"[評分] 最終風險分數：{final_score:.2f} (加權因子：{', '.join(multipliers)})")
-    else:
-        print(f"[評分] 最終風險分數：{final_score:.2f} (無額外加權)")
+    # 比對邏輯 B：IOC 比對（未來實現）
+    # elif intel_type == 'IOC_REPORT':
+    #     # TODO: 實現 IOC IP 比對邏輯
+    #     pass
     
-    return round(final_score, 2)
+    return []
 
 
 def run_correlation_analysis(db_conn, config):
@@ -239,7 +386,15 @@ def run_correlation_analysis(db_conn, config):
     try:
         # 步驟 1：載入資產清單
         print("\n[步驟 1] 載入資產清單...")
-        df_assets = pd.read_sql_query("SELECT * FROM T_Assets", db_conn)
+        # 只取比對與評分會用到的欄位
+        df_assets = pd.read_sql_query(
+            """
+            SELECT id, hostname, os_version, applications, is_public, business_criticality, data_sensitivity
+            FROM T_Assets
+            """,
+            db_conn
+        )
+        _to_category(df_assets, ASSET_CATEGORY_COLUMNS)
         asset_count = len(df_assets)
         print(f"[步驟 1] 成功載入 {asset_count} 筆資產")
         
@@ -247,15 +402,20 @@ def run_correlation_analysis(db_conn, config):
             print("警告：資產清單為空，無法進行比對。")
             return
         
-        # 步驟 2：提取新情資
+        prepare_asset_match_columns(df_assets)
+        
+        # 步驟 2：提取新情資（以 status/timestamp 索引範圍掃描）
         print("\n[步驟 2] 提取新情資...")
+        ensure_raw_intel_indexes(db_conn)
         query = """
-            SELECT id, source, type, title, url, cve_id, cvss_score, raw_data, status, timestamp
+            SELECT id, source, type, title, cve_id, cvss_score, raw_data
             FROM T_Raw_Intel
             WHERE status = 'new'
             ORDER BY timestamp DESC
         """
         df_new_intel = pd.read_sql_query(query, db_conn)
+        _to_category(df_new_intel, INTEL_CATEGORY_COLUMNS)
+        df_new_intel['cvss_score'] = pd.to_numeric(df_new_intel['cvss_score'], errors='coerce')
         intel_count = len(df_new_intel)
         print(f"[步驟 2] 找到 {intel_count} 筆新情資")
         
@@ -265,131 +425,123 @@ def run_correlation_analysis(db_conn, config):
         
         # 步驟 3：迭代比對
         print("\n[步驟 3] 開始比對情資與資產...")
-        validated_threats = []  # 儲存驗證後的威脅
+        matches = []  # 匹配結果 (intel_id, asset_id, source, cvss_score, cve_id)，迴圈後統一評分
         processed_intel_ids = []  # 儲存已處理的情資 ID
         
-        for _, intel_row in df_new_intel.iterrows():
+        intel_rows = []
+        for intel in df_new_intel.itertuples(index=False):
+            if not intel.id:
+                print(f"[警告] 跳過無效情資：缺少 ID")
+                continue
+            intel_rows.append(intel)
+        
+        def _safe_match(intel):
+            # 只有 CVE 情資需要比對，也只有這些才建立 dict 交給比對函式
+            if str(intel.type).upper() != 'CVE':
+                return [], None
             try:
-                intel_data = intel_row.to_dict()
-                intel_id = intel_data.get('id')
-                intel_type = intel_data.get('type', '').upper() if intel_data.get('type') else ''
-                
-                if not intel_id:
-                    print(f"[警告] 跳過無效情資：缺少 ID")
-                    continue
-                
-                print(f"\n[處理] 情資 ID {intel_id}: {str(intel_data.get('title', 'N/A'))[:50]}")
-                print(f"       來源：{intel_data.get('source', 'N/A')}, 類型：{intel_type}, CVSS：{intel_data.get('cvss_score', 'N/A')}")
-                
-                is_match = False
-                matched_asset_ids = []
-                
-                # 比對邏輯 A：CVE 比對
-                if intel_type == 'CVE':
-                    matched_asset_ids = match_cve_with_assets(intel_data, df_assets)
-                    if matched_asset_ids:
-                        is_match = True
-                        print(f"[比對] 找到 {len(matched_asset_ids)} 個匹配的資產")
-                
-                # 比對邏輯 B：IOC 比對（未來實現）
-                # elif intel_type == 'IOC_REPORT':
-                #     # TODO: 實現 IOC IP 比對邏輯
-                #     pass
-                
-                # 步驟 4：風險評分與寫入
-                if is_match and matched_asset_ids:
-                    for asset_id in matched_asset_ids:
-                        try:
-                            # 獲取資產資料
-                            asset_row = df_assets[df_assets['id'] == asset_id]
-                            if asset_row.empty:
-                                print(f"[警告] 找不到資產 ID {asset_id}，跳過")
-                                continue
-                            
-                            asset_data = asset_row.iloc[0].to_dict()
-                            
-                            # 計算風險分數
-                            risk_score = calculate_risk_score(intel_data, asset_data)
-                            
-                            # 準備寫入資料
-                            validated_threat = {
-                                'intel_id': intel_id,
-                                'asset_id': asset_id,
-                                'risk_score': risk_score,
-                                'status': 'new',
-                                'notes': f"來源：{intel_data.get('source', 'N/A')}, CVE：{intel_data.get('cve_id', 'N/A')}"
-                            }
-                            validated_threats.append(validated_threat)
-                            
-                            print(f"[結果] 威脅已驗證：情資 ID {intel_id} -> 資產 ID {asset_id} (風險分數：{risk_score})")
-                        except Exception as asset_e:
-                            print(f"[錯誤] 處理資產 ID {asset_id} 時失敗：{asset_e}", file=sys.stderr)
-                            continue
-                    
-                    processed_intel_ids.append(intel_id)
-                else:
-                    # 沒有匹配，標記為已處理（無匹配）
-                    processed_intel_ids.append(intel_id)
-                    print(f"[結果] 無匹配資產，標記為已記錄（無匹配）")
-            
+                return _match_intel(intel._asdict(), df_assets), None
             except Exception as intel_e:
-                print(f"[錯誤] 處理情資 ID {intel_id} 時發生錯誤：{intel_e}", file=sys.stderr)
-                import traceback
-                traceback.print_exc()
-                # 即使錯誤也要標記為已處理，避免無限重試
-                if intel_id and intel_id not in processed_intel_ids:
-                    processed_intel_ids.append(intel_id)
-                continue
+                return [], (intel_e, traceback.format_exc())
+        
+        # 各筆情資的比對互相獨立，交給執行緒池；資料庫寫入仍留在主執行緒
+        if PARALLEL_MATCHING and len(intel_rows) > 1:
+            with ThreadPoolExecutor(max_workers=MATCH_WORKERS) as executor:
+                results = list(executor.map(_safe_match, intel_rows))
+        else:
+            results = [_safe_match(intel) for intel in intel_rows]
+        
+        for intel, (matched_asset_ids, error) in zip(intel_rows, results):
+            intel_id = intel.id
+            if error:
+                print(f"[錯誤] 處理情資 ID {intel_id} 時發生錯誤：{error[0]}", file=sys.stderr)
+                print(error[1], file=sys.stderr, end='')
+            elif matched_asset_ids:
+                # 記錄匹配結果（資產 ID 皆取自 df_assets；風險評分於迴圈後一次計算）
+                for asset_id in matched_asset_ids:
+                    matches.append((intel_id, asset_id, intel.source, intel.cvss_score, intel.cve_id))
+            else:
+                logger.debug("[結果] 情資 ID %s 無匹配資產，標記為已記錄（無匹配）", intel_id)
+            # 不論是否匹配或發生錯誤都標記為已處理，避免無限重試
+            processed_intel_ids.append(intel_id)
+        
+        matched_intel_count = len({m[0] for m in matches})
+        print(f"[步驟 3] 比對完成：{matched_intel_count}/{intel_count} 筆情資有匹配，共 {len(matches)} 組（情資, 資產）")
+        
+        # 步驟 4：向量化風險評分
+        validated_threats = []  # 儲存驗證後的威脅
+        if matches:
+            df_matches = pd.DataFrame(matches, columns=['intel_id', 'asset_id', 'source', 'cvss_score', 'cve_id'])
+            df_matches = df_matches.join(df_assets.set_index('id'), on='asset_id')
+            df_matches['risk_score'] = calculate_risk_scores(df_matches)
+            for intel_id, asset_id, source, cve_id, risk_score in zip(
+                df_matches['intel_id'].tolist(), df_matches['asset_id'].tolist(), df_matches['source'].tolist(),
+                df_matches['cve_id'].tolist(), df_matches['risk_score'].tolist()
+            ):
+                validated_threats.append({
+                    'intel_id': intel_id,
+                    'asset_id': asset_id,
+                    'risk_score': risk_score,
+                    'status': 'new',
+                    'notes': f"來源：{source}, CVE：{cve_id}"
+                })
+                logger.debug("[結果] 威脅已驗證：情資 ID %s -> 資產 ID %s (風險分數：%s)", intel_id, asset_id, risk_score)
         
         # 步驟 5：批次寫入資料庫
         print(f"\n[步驟 4] 寫入驗證後的威脅...")
         cursor = db_conn.cursor()
         
+        threat_rows = [
+            (t['intel_id'], t['asset_id'], t['risk_score'], t['status'], t['notes'])
+            for t in validated_threats
+        ]
+        matched_intel_ids = {t['intel_id'] for t in validated_threats}
+        matched_assets = {t['asset_id'] for t in validated_threats}
+        status_updates = [
+            ('processed' if intel_id in matched_intel_ids else 'logged (no match)', intel_id)
+            for intel_id in processed_intel_ids
+        ]
+        
         threats_written = 0
         threats_failed = 0
-        for threat in validated_threats:
+        with db_conn:  # 威脅寫入與狀態更新在同一交易中提交
+            # SAVEPOINT 不會觸發 sqlite3 的隱式 BEGIN；未先開啟交易時，RELEASE 會直接提交威脅寫入
+            if not db_conn.in_transaction:
+                cursor.execute("BEGIN")
+            cursor.execute("SAVEPOINT threats")
             try:
-                cursor.execute(
-                    """
-                    INSERT INTO T_Validated_Threats 
-                    (intel_id, asset_id, risk_score, status, notes, timestamp)
-                    VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-                    """,
-                    (threat['intel_id'], threat['asset_id'], threat['risk_score'], 
-                     threat['status'], threat['notes'])
-                )
-                threats_written += 1
+                cursor.executemany(_SQL_INSERT_THREAT, threat_rows)
+                threats_written = len(threat_rows)
             except sqlite3.Error as e:
-                threats_failed += 1
-                print(f"[錯誤] 寫入威脅資料失敗（情資 ID {threat.get('intel_id', 'N/A')}）：{e}", file=sys.stderr)
-        
-        if threats_failed > 0:
-            print(f"[警告] {threats_failed} 筆威脅資料寫入失敗")
-        
-        # 更新 T_Raw_Intel 狀態
-        print(f"\n[步驟 5] 更新情資狀態...")
-        for intel_id in processed_intel_ids:
-            # 檢查是否有匹配的威脅
-            has_match = any(t['intel_id'] == intel_id for t in validated_threats)
-            new_status = 'processed' if has_match else 'logged (no match)'
+                # 批次失敗時回到儲存點，改逐筆寫入以略過有問題的資料
+                cursor.execute("ROLLBACK TO threats")
+                print(f"[警告] 批次寫入威脅資料失敗，改為逐筆寫入：{e}", file=sys.stderr)
+                for row in threat_rows:
+                    try:
+                        cursor.execute(_SQL_INSERT_THREAT, row)
+                        threats_written += 1
+                    except sqlite3.Error as row_e:
+                        threats_failed += 1
+                        print(f"[錯誤] 寫入威脅資料失敗（情資 ID {row[0]}）：{row_e}", file=sys.stderr)
+            cursor.execute("RELEASE threats")
             
-            cursor.execute(
-                "UPDATE T_Raw_Intel SET status = ? WHERE id = ?",
-                (new_status, intel_id)
-            )
-        
-        db_conn.commit()
+            if threats_failed > 0:
+                print(f"[警告] {threats_failed} 筆威脅資料寫入失敗")
+            
+            # 更新 T_Raw_Intel 狀態
+            print(f"\n[步驟 5] 更新情資狀態...")
+            cursor.executemany("UPDATE T_Raw_Intel SET status = ? WHERE id = ?", status_updates)
         
         # 結果摘要
         print("\n" + "=" * 60)
         print(f"[{datetime.now()}] --- 關聯分析完成 ---")
         print("=" * 60)
-        processed_with_match = len(set(t['intel_id'] for t in validated_threats))
+        processed_with_match = len(matched_intel_ids)
         processed_no_match = intel_count - processed_with_match
         
         print(f"處理情資：{intel_count} 筆")
         print(f"驗證威脅：{threats_written} 筆")
-        print(f"匹配資產：{len(set(t['asset_id'] for t in validated_threats))} 個")
+        print(f"匹配資產：{len(matched_assets)} 個")
         print(f"有匹配情資：{processed_with_match} 筆")
         print(f"無匹配情資：{processed_no_match} 筆")
         
@@ -400,7 +552,7 @@ def run_correlation_analysis(db_conn, config):
             
             if high_risk_threats:
                 print(f"\n高風險威脅（風險分數 >= 7.0）：{len(high_risk_threats)} 筆")
-                for threat in sorted(high_risk_threats, key=lambda x: x['risk_score'], reverse=True)[:5]:
+                for threat in heapq.nlargest(5, high_risk_threats, key=lambda x: x['risk_score']):
                     print(f"  - 情資 ID {threat['intel_id']} -> 資產 ID {threat['asset_id']} (風險：{threat['risk_score']})")
             
             # 觸發嚴重威脅通知
@@ -426,6 +578,7 @@ def run_correlation_analysis(db_conn, config):
 
 def main():
     """主函數：執行關聯分析"""
+    configure_logging()
     db_conn = None
     try:
         config = load_config()
@@ -5,14 +5,19 @@ AETIM 密碼加密工具模組
 """
 
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
-from cryptography.hazmat.backends import default_backend
 import os
 import base64
 import sys
+import functools
+
+KEY_FILE = os.path.join('/app', '.aetim_key')
+ENCRYPTED_PREFIX = 'ENCRYPTED:'
+NONCE_SIZE = 12  # 96 bits nonce for GCM
 
 def get_encryption_key():
     """
     取得加密密鑰（優先順序：環境變數 > 密鑰檔案）
+    結果依來源快取：環境變數值或密鑰檔案修改時間改變時才重新解析
     
     Returns:
         bytes: 32 bytes 加密密鑰，如果未設定則返回 None
@@ -20,34 +25,47 @@ def get_encryption_key():
     # 優先從環境變數讀取
     key = os.environ.get('AETIM_ENCRYPTION_KEY')
     if key:
-        # 如果是 base64 編碼，解碼；否則直接使用
-        try:
-            decoded_key = base64.b64decode(key)
-            if len(decoded_key) >= 32:
-                return decoded_key[:32]
-            else:
-                # 如果長度不足，補零到 32 bytes
-                return decoded_key.ljust(32, b'\0')
-        except:
-            # 如果不是 base64，直接使用字串（補零到 32 bytes）
-            key_bytes = key.encode('utf-8')
-            return key_bytes[:32].ljust(32, b'\0')
+        return _key_from_env(key)
     
     # 從密鑰檔案讀取
-    key_file = os.path.join('/app', '.aetim_key')
-    if os.path.exists(key_file):
-        try:
-            with open(key_file, 'rb') as f:
-                key_data = f.read()
-                if len(key_data) >= 32:
-                    return key_data[:32]
-                else:
-                    return key_data.ljust(32, b'\0')
-        except Exception as e:
-            print(f"警告：無法讀取密鑰檔案 {key_file}：{e}", file=sys.stderr)
-            return None
-    
-    return None
+    try:
+        mtime = os.stat(KEY_FILE).st_mtime_ns
+    except OSError:
+        return None
+    return _key_from_file(KEY_FILE, mtime)
+
+@functools.lru_cache(maxsize=1)
+def _key_from_env(key):
+    # 如果是 base64 編碼，解碼；否則直接使用
+    try:
+        decoded_key = base64.b64decode(key)
+        if len(decoded_key) >= 32:
+            return decoded_key[:32]
+        else:
+            # 如果長度不足，補零到 32 bytes
+            return decoded_key.ljust(32, b'\0')
+    except:
+        # 如果不是 base64，直接使用字串（補零到 32 bytes）
+        key_bytes = key.encode('utf-8')
+        return key_bytes[:32].ljust(32, b'\0')
+
+@functools.lru_cache(maxsize=1)
+def _key_from_file(key_file, mtime):
+    try:
+        with open(key_file, 'rb') as f:
+            key_data = f.read()
+            if len(key_data) >= 32:
+                return key_data[:32]
+            else:
+                return key_data.ljust(32, b'\0')
+    except Exception as e:
+        print(f"警告：無法讀取密鑰檔案 {key_file}：{e}", file=sys.stderr)
+        return None
+
+@functools.lru_cache(maxsize=2)
+def _get_cipher(key):
+    """依密鑰快取 AESGCM 物件（避免每次加解密重新建立）"""
+    return AESGCM(key)
 
 def encrypt_password(password: str) -> str:
     """
@@ -57,7 +75,7 @@ def encrypt_password(password: str) -> str:
         password: 明碼密碼
         
     Returns:
-        加密字串格式：ENCRYPTED:<ciphertext>:<nonce>:<tag>
+        加密字串格式：ENCRYPTED:<base64(nonce || ciphertext || tag)>
         
     Raises:
         ValueError: 如果加密密鑰未設定
@@ -69,27 +87,19 @@ def encrypt_password(password: str) -> str:
     if len(key) < 32:
         raise ValueError("加密密鑰長度不足（需要至少 32 bytes）")
     
-    aesgcm = AESGCM(key)
-    nonce = os.urandom(12)  # 96 bits nonce for GCM
-    ciphertext = aesgcm.encrypt(nonce, password.encode('utf-8'), None)
-    
-    # 分離密文和認證標籤（GCM 模式）
-    tag = ciphertext[-16:]
-    ciphertext_only = ciphertext[:-16]
+    aesgcm = _get_cipher(key)
+    nonce = os.urandom(NONCE_SIZE)
+    # AESGCM.encrypt 回傳的密文已附帶 16 bytes 認證標籤，與 nonce 串接後單次 URL-safe Base64 編碼
+    blob = nonce + aesgcm.encrypt(nonce, password.encode('utf-8'), None)
     
-    # Base64 編碼
-    ciphertext_b64 = base64.b64encode(ciphertext_only).decode('utf-8')
-    nonce_b64 = base64.b64encode(nonce).decode('utf-8')
-    tag_b64 = base64.b64encode(tag).decode('utf-8')
-    
-    return f"ENCRYPTED:{ciphertext_b64}:{nonce_b64}:{tag_b64}"
+    return ENCRYPTED_PREFIX + base64.urlsafe_b64encode(blob).decode('ascii')
 
 def decrypt_password(encrypted_str: str) -> str:
     """
     解密密碼
     
     Args:
-        encrypted_str: 加密字串（格式：ENCRYPTED:...）
+        encrypted_str: 加密字串（格式：ENCRYPTED:<blob>；亦相容舊格式 ENCRYPTED:<ciphertext>:<nonce>:<tag>）
         
     Returns:
         明碼密碼
@@ -100,23 +110,26 @@ def decrypt_password(encrypted_str: str) -> str:
     if not encrypted_str or not isinstance(encrypted_str, str):
         return encrypted_str  # 不是字串，直接返回
     
-    if not encrypted_str.startswith('ENCRYPTED:'):
+    if not encrypted_str.startswith(ENCRYPTED_PREFIX):
         return encrypted_str  # 不是加密字串，直接返回
     
     try:
-        parts = encrypted_str.split(':')
-        if len(parts) != 4:
-            raise ValueError("加密字串格式錯誤：應為 ENCRYPTED:<ciphertext>:<nonce>:<tag>")
-        
-        _, ciphertext_b64, nonce_b64, tag_b64 = parts
-        
-        # Base64 解碼
-        ciphertext_only = base64.b64decode(ciphertext_b64)
-        nonce = base64.b64decode(nonce_b64)
-        tag = base64.b64decode(tag_b64)
-        
-        # 合併密文和認證標籤
-        ciphertext = ciphertext_only + tag
+        payload = encrypted_str[len(ENCRYPTED_PREFIX):]
+        if ':' not in payload:
+            # 目前格式：nonce || ciphertext || tag（urlsafe_b64decode 同時接受標準 Base64 的 +/）
+            blob = base64.urlsafe_b64decode(payload.encode('ascii'))
+            if len(blob) <= NONCE_SIZE:
+                raise ValueError("加密字串格式錯誤：資料長度不足")
+            nonce, ciphertext = blob[:NONCE_SIZE], blob[NONCE_SIZE:]
+        else:
+            # 舊格式（向後相容）：ENCRYPTED:<ciphertext>:<nonce>:<tag>
+            parts = payload.split(':')
+            if len(parts) != 3:
+                raise ValueError("加密字串格式錯誤：應為 ENCRYPTED:<blob> 或 ENCRYPTED:<ciphertext>:<nonce>:<tag>")
+            ciphertext_b64, nonce_b64, tag_b64 = parts
+            nonce = base64.b64decode(nonce_b64)
+            # 合併密文和認證標籤
+            ciphertext = base64.b64decode(ciphertext_b64) + base64.b64decode(tag_b64)
         
         # 解密
         key = get_encryption_key()
@@ -126,7 +139,7 @@ def decrypt_password(encrypted_str: str) -> str:
         if len(key) < 32:
             raise ValueError("加密密鑰長度不足（需要至少 32 bytes）")
         
-        aesgcm = AESGCM(key)
+        aesgcm = _get_cipher(key)
         plaintext = aesgcm.decrypt(nonce, ciphertext, None)
         
         return plaintext.decode('utf-8')
@@ -45,7 +45,7 @@ def main():
         print("    python encrypt_password.py --generate-key")
         print("\n範例：")
         print("  python encrypt_password.py 'MyPassword123!'")
-        print("  python encrypt_password.py --decrypt ENCRYPTED:xxxxx:yyyyy:zzzzz")
+        print("  python encrypt_password.py --decrypt ENCRYPTED:<base64 blob>")
         print("  python encrypt_password.py --generate-key")
         print("\n注意：")
         print("  - 加密前請先設定 AETIM_ENCRYPTION_KEY 環境變數或建立 .aetim_key 檔案")
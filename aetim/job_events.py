@@ -2,21 +2,44 @@ import os
 import json
 import uuid
 import time
-from datetime import datetime
+import atexit
+import threading
+from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional
+
+try:
+    import orjson  # 選用：加速 JSONL 序列化／解析
+
+    def _dumps(obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+    _loads = json.loads
 
 TAIPEI_TZ = ZoneInfo('Asia/Taipei')
 BASE_DIR = os.path.dirname(__file__)
 LOG_BASE = os.path.join(BASE_DIR, 'logs', 'weekly_jobs')
 
+# 寫入檔案控制代碼快取（依路徑），避免每筆事件都 open/close
+_OPEN: Dict[str, object] = {}
+_LOCK = threading.Lock()
+_KNOWN_DIRS = set()
+
 
 def _now_iso() -> str:
     return datetime.now(TAIPEI_TZ).isoformat()
 
 
 def _ensure_dir(path: str):
+    if path in _KNOWN_DIRS:
+        return
     os.makedirs(path, exist_ok=True)
+    _KNOWN_DIRS.add(path)
 
 
 def _mask_email(addr: str) -> str:
@@ -38,6 +61,36 @@ def _logfile_path(ts: datetime) -> str:
     return os.path.join(dir_path, f'{ymd}.jsonl')
 
 
+def _append(path: str, record: Dict):
+    """
+    以快取的檔案控制代碼附加一行 JSON。
+    每筆仍立即 flush，確保其他行程（如 Web 介面）讀取時可見；
+    換日時關閉舊檔的控制代碼。
+    """
+    line = _dumps(record) + b'\n'
+    with _LOCK:
+        f = _OPEN.get(path)
+        if f is None:
+            for old_path in list(_OPEN):
+                _OPEN.pop(old_path).close()
+            f = _OPEN[path] = open(path, 'ab', buffering=64 * 1024)
+        f.write(line)
+        f.flush()
+
+
+def _close_all():
+    with _LOCK:
+        for f in _OPEN.values():
+            try:
+                f.close()
+            except Exception:
+                pass
+        _OPEN.clear()
+
+
+atexit.register(_close_all)
+
+
 def start_event(metadata: Optional[Dict] = None) -> Dict:
     """
     建立一筆新的週報事件並落地到 JSONL，回傳事件字典。
@@ -53,13 +106,11 @@ def start_event(metadata: Optional[Dict] = None) -> Dict:
         'recipients': [],
         'email_result': None,
         'duration_ms': None,
-        'updated_at': _now_iso()
+        'updated_at': ts.isoformat()
     }
     if metadata:
         event.update(metadata)
-    path = _logfile_path(ts)
-    with open(path, 'a', encoding='utf-8') as f:
-        f.write(json.dumps(event, ensure_ascii=False) + '\n')
+    _append(_logfile_path(ts), event)
     return event
 
 
@@ -69,44 +120,110 @@ def update_event(event_id: str, updates: Dict):
     前端與 API 在聚合時以最後一筆為準。
     """
     ts = datetime.now(TAIPEI_TZ)
-    record = {'id': event_id, 'updated_at': _now_iso()}
+    record = {'id': event_id, 'updated_at': ts.isoformat()}
     record.update(updates or {})
-    path = _logfile_path(ts)
-    _ensure_dir(os.path.dirname(path))
-    with open(path, 'a', encoding='utf-8') as f:
-        f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    _append(_logfile_path(ts), record)
+
+
+class EventRecorder:
+    """
+    在記憶體中累積單一事件的階段與欄位更新，於 flush() 時合併為一筆 update_event 寫入。
+    phases 保留各階段的時間與訊息，最終狀態以最後一次 phase()/update() 為準。
+    耗時較長的階段以 phase(..., flush=True) 立即寫入，讓 Web 介面可看到進行中的階段。
+    """
+
+    def __init__(self, event_id: str):
+        self.event_id = event_id
+        self.updates: Dict = {}
+        self.phases: List[Dict] = []
+
+    def phase(self, name: str, message: str = '', flush: bool = False, **fields):
+        """記錄進入新階段；flush=True 時連同先前累積的更新一併寫入。"""
+        self.phases.append({'phase': name, 'message': message, 'at': _now_iso()})
+        self.updates['phase'] = name
+        self.updates['message'] = message
+        self.updates.update(fields)
+        if flush:
+            self.flush()
+
+    def update(self, **fields):
+        """合併欄位更新（不做 I/O）。"""
+        self.updates.update(fields)
+
+    def flush(self):
+        """將累積的更新一次寫入；無待寫入內容時不動作。"""
+        if not self.updates:
+            return
+        record = dict(self.updates)
+        if self.phases:
+            record['phases'] = list(self.phases)
+        update_event(self.event_id, record)
+        self.updates.clear()
+
+
+def _iter_lines_reversed(path: str, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+    """
+    由檔尾往前逐行讀取（以區塊讀入，不需載入整個檔案）。
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        tail = b''
+        while pos > 0:
+            size = min(chunk_size, pos)
+            pos -= size
+            f.seek(pos)
+            lines = (f.read(size) + tail).split(b'\n')
+            tail = lines.pop(0)  # 可能是不完整的一行，留待下一個區塊
+            for line in reversed(lines):
+                if line.strip():
+                    yield line
+        if tail.strip():
+            yield tail
 
 
 def list_recent_events(limit: int = 20) -> List[Dict]:
     """
     聚合最近 3 天檔案，彙整每個 id 的最後狀態，回傳依時間排序的前 N 筆。
+    由新到舊反向讀取：較舊的行只補上尚未出現的欄位；已取得 limit 筆完整事件
+    （含 start_event 寫入的 triggered_at）後即停止，更早的事件不可能排進前 N 筆。
+    提前停止時，尚未讀到起始行的 id（較早觸發、近期才更新）只有部分欄位，一併捨棄。
     """
     out: Dict[str, Dict] = {}
+    started = set()
     now = datetime.now(TAIPEI_TZ)
-    files = []
-    for delta in range(0, 3):
-        day = now.fromtimestamp(now.timestamp() - delta * 86400)
-        files.append(_logfile_path(day))
+    files = [_logfile_path(now - timedelta(days=delta)) for delta in range(0, 3)]
     for fp in files:
+        if len(started) >= limit:
+            break
         if not os.path.exists(fp):
             continue
         try:
-            with open(fp, 'r', encoding='utf-8') as f:
-                for line in f:
-                    try:
-                        rec = json.loads(line.strip())
-                        _id = rec.get('id')
-                        if not _id:
-                            continue
-                        if _id not in out:
-                            out[_id] = {}
-                        out[_id].update(rec)
-                    except Exception:
-                        continue
+            for line in _iter_lines_reversed(fp):
+                try:
+                    rec = _loads(line)
+                    _id = rec.get('id')
+                except Exception:
+                    continue
+                if not _id:
+                    continue
+                cur = out.get(_id)
+                if cur is None:
+                    out[_id] = dict(rec)
+                else:
+                    for k, v in rec.items():
+                        cur.setdefault(k, v)  # 較新的值優先
+                if 'triggered_at' in rec:
+                    started.add(_id)
+                    if len(started) >= limit:
+                        break
         except Exception:
             continue
     # 轉為列表，依 triggered_at 或 updated_at 排序
-    items = list(out.values())
+    if len(started) >= limit:
+        items = [out[_id] for _id in started]
+    else:
+        items = list(out.values())
     def _key(x):
         return x.get('triggered_at') or x.get('updated_at') or ''
     items.sort(key=_key, reverse=True)
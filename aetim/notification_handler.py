@@ -6,26 +6,287 @@ AETIM 通知處理器 (Notification Handler)
 
 import sys
 import os
+import ssl
+import sqlite3
 import smtplib
 import json
+import time
+import logging
+import re
+import io
+import mmap
+import atexit
+import base64
+import hashlib
+import functools
+import threading
+import string
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
-from email import encoders
-from datetime import datetime
+from email.generator import BytesGenerator
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from types import MappingProxyType
+from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
-from typing import List, Dict, Optional
-from utils import load_config
+from typing import List, Dict, Optional, Tuple, Union
+from utils import load_config, ensure_validated_threat_indexes
 
 # 設定時區為 Asia/Taipei
 TAIPEI_TZ = ZoneInfo('Asia/Taipei')
 
+# 發送成功走 INFO；連線、TLS、附件等逐步訊息與例外的詳細堆疊走 DEBUG 等級
+# handler 由進入點設定（utils.configure_logging）；需要時設定 logging.getLogger('aetim.notification').setLevel(logging.DEBUG)
+logger = logging.getLogger('aetim.notification')
+
+# SMTP 連線池：依 (伺服器, 埠口, 帳號, 密碼雜湊, TLS) 保留已登入的閒置連線，跨多封信重複使用
+# 每個項目為 [連線, 已發送封數]；發送時取出（同一時間只由一個執行緒使用），發送後歸還
+# 同一條連線發送超過上限後重新建立
+_SMTP_POOL: Dict[tuple, List[list]] = {}
+_POOL_LOCK = threading.Lock()
+SMTP_MAX_MESSAGES_PER_CONNECTION = 100
+SMTP_MAX_IDLE_PER_SERVER = 8
+
+# 連線中斷（閒置逾時、broken pipe）時的重試次數與退避基準秒數（0.2, 0.4, ...）
+SMTP_SEND_ATTEMPTS = 3
+SMTP_RETRY_BACKOFF = 0.2
+
+# 嚴重威脅通知的平行發送上限
+NOTIFY_WORKERS = 8
+
+# 各 SMTP 伺服器最近一次的 TLS session，重新連線時用於 session resumption（省去完整握手）
+_TLS_SESSIONS: Dict[str, ssl.SSLSession] = {}
+
+
+class _SessionReuseContext(ssl.SSLContext):
+    """
+    wrap_socket 時自動帶入同一伺服器上次的 TLS session
+    （smtplib.starttls 只接受 context，無法直接傳入 session）；session 失效時 OpenSSL 會改走完整握手
+    """
+    def wrap_socket(self, sock, *args, server_hostname=None, session=None, **kwargs):
+        if session is None and server_hostname:
+            session = _TLS_SESSIONS.get(server_hostname)
+        return super().wrap_socket(sock, *args, server_hostname=server_hostname, session=session, **kwargs)
+
+
+def _create_tls_context() -> ssl.SSLContext:
+    context = _SessionReuseContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    # 與原本 server.starttls() 的預設 context 相同：不驗證伺服器憑證（相容內部自簽憑證的郵件伺服器）
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+# 所有 STARTTLS 連線共用同一個 context（session 只能在同一 context 建立的連線間重用）
+_TLS_CONTEXT = _create_tls_context()
+
+# 每日摘要最多列出的威脅筆數（總數仍完整顯示）
+DAILY_SUMMARY_MAX_ROWS = 500
+
+# 嚴重威脅通知的信件內容範本（模組載入時建立一次，每筆威脅只做代換）
+_CRIT_IT_TPL = string.Template("""
+緊急資安威脅通知
+
+工單編號：${ticket_id}
+優先級：${priority}
+
+受影響資產：
+- 主機名稱：${hostname}
+- IP 位址：${ip_address}
+- 負責人：${owner}
+
+威脅資訊：
+- CVE ID：${cve_id}
+- 威脅標題：${title}
+- 風險分數：${risk_score} / 10.0
+- 情資來源：${source}
+
+建議行動：
+${recommendations}
+
+---
+此為自動化系統發送的通知，請勿直接回覆。
+""")
+
+_CRIT_OFFICER_TPL = string.Template("""
+緊急資安威脅警報
+
+系統偵測到嚴重威脅，已自動建立工單並通知 IT 團隊。
+
+威脅摘要：
+- CVE ID：${cve_id}
+- 受影響主機：${hostname} (${ip_address})
+- 風險分數：${risk_score} / 10.0
+- 負責人：${owner}
+
+工單編號：${ticket_id}
+優先級：${priority}
+
+---
+此為自動化系統發送的通知，請勿直接回覆。
+""")
+
+
 def get_taipei_time():
     """取得 Asia/Taipei 時區的當前時間"""
     return datetime.now(TAIPEI_TZ)
 
 
-def send_email(subject: str, body: str, to_address: str, from_address: str, 
+@functools.lru_cache(maxsize=32)
+def _encoded_attachment(filepath: str, mtime_ns: int, size: int) -> str:
+    """
+    讀取附件並 Base64 編碼（依路徑、修改時間與大小快取，同一份報告只編碼一次）
+    以 mmap 直接編碼檔案內容，不先讀入一份完整的 bytes
+    email.encoders.encode_base64 在 Python 3 直接使用 base64.encodebytes（含結尾換行），
+    故此處不去除結尾換行，MIME 內容與原本以 encode_base64 編碼時逐位元組相同
+    """
+    if size == 0:
+        return ''  # 空檔案無法 mmap
+    with open(filepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return base64.encodebytes(mm).decode('ascii')
+
+
+def _quit_quietly(server):
+    try:
+        server.quit()
+    except Exception:
+        try:
+            server.close()
+        except Exception:
+            pass
+
+
+def _open_smtp(smtp_server: str, smtp_port: int, smtp_username: str,
+               smtp_password: str, use_tls: bool):
+    """建立新的 SMTP 連線（TLS 與登入）"""
+    logger.debug("正在連線 SMTP 伺服器 %s:%s...", smtp_server, smtp_port)
+    server = smtplib.SMTP(smtp_server, smtp_port, timeout=30)
+    server.set_debuglevel(0)  # 關閉除錯模式（避免輸出過多資訊）
+    try:
+        if use_tls:
+            logger.debug("啟動 TLS...")
+            server.starttls(context=_TLS_CONTEXT)
+            if server.sock.session_reused:
+                logger.debug("已重用 TLS session")
+        
+        if smtp_username and smtp_password:
+            logger.debug("正在登入 SMTP 伺服器...")
+            server.login(smtp_username, smtp_password)
+    except Exception:
+        _quit_quietly(server)
+        raise
+    return server
+
+
+def _pool_key(smtp_server, smtp_port, smtp_username, smtp_password, use_tls) -> tuple:
+    pw_hash = hashlib.sha256((smtp_password or '').encode('utf-8')).hexdigest()
+    return (smtp_server, smtp_port, smtp_username, pw_hash, bool(use_tls))
+
+
+def _acquire_smtp(key: tuple, smtp_server: str, smtp_port: int, smtp_username: str,
+                  smtp_password: str, use_tls: bool) -> list:
+    """
+    自連線池取出一條 SMTP 連線，回傳 [連線, 已發送封數]；用完以 _release_smtp 歸還
+    閒置連線以 NOOP 確認仍可用；已斷線或達到發送上限時重新連線並登入
+    """
+    with _POOL_LOCK:
+        idle = _SMTP_POOL.get(key)
+        entry = idle.pop() if idle else None
+    if entry:
+        server, sent = entry
+        if sent < SMTP_MAX_MESSAGES_PER_CONNECTION:
+            try:
+                if server.noop()[0] == 250:
+                    logger.debug("重複使用既有 SMTP 連線")
+                    return entry
+            except (smtplib.SMTPException, OSError):
+                pass
+        _quit_quietly(server)
+    return [_open_smtp(smtp_server, smtp_port, smtp_username, smtp_password, use_tls), 0]
+
+
+def _release_smtp(key: tuple, entry: list):
+    """將連線歸還連線池（閒置連線超過上限時直接關閉）"""
+    with _POOL_LOCK:
+        idle = _SMTP_POOL.setdefault(key, [])
+        if len(idle) < SMTP_MAX_IDLE_PER_SERVER:
+            idle.append(entry)
+            return
+    _quit_quietly(entry[0])
+
+
+# 判斷內容是否為 HTML：只檢查開頭，開頭標籤一定出現在文件最前面
+_HTML_RE = re.compile(r'<(?:html|body)\b', re.IGNORECASE)
+_HTML_SNIFF_BYTES = 4096
+
+_EOL_RE = re.compile(br'(?:\r\n|\n|\r(?!\n))')
+_LEADING_DOT_RE = re.compile(br'(?m)^\.')
+
+
+def _serialize_message(msg) -> bytes:
+    """將郵件序列化為 bytes（與 send_message 相同：CRLF 換行）；每封信只做一次，重試時沿用"""
+    with io.BytesIO() as buf:
+        BytesGenerator(buf).flatten(msg, linesep='\r\n')
+        return buf.getvalue()
+
+
+def _pipelined_send(server, msg_bytes: bytes, from_addr: str, to_addrs: List[str]) -> Dict[str, tuple]:
+    """
+    以 ESMTP PIPELINING（RFC 2920）發送：MAIL FROM / RCPT TO / DATA 一次寫出，再依序讀取回應，
+    省去每個指令各等一次往返。行為與 sendmail 相同：部分收件者被拒時仍發送，回傳被拒收件者
+    """
+    commands = [f"MAIL FROM:<{from_addr}>"] + [f"RCPT TO:<{addr}>" for addr in to_addrs] + ["DATA"]
+    server.send(''.join(cmd + '\r\n' for cmd in commands).encode('ascii'))
+    
+    mail_code, mail_resp = server.getreply()
+    refused = {}
+    for addr in to_addrs:
+        code, resp = server.getreply()
+        if code not in (250, 251):
+            refused[addr] = (code, resp)
+    data_code, data_resp = server.getreply()
+    
+    if data_code == 354 and (mail_code != 250 or len(refused) == len(to_addrs)):
+        # 伺服器仍接受 DATA 時送出空內容結束本次交易
+        server.send(b'.\r\n')
+        server.getreply()
+    if mail_code != 250:
+        server.rset()
+        raise smtplib.SMTPSenderRefused(mail_code, mail_resp, from_addr)
+    if len(refused) == len(to_addrs):
+        server.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+    if data_code != 354:
+        server.rset()
+        raise smtplib.SMTPDataError(data_code, data_resp)
+    
+    # 與 sendmail 相同：統一 CRLF 換行、行首句點加倍
+    payload = _LEADING_DOT_RE.sub(b'..', _EOL_RE.sub(b'\r\n', msg_bytes))
+    if not payload.endswith(b'\r\n'):
+        payload += b'\r\n'
+    server.send(payload + b'.\r\n')
+    code, resp = server.getreply()
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+
+def close_smtp_pool():
+    """關閉連線池中所有閒置的 SMTP 連線"""
+    with _POOL_LOCK:
+        entries = [entry for idle in _SMTP_POOL.values() for entry in idle]
+        _SMTP_POOL.clear()
+    for server, _ in entries:
+        _quit_quietly(server)
+
+
+atexit.register(close_smtp_pool)
+
+
+def send_email(subject: str, body: str, to_address: Union[str, List[str]], from_address: str, 
                smtp_server: str, smtp_port: int, smtp_username: str, 
                smtp_password: str, use_tls: bool = True, attachments: List[str] = None):
     """
@@ -34,7 +295,7 @@ def send_email(subject: str, body: str, to_address: str, from_address: str,
     Args:
         subject: 主旨
         body: 內容（HTML 或純文字）
-        to_address: 收件者 Email
+        to_address: 收件者 Email（可為列表：同一封信一次交給所有收件者，內容只傳送一次；收件者彼此不可見）
         from_address: 發送者 Email
         smtp_server: SMTP 伺服器
         smtp_port: SMTP 埠口
@@ -44,8 +305,12 @@ def send_email(subject: str, body: str, to_address: str, from_address: str,
         attachments: 附件檔案路徑列表
     """
     try:
-        # 驗證必要參數
-        if not to_address:
+        # 驗證必要參數（收件者去重並保留順序）
+        to_addresses = list(dict.fromkeys(
+            [to_address] if isinstance(to_address, str) else [a for a in (to_address or []) if a]
+        ))
+        to_address = ', '.join(to_addresses)
+        if not to_addresses:
             print(f"[錯誤] 發送 Email 失敗：收件者 Email 為空", file=sys.stderr)
             return False
         
@@ -57,17 +322,17 @@ def send_email(subject: str, body: str, to_address: str, from_address: str,
             print(f"[錯誤] 發送 Email 失敗：SMTP 伺服器為空", file=sys.stderr)
             return False
         
-        print(f"[通知] 準備發送 Email 至：{to_address}")
-        print(f"[通知] SMTP 伺服器：{smtp_server}:{smtp_port}")
-        print(f"[通知] 使用 TLS：{use_tls}")
+        logger.debug("準備發送 Email 至：%s（SMTP 伺服器：%s:%s，使用 TLS：%s）",
+                     to_address, smtp_server, smtp_port, use_tls)
         
         msg = MIMEMultipart('alternative')
         msg['From'] = from_address
-        msg['To'] = to_address
+        # 多位收件者只放在 SMTP 信封（RCPT TO），標頭不列出彼此的地址
+        msg['To'] = to_addresses[0] if len(to_addresses) == 1 else 'undisclosed-recipients:;'
         msg['Subject'] = subject
         
         # 判斷是否為 HTML
-        if '<html>' in body.lower() or '<body>' in body.lower():
+        if _HTML_RE.search(body, 0, _HTML_SNIFF_BYTES):
             msg.attach(MIMEText(body, 'html', 'utf-8'))
         else:
             msg.attach(MIMEText(body, 'plain', 'utf-8'))
@@ -76,35 +341,56 @@ def send_email(subject: str, body: str, to_address: str, from_address: str,
         if attachments:
             for filepath in attachments:
                 if os.path.exists(filepath):
-                    with open(filepath, 'rb') as f:
-                        part = MIMEBase('application', 'octet-stream')
-                        part.set_payload(f.read())
-                        encoders.encode_base64(part)
-                        part.add_header(
-                            'Content-Disposition',
-                            f'attachment; filename= {os.path.basename(filepath)}'
-                        )
-                        msg.attach(part)
-                    print(f"[通知] 已添加附件：{os.path.basename(filepath)}")
-        
-        # 發送郵件
-        print(f"[通知] 正在連線 SMTP 伺服器...")
-        server = smtplib.SMTP(smtp_server, smtp_port, timeout=30)
-        server.set_debuglevel(0)  # 關閉除錯模式（避免輸出過多資訊）
-        
-        if use_tls:
-            print(f"[通知] 啟動 TLS...")
-            server.starttls()
+                    st = os.stat(filepath)
+                    part = MIMEBase('application', 'octet-stream')
+                    part.set_payload(_encoded_attachment(filepath, st.st_mtime_ns, st.st_size))
+                    part['Content-Transfer-Encoding'] = 'base64'
+                    part.add_header(
+                        'Content-Disposition',
+                        f'attachment; filename= {os.path.basename(filepath)}'
+                    )
+                    msg.attach(part)
+                    logger.debug("已添加附件：%s", os.path.basename(filepath))
         
-        if smtp_username and smtp_password:
-            print(f"[通知] 正在登入 SMTP 伺服器...")
-            server.login(smtp_username, smtp_password)
+        # 發送郵件（使用連線池中的連線，不在每封信後 QUIT）
+        key = _pool_key(smtp_server, smtp_port, smtp_username, smtp_password, use_tls)
+        # ASCII 位址直接送出預先序列化的內容；非 ASCII 位址需 SMTPUTF8，交由 send_message 處理
+        msg_bytes = _serialize_message(msg) if (from_address + to_address).isascii() else None
+        for attempt in range(SMTP_SEND_ATTEMPTS):
+            entry = _acquire_smtp(key, smtp_server, smtp_port, smtp_username, smtp_password, use_tls)
+            server = entry[0]
+            logger.debug("正在發送 Email...")
+            try:
+                server.ehlo_or_helo_if_needed()
+                if msg_bytes is None:
+                    refused = server.send_message(msg, from_addr=from_address, to_addrs=to_addresses)
+                elif server.has_extn('pipelining'):
+                    refused = _pipelined_send(server, msg_bytes, from_address, to_addresses)
+                else:
+                    refused = server.sendmail(from_address, to_addresses, msg_bytes)
+                break
+            except (smtplib.SMTPServerDisconnected, BrokenPipeError, ConnectionResetError) as e:
+                # 連線中斷：捨棄該連線，退避後以新連線重試（認證錯誤與 5xx 回應不重試）
+                _quit_quietly(server)
+                if attempt == SMTP_SEND_ATTEMPTS - 1:
+                    raise
+                delay = SMTP_RETRY_BACKOFF * 2 ** attempt
+                print(f"[警告] SMTP 連線中斷（{e}），{delay:.1f} 秒後重試...", file=sys.stderr)
+                time.sleep(delay)
+            except Exception:
+                # 發送失敗的連線狀態不明，不歸還連線池，下次重新建立
+                _quit_quietly(server)
+                raise
+        entry[1] += 1
+        # TLS 1.3 的 session ticket 於握手後才送達，完成一次發送後再記錄
+        if isinstance(server.sock, ssl.SSLSocket) and server.sock.session is not None:
+            _TLS_SESSIONS[smtp_server] = server.sock.session
+        _release_smtp(key, entry)
         
-        print(f"[通知] 正在發送 Email...")
-        server.send_message(msg)
-        server.quit()
+        if refused:
+            print(f"[警告] 以下收件者被 SMTP 伺服器拒收：{', '.join(refused)}", file=sys.stderr)
         
-        print(f"[通知] Email 已成功發送至：{to_address}")
+        logger.info("Email 已成功發送至：%s", to_address)
         return True
     
     except smtplib.SMTPAuthenticationError as e:
@@ -120,12 +406,94 @@ def send_email(subject: str, body: str, to_address: str, from_address: str,
         return False
     except Exception as e:
         print(f"[錯誤] 發送 Email 失敗：{e}", file=sys.stderr)
-        import traceback
-        traceback.print_exc()
+        logger.debug("發送 Email 失敗的詳細資訊", exc_info=True)
         return False
 
 
-def notify_critical_threat(threat_data: Dict, config: Dict):
+# 設定缺漏時共用的唯讀空字典（避免每次 .get(..., {}) 都配置新的 dict）
+_EMPTY = MappingProxyType({})
+
+
+def resolve_recipients(notification_config: Dict, kind: str,
+                       groups: Optional[Tuple[str, ...]] = None) -> List[str]:
+    """
+    依新結構（notification.types.<kind>.recipients + notification.recipients）解析收件者 Email
+    
+    Args:
+        notification_config: config['notification']
+        kind: 通知類型（critical / high_daily / weekly_report）
+        groups: 只取這些收件群組（None 表示不限）
+    
+    Returns:
+        收件者 Email 列表；類型停用或未設定時為空列表（由呼叫端回退舊結構）
+    """
+    type_cfg = notification_config.get('types', _EMPTY).get(kind, _EMPTY)
+    if not type_cfg.get('enabled', True):
+        return []
+    recipients_map = notification_config.get('recipients', _EMPTY)
+    return [
+        addr for g in type_cfg.get('recipients', ())
+        if (groups is None or g in groups) and (addr := recipients_map.get(g))
+    ]
+
+
+@dataclass(frozen=True, slots=True)
+class CriticalNotifySettings:
+    """
+    嚴重威脅通知所需的設定（批次通知前由 config 解析一次，迴圈內只處理各筆威脅資料）
+    """
+    enabled: bool
+    email_channel: bool
+    officer_emails: Tuple[str, ...]
+    from_address: str
+    smtp_server: str
+    smtp_port: int
+    smtp_username: str
+    smtp_password: str
+    use_tls: bool
+
+    @classmethod
+    def from_config(cls, config: Dict) -> 'CriticalNotifySettings':
+        notification_config = config.get('notification', {})
+        email_config = notification_config.get('email', {})
+        
+        # 新結構：critical 類型收件者
+        officer_emails = resolve_recipients(notification_config, 'critical')
+        # 回退舊結構
+        if not officer_emails:
+            fallback = email_config.get('to_address', '')
+            if fallback:
+                officer_emails = [fallback]
+        
+        return cls(
+            # 預設為 false，因為需要設定 Email
+            enabled=bool(notification_config.get('enabled', False) and email_config.get('enabled', False)),
+            email_channel=bool(notification_config.get('channels', {}).get('email', False)),
+            officer_emails=tuple(officer_emails),
+            from_address=email_config.get('from_address', ''),
+            smtp_server=email_config.get('smtp_server', ''),
+            smtp_port=email_config.get('smtp_port', 587),
+            smtp_username=email_config.get('smtp_username', ''),
+            smtp_password=email_config.get('smtp_password', ''),
+            use_tls=email_config.get('use_tls', True),
+        )
+
+    def send(self, subject: str, body: str, to_address: Union[str, List[str]]):
+        return send_email(
+            subject=subject,
+            body=body,
+            to_address=to_address,
+            from_address=self.from_address,
+            smtp_server=self.smtp_server,
+            smtp_port=self.smtp_port,
+            smtp_username=self.smtp_username,
+            smtp_password=self.smtp_password,
+            use_tls=self.use_tls
+        )
+
+
+def notify_critical_threat(threat_data: Dict, config: Dict, settings: Optional[CriticalNotifySettings] = None,
+                           ticket_cache: Optional[Dict[tuple, Dict]] = None):
     """
     工作流 1：嚴重威脅（Critical Threat）- 即時觸發
     當 risk_score > 9.0 時立即通知
@@ -133,15 +501,15 @@ def notify_critical_threat(threat_data: Dict, config: Dict):
     Args:
         threat_data: 威脅資料（包含 validated_threat, asset_data, intel_data）
         config: 設定檔
+        settings: 預先解析的通知設定（批次呼叫時傳入；為 None 時由 config 解析）
+        ticket_cache: 同一批次共用的工單快取（key 為 (intel_id, asset_id)），
+                      同一組情資與資產重複出現時沿用已生成的工單
     """
-    notification_config = config.get('notification', {})
-    
-    # 檢查通知是否啟用（預設為 false，因為需要設定 Email）
-    notification_enabled = notification_config.get('enabled', False)
-    email_config = notification_config.get('email', {})
-    email_enabled = email_config.get('enabled', False)
+    if settings is None:
+        settings = CriticalNotifySettings.from_config(config)
     
-    if not notification_enabled or not email_enabled:
+    # 檢查通知是否啟用
+    if not settings.enabled:
         print("[通知] 通知功能未啟用（請在 config.yaml 中設定 notification.enabled = true 和 notification.email.enabled = true）")
         return
     
@@ -155,102 +523,47 @@ def notify_critical_threat(threat_data: Dict, config: Dict):
     
     # 生成 IT 工單內容
     from reporting_engine import generate_it_ticket
-    ticket = generate_it_ticket(validated_threat, asset_data, intel_data, config)
+    key = (validated_threat.get('intel_id'), validated_threat.get('asset_id'))
+    ticket = ticket_cache.get(key) if ticket_cache is not None else None
+    if ticket is None:
+        ticket = generate_it_ticket(validated_threat, asset_data, intel_data, config)
+        if ticket_cache is not None:
+            # 多個執行緒同時生成時，以先寫入者為準
+            ticket = ticket_cache.setdefault(key, ticket)
     
     # 通知 IT 團隊
     owner = asset_data.get('owner', 'IT 團隊')
     # 注意：owner_email 需要從設定檔或資產清單中取得
     # 目前先使用資安官的 Email，未來可以擴充
     owner_email = asset_data.get('owner_email', None)
+    hostname = asset_data.get('hostname', 'N/A')
     
-    if owner_email and notification_config.get('channels', {}).get('email', False):
-        email_config = notification_config.get('email', {})
-        if email_config.get('enabled', False):
-            it_subject = f"[AETIM 緊急工單] {ticket['title']}"
-            it_body = f"""
-緊急資安威脅通知
-
-工單編號：{ticket['ticket_id']}
-優先級：{ticket['priority']}
-
-受影響資產：
-- 主機名稱：{asset_data.get('hostname', 'N/A')}
-- IP 位址：{asset_data.get('ip_address', 'N/A')}
-- 負責人：{owner}
-
-威脅資訊：
-- CVE ID：{intel_data.get('cve_id', 'N/A')}
-- 威脅標題：{intel_data.get('title', 'N/A')}
-- 風險分數：{risk_score} / 10.0
-- 情資來源：{intel_data.get('source', 'N/A')}
-
-建議行動：
-{ticket.get('recommendations', '請查閱相關安全公告')}
-
----
-此為自動化系統發送的通知，請勿直接回覆。
-"""
-            send_email(
-                subject=it_subject,
-                body=it_body,
-                to_address=owner_email,
-                from_address=email_config.get('from_address', ''),
-                smtp_server=email_config.get('smtp_server', ''),
-                smtp_port=email_config.get('smtp_port', 587),
-                smtp_username=email_config.get('smtp_username', ''),
-                smtp_password=email_config.get('smtp_password', ''),
-                use_tls=email_config.get('use_tls', True)
-            )
+    # 兩份範本共用的欄位
+    fields = {
+        'ticket_id': ticket['ticket_id'],
+        'priority': ticket['priority'],
+        'hostname': hostname,
+        'ip_address': asset_data.get('ip_address', 'N/A'),
+        'owner': owner,
+        'cve_id': intel_data.get('cve_id', 'N/A'),
+        'risk_score': risk_score,
+    }
+    
+    if owner_email and settings.email_channel:
+        it_subject = f"[AETIM 緊急工單] {ticket['title']}"
+        it_body = _CRIT_IT_TPL.substitute(
+            fields,
+            title=intel_data.get('title', 'N/A'),
+            source=intel_data.get('source', 'N/A'),
+            recommendations=ticket.get('recommendations', '請查閱相關安全公告'),
+        )
+        settings.send(it_subject, it_body, owner_email)
     
     # 通知資安官
-    email_config = notification_config.get('email', {})
-    if email_config.get('enabled', False):
-        # 新結構：critical 類型收件者
-        target_emails = []
-        types_cfg = notification_config.get('types', {})
-        crit_cfg = types_cfg.get('critical', {})
-        if crit_cfg.get('enabled', True):
-            rec_groups = crit_cfg.get('recipients', [])
-            recipients_map = notification_config.get('recipients', {})
-            for g in rec_groups:
-                addr = recipients_map.get(g)
-                if addr:
-                    target_emails.append(addr)
-        # 回退舊結構
-        if not target_emails:
-            fallback = email_config.get('to_address', '')
-            if fallback:
-                target_emails = [fallback]
-        for security_officer_email in target_emails:
-            subject = f"[AETIM 緊急警報] 發現嚴重威脅 (Risk: {risk_score}) - 影響 {asset_data.get('hostname', 'N/A')}"
-            body = f"""
-緊急資安威脅警報
-
-系統偵測到嚴重威脅，已自動建立工單並通知 IT 團隊。
-
-威脅摘要：
-- CVE ID：{intel_data.get('cve_id', 'N/A')}
-- 受影響主機：{asset_data.get('hostname', 'N/A')} ({asset_data.get('ip_address', 'N/A')})
-- 風險分數：{risk_score} / 10.0
-- 負責人：{owner}
-
-工單編號：{ticket['ticket_id']}
-優先級：{ticket['priority']}
-
----
-此為自動化系統發送的通知，請勿直接回覆。
-"""
-            send_email(
-                subject=subject,
-                body=body,
-                to_address=security_officer_email,
-                from_address=email_config.get('from_address', ''),
-                smtp_server=email_config.get('smtp_server', ''),
-                smtp_port=email_config.get('smtp_port', 587),
-                smtp_username=email_config.get('smtp_username', ''),
-                smtp_password=email_config.get('smtp_password', ''),
-                use_tls=email_config.get('use_tls', True)
-            )
+    if settings.officer_emails:
+        subject = f"[AETIM 緊急警報] 發現嚴重威脅 (Risk: {risk_score}) - 影響 {hostname}"
+        body = _CRIT_OFFICER_TPL.substitute(fields)
+        settings.send(subject, body, list(settings.officer_emails))
 
 
 def notify_high_risk_daily_summary(db_conn, config):
@@ -272,22 +585,19 @@ def notify_high_risk_daily_summary(db_conn, config):
     critical_threshold = thresholds.get('critical', 9.0)
     
     # 查詢過去 24 小時內的高風險威脅
-    from datetime import timedelta
     end_date = datetime.now()
     start_date = end_date - timedelta(hours=24)
     
-    import pandas as pd
+    ensure_validated_threat_indexes(db_conn)
+    # 只取摘要需要的欄位，直接以 cursor 讀取（不建立 DataFrame）；COUNT(*) OVER () 取得 LIMIT 前的總數
     query = """
         SELECT 
-            vt.id,
-            vt.risk_score,
-            vt.status,
             ri.cve_id,
-            ri.title,
-            ri.source,
             a.hostname,
             a.ip_address,
-            a.owner
+            vt.risk_score,
+            ri.source,
+            COUNT(*) OVER () AS total
         FROM T_Validated_Threats vt
         JOIN T_Raw_Intel ri ON vt.intel_id = ri.id
         JOIN T_Assets a ON vt.asset_id = a.id
@@ -296,65 +606,61 @@ def notify_high_risk_daily_summary(db_conn, config):
           AND vt.risk_score <= ?
           AND vt.status = 'new'
         ORDER BY vt.risk_score DESC
+        LIMIT ?
     """
     
-    df_high_risk = pd.read_sql_query(query, db_conn, params=(
-        start_date.isoformat(), high_threshold, critical_threshold
-    ))
+    rows = db_conn.execute(query, (
+        start_date.isoformat(), high_threshold, critical_threshold, DAILY_SUMMARY_MAX_ROWS
+    )).fetchall()
     
-    if len(df_high_risk) == 0:
+    if not rows:
         print("[通知] 過去 24 小時內無高風險威脅，跳過每日摘要。")
         return
     
-    print(f"\n[通知] 生成高風險威脅每日摘要（{len(df_high_risk)} 筆）")
+    total_count = rows[0][-1]
+    print(f"\n[通知] 生成高風險威脅每日摘要（{total_count} 筆）")
     
     email_config = notification_config.get('email', {})
     if email_config.get('enabled', False):
         # 依新結構決定收件者
-        target_emails = []
-        types_cfg = notification_config.get('types', {})
-        high_cfg = types_cfg.get('high_daily', {})
-        if high_cfg.get('enabled', True):
-            rec_groups = high_cfg.get('recipients', [])
-            recipients_map = notification_config.get('recipients', {})
-            for g in rec_groups:
-                addr = recipients_map.get(g)
-                if addr:
-                    target_emails.append(addr)
+        target_emails = resolve_recipients(notification_config, 'high_daily')
         # 相容處理
         if not target_emails:
             to_address = email_config.get('to_address', '')
             if to_address:
                 target_emails = [to_address]
-        for to_address in target_emails:
+        if target_emails:
             subject = f"[AETIM 每日威脅摘要] {get_taipei_time().strftime('%Y-%m-%d')}"
             
-            # 生成摘要內容
-            body = f"""
+            # 生成摘要內容（各段收集後一次 join，避免迴圈內字串累加）
+            body_parts = [f"""
 高風險威脅每日摘要
 
 報告期間：{start_date.strftime('%Y-%m-%d %H:%M')} 至 {end_date.strftime('%Y-%m-%d %H:%M')}
-威脅數量：{len(df_high_risk)} 筆
+威脅數量：{total_count} 筆
 
 威脅清單：
-"""
-            for _, row in df_high_risk.iterrows():
-                body += f"""
-- CVE: {row['cve_id'] or 'N/A'}
-  主機：{row['hostname']} ({row['ip_address']})
-  風險分數：{row['risk_score']:.2f}
-  來源：{row['source']}
-"""
+"""]
+            for cve_id, hostname, ip_address, risk_score, source, _ in rows:
+                body_parts.append(f"""
+- CVE: {cve_id or 'N/A'}
+  主機：{hostname} ({ip_address})
+  風險分數：{risk_score:.2f}
+  來源：{source}
+""")
+            if total_count > len(rows):
+                body_parts.append(f"\n... 還有 {total_count - len(rows)} 筆，請至系統查看。\n")
             
-            body += """
+            body_parts.append("""
 ---
 此為自動化系統發送的通知，請勿直接回覆。
-"""
+""")
+            body = ''.join(body_parts)
             
             send_email(
                 subject=subject,
                 body=body,
-                to_address=to_address,
+                to_address=target_emails,
                 from_address=email_config.get('from_address', ''),
                 smtp_server=email_config.get('smtp_server', ''),
                 smtp_port=email_config.get('smtp_port', 587),
@@ -389,18 +695,21 @@ def notify_weekly_report(report_filepath: str, config: Dict, target_email: str =
     # 或者 notification.enabled 為 True 且 email.enabled 為 True
     is_enabled = email_enabled or (notification_enabled and email_enabled)
     
-    # 添加詳細的日誌輸出
-    print(f"[通知] 通知設定檢查：")
-    print(f"  - notification.enabled：{notification_enabled}")
-    print(f"  - email.enabled：{email_enabled}")
-    print(f"  - 通知功能啟用狀態：{is_enabled}")
-    print(f"[通知] Email 設定檢查：")
-    print(f"  - SMTP 伺服器：{email_config.get('smtp_server', 'N/A')}")
-    print(f"  - SMTP 埠口：{email_config.get('smtp_port', 'N/A')}")
-    print(f"  - SMTP 使用者名稱：{email_config.get('smtp_username', 'N/A')}")
-    print(f"  - 發送者 Email：{email_config.get('from_address', 'N/A')}")
-    print(f"  - 收件者 Email：{email_config.get('to_address', 'N/A')}")
-    print(f"  - 使用 TLS：{email_config.get('use_tls', True)}")
+    # 詳細的設定檢查輸出（僅於 DEBUG 等級時組字串）
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            f"通知設定檢查：\n"
+            f"  - notification.enabled：{notification_enabled}\n"
+            f"  - email.enabled：{email_enabled}\n"
+            f"  - 通知功能啟用狀態：{is_enabled}\n"
+            f"Email 設定檢查：\n"
+            f"  - SMTP 伺服器：{email_config.get('smtp_server', 'N/A')}\n"
+            f"  - SMTP 埠口：{email_config.get('smtp_port', 'N/A')}\n"
+            f"  - SMTP 使用者名稱：{email_config.get('smtp_username', 'N/A')}\n"
+            f"  - 發送者 Email：{email_config.get('from_address', 'N/A')}\n"
+            f"  - 收件者 Email：{email_config.get('to_address', 'N/A')}\n"
+            f"  - 使用 TLS：{email_config.get('use_tls', True)}"
+        )
     
     # 如果 email.enabled 為 True，就繼續執行（即使 notification.enabled 為 False）
     if not email_enabled:
@@ -413,16 +722,7 @@ def notify_weekly_report(report_filepath: str, config: Dict, target_email: str =
         target_emails = [target_email]
     else:
         # 否則從設定檔讀取（新結構 recipients + types.weekly_report）
-        target_emails = []
-        types_cfg = notification_config.get('types', {})
-        weekly_cfg = types_cfg.get('weekly_report', {})
-        if weekly_cfg.get('enabled', True):
-            rec_groups = weekly_cfg.get('recipients', [])
-            recipients_map = notification_config.get('recipients', {})
-            for g in rec_groups:
-                addr = recipients_map.get(g)
-                if addr:
-                    target_emails.append(addr)
+        target_emails = resolve_recipients(notification_config, 'weekly_report')
         # 相容舊結構：回退 to_address
         if not target_emails:
             to_address = email_config.get('to_address', '')
@@ -465,24 +765,24 @@ def notify_weekly_report(report_filepath: str, config: Dict, target_email: str =
         body = "本週資安情資週報已生成，請查看系統報告目錄。"
         print(f"[通知] 警告：報告檔案不存在，使用預設內容。")
     
-    for to_address in target_emails:
-        print(f"[通知] 正在發送 Email 至：{to_address}")
-        result = send_email(
-            subject=subject,
-            body=body,
-            to_address=to_address,
-            from_address=from_address,
-            smtp_server=smtp_server,
-            smtp_port=smtp_port,
-            smtp_username=smtp_username,
-            smtp_password=smtp_password,
-            use_tls=email_config.get('use_tls', True),
-            attachments=attachments
-        )
-        if result:
-            print(f"[通知] 週報 Email 已成功發送至：{to_address}")
-        else:
-            print(f"[通知] 週報 Email 發送失敗：{to_address}")
+    recipients_text = ', '.join(target_emails)
+    print(f"[通知] 正在發送 Email 至：{recipients_text}")
+    result = send_email(
+        subject=subject,
+        body=body,
+        to_address=target_emails,
+        from_address=from_address,
+        smtp_server=smtp_server,
+        smtp_port=smtp_port,
+        smtp_username=smtp_username,
+        smtp_password=smtp_password,
+        use_tls=email_config.get('use_tls', True),
+        attachments=attachments
+    )
+    if result:
+        print(f"[通知] 週報 Email 已成功發送至：{recipients_text}")
+    else:
+        print(f"[通知] 週報 Email 發送失敗：{recipients_text}")
 
 
 def notify_it_tickets(report_filepath: str, config: Dict, target_email: str = None):
@@ -510,18 +810,8 @@ def notify_it_tickets(report_filepath: str, config: Dict, target_email: str = No
     if target_email:
         target_emails = [target_email]
     else:
-        # 從設定檔讀取 IT 收件者
-        target_emails = []
-        types_cfg = notification_config.get('types', {})
-        weekly_cfg = types_cfg.get('weekly_report', {})
-        if weekly_cfg.get('enabled', True):
-            rec_groups = weekly_cfg.get('recipients', [])
-            recipients_map = notification_config.get('recipients', {})
-            for g in rec_groups:
-                if g == 'it':  # 只發送給 IT
-                    addr = recipients_map.get(g)
-                    if addr:
-                        target_emails.append(addr)
+        # 從設定檔讀取 IT 收件者（週報收件群組中只發送給 IT）
+        target_emails = resolve_recipients(notification_config, 'weekly_report', groups=('it',))
         # 相容舊結構
         if not target_emails:
             it_email = email_config.get('it_email', '')
@@ -599,24 +889,24 @@ def notify_it_tickets(report_filepath: str, config: Dict, target_email: str = No
         return
     
     # 發送 Email
-    for to_address in target_emails:
-        print(f"[通知] 正在發送 IT 工單報告至：{to_address}")
-        result = send_email(
-            subject=subject,
-            body=body,
-            to_address=to_address,
-            from_address=from_address,
-            smtp_server=smtp_server,
-            smtp_port=smtp_port,
-            smtp_username=smtp_username,
-            smtp_password=smtp_password,
-            use_tls=email_config.get('use_tls', True),
-            attachments=attachments
-        )
-        if result:
-            print(f"[通知] IT 工單報告 Email 已成功發送至：{to_address}")
-        else:
-            print(f"[通知] IT 工單報告 Email 發送失敗：{to_address}")
+    recipients_text = ', '.join(target_emails)
+    print(f"[通知] 正在發送 IT 工單報告至：{recipients_text}")
+    result = send_email(
+        subject=subject,
+        body=body,
+        to_address=target_emails,
+        from_address=from_address,
+        smtp_server=smtp_server,
+        smtp_port=smtp_port,
+        smtp_username=smtp_username,
+        smtp_password=smtp_password,
+        use_tls=email_config.get('use_tls', True),
+        attachments=attachments
+    )
+    if result:
+        print(f"[通知] IT 工單報告 Email 已成功發送至：{recipients_text}")
+    else:
+        print(f"[通知] IT 工單報告 Email 發送失敗：{recipients_text}")
 
 
 def check_and_notify_critical_threats(db_conn, config):
@@ -632,7 +922,7 @@ def check_and_notify_critical_threats(db_conn, config):
     thresholds = notification_config.get('thresholds', {})
     critical_threshold = thresholds.get('critical', 9.0)
     
-    import pandas as pd
+    ensure_validated_threat_indexes(db_conn)
     query = """
         SELECT 
             vt.id,
@@ -656,20 +946,30 @@ def check_and_notify_critical_threats(db_conn, config):
         JOIN T_Assets a ON vt.asset_id = a.id
         WHERE vt.risk_score > ?
           AND vt.status = 'new'
-          AND vt.timestamp >= datetime('now', '-1 hour')
+          AND vt.timestamp >= ?
         ORDER BY vt.risk_score DESC
     """
     
-    df_critical = pd.read_sql_query(query, db_conn, params=(critical_threshold,))
+    # 時間下限於 Python 端計算後綁定（與 CURRENT_TIMESTAMP 相同：UTC、'YYYY-MM-DD HH:MM:SS'），
+    # SQL 文字固定，可命中 sqlite3 的 statement cache
+    cutoff = (datetime.now(timezone.utc) - timedelta(hours=1)).strftime('%Y-%m-%d %H:%M:%S')
+    # 以 cursor 直接讀取（不需為此載入 pandas）
+    cursor = db_conn.cursor()
+    cursor.row_factory = sqlite3.Row
+    rows = cursor.execute(query, (critical_threshold, cutoff)).fetchall()
     
-    if len(df_critical) == 0:
+    if not rows:
         return
     
-    print(f"\n[通知] 發現 {len(df_critical)} 筆嚴重威脅，開始發送通知...")
+    print(f"\n[通知] 發現 {len(rows)} 筆嚴重威脅，開始發送通知...")
+    settings = CriticalNotifySettings.from_config(config)
     
-    for _, row in df_critical.iterrows():
+    threats = []
+    for row in rows:
         validated_threat = {
             'id': row['id'],
+            'intel_id': row['intel_id'],
+            'asset_id': row['asset_id'],
             'risk_score': row['risk_score'],
             'status': row['status']
         }
@@ -691,19 +991,34 @@ def check_and_notify_critical_threats(db_conn, config):
             'raw_data': row['raw_data']
         }
         
-        threat_data = {
+        threats.append({
             'validated_threat': validated_threat,
             'asset_data': asset_data,
             'intel_data': intel_data
+        })
+    
+    # 本次檢查共用的工單快取：同一組 (intel_id, asset_id) 只生成一次工單
+    ticket_cache: Dict[tuple, Dict] = {}
+    
+    # 各筆威脅的通知主要在等待網路，交給執行緒池同時發送（SMTP 連線由連線池分配給各執行緒）
+    with ThreadPoolExecutor(max_workers=min(NOTIFY_WORKERS, len(threats))) as executor:
+        futures = {
+            executor.submit(notify_critical_threat, threat_data, config, settings, ticket_cache): threat_data
+            for threat_data in threats
         }
-        
-        notify_critical_threat(threat_data, config)
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                threat_id = futures[future]['validated_threat']['id']
+                print(f"[錯誤] 發送嚴重威脅通知失敗（威脅 ID {threat_id}）：{e}", file=sys.stderr)
 
 
 if __name__ == "__main__":
     """測試通知功能"""
-    from utils import get_db_connection
+    from utils import get_db_connection, configure_logging
     
+    configure_logging()
     config = load_config()
     db_conn = get_db_connection()
     
@@ -711,4 +1026,5 @@ if __name__ == "__main__":
         try:
             check_and_notify_critical_threats(db_conn, config)
         finally:
+            close_smtp_pool()
             db_conn.close()
@@ -10,221 +10,40 @@ import sys
 import os
 import json
 import sqlite3
-import pandas as pd
+import hashlib
+import threading
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
-from typing import List, Dict, Optional
-from jinja2 import Template, Environment, FileSystemLoader
-from utils import get_db_connection, load_config
+from dataclasses import dataclass
+from typing import List, Dict, Optional, Tuple
+from jinja2 import Environment
+from utils import get_db_connection, load_config, ensure_validated_threat_indexes
 
-# 設定時區為 Asia/Taipei
-TAIPEI_TZ = ZoneInfo('Asia/Taipei')
-
-def get_taipei_time():
-    """取得 Asia/Taipei 時區的當前時間"""
-    return datetime.now(TAIPEI_TZ)
+try:
+    from openai import OpenAI
+except ImportError:
+    OpenAI = None
 
+try:
+    import orjson  # 選用：加速 JSON 報告序列化
 
-def generate_ai_summary(threats_data: List[Dict], config: Dict) -> Optional[str]:
-    """
-    使用 AI 生成威脅摘要（150 字內）
-    
-    Args:
-        threats_data: 威脅資料列表
-        config: 設定檔
-    
-    Returns:
-        AI 生成的摘要文字，如果 AI 無法使用則返回 None
-    """
-    # 安全處理 None 值：先取得值，如果不是 None 才調用 strip()
-    openai_key_raw = config['api_keys'].get('openai')
-    openai_key = str(openai_key_raw).strip() if openai_key_raw is not None else ''
-    
-    if not openai_key or openai_key == '${OPENAI_API_KEY}' or openai_key == 'YOUR_OPENAI_API_KEY_HERE' or openai_key == 'None':
-        print("[AI 摘要] OpenAI API 金鑰未設定，跳過 AI 摘要生成。")
-        return None
-    
-    try:
-        from openai import OpenAI
-        client = OpenAI(api_key=openai_key)
-        
-        # 準備威脅摘要資料
-        threats_summary = []
-        for threat in threats_data[:10]:  # 最多處理前 10 筆
-            threats_summary.append({
-                'cve_id': threat.get('cve_id', 'N/A'),
-                'title': threat.get('title', 'N/A')[:100],
-                'risk_score': threat.get('risk_score', 0),
-                'hostname': threat.get('hostname', 'N/A')
-            })
-        
-        prompt = f"""你是一位企業資安諮詢顧問。請用 150 字內的繁體中文，總結以下威脅對本公司（一家擁有對外文件倉儲系統的公司）的潛在業務衝擊，並建議本週的管理層應關注的焦點。
-
-威脅列表：
-{json.dumps(threats_summary, ensure_ascii=False, indent=2)}
+    def _json_bytes(obj, compact: bool = True) -> bytes:
+        option = orjson.OPT_NON_STR_KEYS | (0 if compact else orjson.OPT_INDENT_2)
+        return orjson.dumps(obj, default=str, option=option)
+except ImportError:
+    def _json_bytes(obj, compact: bool = True) -> bytes:
+        if compact:
+            return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8')
+        return json.dumps(obj, ensure_ascii=False, indent=2, default=str).encode('utf-8')
 
-請以專業、簡潔的方式回應，重點強調業務風險和行動建議。"""
-        
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",  # 使用較便宜的模型
-            messages=[
-                {"role": "system", "content": "你是一位資安顧問，專精於將技術威脅轉化為業務風險描述。"},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=200,
-            temperature=0.7
-        )
-        
-        summary = response.choices[0].message.content.strip()
-        print(f"[AI 摘要] 成功生成摘要（{len(summary)} 字）")
-        return summary
-    
-    except ImportError:
-        print("[AI 摘要] openai 套件未安裝，跳過 AI 摘要生成。")
-        return None
-    except Exception as e:
-        print(f"[AI 摘要] 生成摘要時發生錯誤：{e}")
-        return None
-
-
-def generate_ciso_weekly_report(db_conn, config, days: int = 7) -> Dict:
-    """
-    生成 CISO 威脅情資週報（管理層）
-    
-    Args:
-        db_conn: 資料庫連線
-        config: 設定檔
-        days: 報告涵蓋天數（預設 7 天）
-    
-    Returns:
-        報告資料字典
-    """
-    print(f"\n[報告生成] 開始生成 CISO 週報（過去 {days} 天）...")
-    
-    # 計算日期範圍（使用 Asia/Taipei 時區）
-    end_date = get_taipei_time()
-    start_date = end_date - timedelta(days=days)
-    
-    # 查詢高風險以上的威脅（過去 7 天）
-    query = """
-        SELECT 
-            vt.id,
-            vt.intel_id,
-            vt.asset_id,
-            vt.risk_score,
-            vt.status,
-            vt.timestamp,
-            ri.cve_id,
-            ri.title,
-            ri.source,
-            ri.cvss_score,
-            a.hostname,
-            a.ip_address,
-            a.is_public,
-            a.business_criticality,
-            a.owner
-        FROM T_Validated_Threats vt
-        JOIN T_Raw_Intel ri ON vt.intel_id = ri.id
-        JOIN T_Assets a ON vt.asset_id = a.id
-        WHERE vt.timestamp >= ? 
-          AND vt.risk_score >= 4.0
-        ORDER BY vt.risk_score DESC
-    """
-    
-    df_threats = pd.read_sql_query(query, db_conn, params=(start_date.isoformat(),))
-    
-    # 分類威脅
-    critical_threats = df_threats[df_threats['risk_score'] >= 9.0].to_dict('records')
-    high_threats = df_threats[(df_threats['risk_score'] >= 7.0) & (df_threats['risk_score'] < 9.0)].to_dict('records')
-    medium_threats = df_threats[(df_threats['risk_score'] >= 4.0) & (df_threats['risk_score'] < 7.0)].to_dict('records')
-    
-    # 統計資料
-    stats = {
-        'total_threats': len(df_threats),
-        'critical_count': len(critical_threats),
-        'high_count': len(high_threats),
-        'medium_count': len(medium_threats),
-        'remediated_count': len(df_threats[df_threats['status'] == 'remediated']),
-        'new_count': len(df_threats[df_threats['status'] == 'new']),
-        'date_range': {
-            'start': start_date.strftime('%Y-%m-%d'),
-            'end': end_date.strftime('%Y-%m-%d')
-        }
-    }
-    
-    # Top 5 曝險最嚴重的資產
-    asset_risk_query = """
-        SELECT 
-            a.id,
-            a.hostname,
-            a.ip_address,
-            a.business_criticality,
-            COUNT(vt.id) as threat_count,
-            AVG(vt.risk_score) as avg_risk_score,
-            MAX(vt.risk_score) as max_risk_score
-        FROM T_Assets a
-        JOIN T_Validated_Threats vt ON a.id = vt.asset_id
-        WHERE vt.timestamp >= ?
-        GROUP BY a.id
-        ORDER BY max_risk_score DESC, threat_count DESC
-        LIMIT 5
-    """
-    
-    df_top_assets = pd.read_sql_query(asset_risk_query, db_conn, params=(start_date.isoformat(),))
-    top_assets = df_top_assets.to_dict('records')
-    
-    # 未關閉的嚴重威脅（上週）
-    unresolved_critical = [t for t in critical_threats if t['status'] != 'remediated']
-    
-    # 準備 AI 摘要資料（前 10 筆高風險威脅）
-    ai_summary_data = (critical_threats[:5] + high_threats[:5])[:10]
-    
-    # 生成 AI 摘要（如果啟用）
-    ai_summary = None
-    reporting_config = config.get('reporting', {})
-    if reporting_config.get('templates', {}).get('ciso_weekly', {}).get('include_ai_summary', False):
-        ai_summary = generate_ai_summary(ai_summary_data, config)
-    
-    report_data = {
-        'report_type': 'CISO Weekly Report',
-        'generated_at': get_taipei_time().strftime('%Y-%m-%d %H:%M:%S'),
-        'stats': stats,
-        'threats': {
-            'critical': critical_threats[:10],  # Top 10
-            'high': high_threats[:10],
-            'medium': medium_threats[:5]
-        },
-        'top_assets': top_assets,
-        'unresolved_critical': unresolved_critical[:5],
-        'ai_summary': ai_summary
-    }
-    
-    print(f"[報告生成] CISO 週報資料準備完成：{stats['total_threats']} 筆威脅")
-    return report_data
+# 設定時區為 Asia/Taipei
+TAIPEI_TZ = ZoneInfo('Asia/Taipei')
 
+# 內建 HTML 報告模板（模組載入時編譯一次，渲染時只執行編譯後的模板）
+# autoescape 明確設為 False，與原本 jinja2.Template(...) 的預設一致，輸出內容不變
+_JINJA_ENV = Environment(autoescape=False, auto_reload=False)
 
-def render_html_report(report_data: Dict, template_name: str = 'ciso_weekly.html') -> str:
-    """
-    使用 Jinja2 渲染 HTML 報告
-    
-    Args:
-        report_data: 報告資料
-        template_name: 模板檔名
-    
-    Returns:
-        HTML 字串
-    """
-    # 創建模板環境
-    template_dir = os.path.join(os.path.dirname(__file__), 'templates')
-    
-    # 如果模板目錄不存在，使用內建模板
-    if not os.path.exists(template_dir):
-        os.makedirs(template_dir, exist_ok=True)
-        # 這裡可以創建預設模板，但目前我們使用字串模板
-    
-    # 使用簡單的字串模板（未來可以改用檔案模板）
-    if template_name == 'ciso_weekly.html':
-        html_template = """
+_CISO_WEEKLY_HTML = """
 <!DOCTYPE html>
 <html lang="zh-TW">
 <head>
@@ -362,15 +181,483 @@ def render_html_report(report_data: Dict, template_name: str = 'ciso_weekly.html
     </div>
 </body>
 </html>
-        """
+"""
+
+# 期間內沒有任何威脅時使用的精簡週報（不需渲染空的表格）
+_CISO_WEEKLY_EMPTY_HTML = """
+<!DOCTYPE html>
+<html lang="zh-TW">
+<head>
+    <meta charset="UTF-8">
+    <title>{{ report_type }} - {{ generated_at }}</title>
+</head>
+<body style="font-family: 'Microsoft JhengHei', Arial, sans-serif; margin: 20px;">
+    <h1>{{ report_type }}</h1>
+    <p><strong>生成時間：</strong>{{ generated_at }}</p>
+    <p><strong>報告期間：</strong>{{ stats.date_range.start }} 至 {{ stats.date_range.end }}</p>
+    <p>本期間內無任何威脅。</p>
+</body>
+</html>
+"""
+
+_HTML_TEMPLATES = {
+    'ciso_weekly.html': _JINJA_ENV.from_string(_CISO_WEEKLY_HTML),
+}
+_CISO_WEEKLY_EMPTY_TEMPLATE = _JINJA_ENV.from_string(_CISO_WEEKLY_EMPTY_HTML)
+
+# 串流寫檔時每次累積的渲染片段數
+HTML_STREAM_BUFFER_SIZE = 64
+
+
+# OpenAI client 依 API 金鑰重複使用（沿用同一個 HTTP 連線池，避免每次重新握手）
+_OPENAI_CLIENTS: Dict[str, 'OpenAI'] = {}
+_OPENAI_LOCK = threading.Lock()
+
+# AI 摘要使用的模型與系統提示
+AI_SUMMARY_MODEL = "gpt-4o-mini"  # 使用較便宜的模型
+AI_SUMMARY_SYSTEM_PROMPT = "你是一位資安顧問，專精於將技術威脅轉化為業務風險描述。"
+
+# AI 摘要快取：模型、提示與威脅清單皆相同時沿用上次的摘要（記憶體 + 檔案，跨執行保留）
+AI_SUMMARY_CACHE_FILE = os.path.join(os.path.dirname(__file__), 'reports', '.ai_cache', 'summaries.json')
+AI_SUMMARY_CACHE_MAX = 64
+_AI_SUMMARY_CACHE: Optional[Dict[str, str]] = None
+
+# CISO 週報各風險分類列出的威脅筆數，以及未解決嚴重威脅的筆數
+CISO_TOP_THREATS = {'critical': 10, 'high': 10, 'medium': 5}
+CISO_TOP_UNRESOLVED = 5
+
+# 週報合併查詢中，威脅列與 Top 資產列各自使用的欄位
+_THREAT_COLUMNS = (
+    'id', 'intel_id', 'asset_id', 'risk_score', 'status', 'timestamp',
+    'cve_id', 'title', 'source', 'cvss_score',
+    'hostname', 'ip_address', 'is_public', 'business_criticality', 'owner',
+)
+_TOP_ASSET_COLUMNS = (
+    'id', 'hostname', 'ip_address', 'business_criticality',
+    'threat_count', 'avg_risk_score', 'max_risk_score',
+)
+
+# 本次執行已建立（或確認存在）的輸出目錄，同一目錄只呼叫一次 os.makedirs
+_KNOWN_DIRS = set()
+
+# 視為「未設定」的 OpenAI API 金鑰（空值、未展開的環境變數、範例佔位字串）
+_INVALID_OPENAI_KEYS = frozenset({'', '${OPENAI_API_KEY}', 'YOUR_OPENAI_API_KEY_HERE', 'None', 'null'})
+
+# AI 摘要 prompt 中威脅標題的最大長度，以及不送出的空值
+AI_SUMMARY_TITLE_MAX = 80
+_EMPTY_PROMPT_VALUES = (None, '', 'N/A', 0)
+
+
+# IT 工單文字報告模板
+_RULE, _SUBRULE = "=" * 80, "-" * 80
+_IT_TICKET_TEXT_TEMPLATE = f"""{_RULE}
+IT 維運工單 (IT Operational Ticket)
+{_RULE}
+
+工單編號：{{ticket_id}}
+優先級：{{priority}}
+標題：{{title}}
+建立時間：{{created_at}}
+
+{_SUBRULE}
+受影響資產 (Affected Asset)
+{_SUBRULE}
+主機名稱：{{hostname}}
+IP 地址：{{ip_address}}
+負責人：{{owner}}
+
+{_SUBRULE}
+威脅資訊 (Threat Information)
+{_SUBRULE}
+CVE ID：{{cve_id}}
+威脅標題：{{threat_title}}
+風險分數：{{risk_score}}
+威脅來源：{{source}}
+{{cvss_line}}
+{_SUBRULE}
+修補建議 (Recommendations)
+{_SUBRULE}
+{{recommendations}}
+
+{_RULE}
+報告結束
+{_RULE}
+"""
+
+
+# 修補建議規則：(條件(cve_id, source, os_version, applications), 建議文字)，依序比對並串接
+_RECOMMENDATION_RULES = (
+    (lambda cve_id, source, os_version, applications: bool(cve_id),
+     ("1. 查閱 CVE 詳細資訊：https://nvd.nist.gov/vuln/detail/{cve_id}",)),
+    (lambda cve_id, source, os_version, applications: source == 'CISA_KEV',
+     ("2. 此漏洞已被 CISA 列入已知遭利用漏洞列表，建議立即修補",
+      "3. 參考 CISA KEV Catalog：https://www.cisa.gov/known-exploited-vulnerabilities-catalog")),
+    (lambda cve_id, source, os_version, applications: 'Windows' in os_version,
+     ("4. 檢查 Windows Update 是否有相關安全性更新",
+      "5. 參考 Microsoft Security Response Center (MSRC) 公告")),
+    (lambda cve_id, source, os_version, applications: 'VMware' in applications or 'VMware' in os_version,
+     ("4. 參考 VMware Security Advisories (VMSA)",
+      "5. 檢查 VMware 支援頁面是否有修補程式")),
+)
+
+_DEFAULT_RECOMMENDATIONS = (
+    "1. 請查閱相關廠商的安全公告",
+    "2. 聯絡資產負責人進行威脅評估",
+    "3. 考慮實施臨時緩解措施",
+)
+
+
+@dataclass(frozen=True, slots=True)
+class CisoReportSettings:
+    """
+    CISO 週報設定（reporting.templates.ciso_weekly；由 config 解析一次，之後以屬性存取）
+    """
+    enabled: bool
+    formats: Tuple[str, ...]
+    include_ai_summary: bool
+
+    @classmethod
+    def from_config(cls, config: Dict) -> 'CisoReportSettings':
+        ciso_cfg = (config.get('reporting') or {}).get('templates', {}).get('ciso_weekly', {})
+        formats = ciso_cfg.get('format', ['html'])
+        if isinstance(formats, str):
+            formats = [formats]
+        return cls(
+            enabled=bool(ciso_cfg.get('enabled', True)),
+            formats=tuple(formats),
+            include_ai_summary=bool(ciso_cfg.get('include_ai_summary', False)),
+        )
+
+
+def get_taipei_time():
+    """取得 Asia/Taipei 時區的當前時間"""
+    return datetime.now(TAIPEI_TZ)
+
+
+def _ensure_dir(path: str):
+    if path in _KNOWN_DIRS:
+        return
+    os.makedirs(path, exist_ok=True)
+    _KNOWN_DIRS.add(path)
+
+
+def _get_openai_client(api_key: str):
+    """取得（必要時建立）對應 API 金鑰的 OpenAI client"""
+    with _OPENAI_LOCK:
+        client = _OPENAI_CLIENTS.get(api_key)
+        if client is None:
+            client = _OPENAI_CLIENTS[api_key] = OpenAI(api_key=api_key)
+        return client
+
+
+def _load_ai_summary_cache() -> Dict[str, str]:
+    """載入 AI 摘要快取檔（只在第一次使用時讀檔）"""
+    global _AI_SUMMARY_CACHE
+    if _AI_SUMMARY_CACHE is None:
+        try:
+            with open(AI_SUMMARY_CACHE_FILE, 'r', encoding='utf-8') as f:
+                _AI_SUMMARY_CACHE = json.load(f)
+        except (OSError, ValueError):
+            _AI_SUMMARY_CACHE = {}
+    return _AI_SUMMARY_CACHE
+
+
+def _store_ai_summary(digest: str, summary: str):
+    """寫入 AI 摘要快取（超過上限時移除最舊的項目）"""
+    cache = _load_ai_summary_cache()
+    cache.pop(digest, None)
+    cache[digest] = summary
+    while len(cache) > AI_SUMMARY_CACHE_MAX:
+        del cache[next(iter(cache))]
+    try:
+        _ensure_dir(os.path.dirname(AI_SUMMARY_CACHE_FILE))
+        with open(AI_SUMMARY_CACHE_FILE, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, ensure_ascii=False)
+    except OSError as e:
+        print(f"[AI 摘要] 無法寫入摘要快取：{e}")
+
+
+def generate_ai_summary(threats_data: List[Dict], config: Dict) -> Optional[str]:
+    """
+    使用 AI 生成威脅摘要（150 字內）
+    
+    Args:
+        threats_data: 威脅資料列表
+        config: 設定檔
+    
+    Returns:
+        AI 生成的摘要文字，如果 AI 無法使用則返回 None
+    """
+    # 安全處理 None 值：先取得值，如果不是 None 才調用 strip()
+    openai_key_raw = config['api_keys'].get('openai')
+    openai_key = str(openai_key_raw).strip() if openai_key_raw is not None else ''
+    
+    if openai_key in _INVALID_OPENAI_KEYS:
+        print("[AI 摘要] OpenAI API 金鑰未設定，跳過 AI 摘要生成。")
+        return None
+    
+    if OpenAI is None:
+        print("[AI 摘要] openai 套件未安裝，跳過 AI 摘要生成。")
+        return None
+    
+    try:
+        # 準備威脅摘要資料（省略空值欄位，以精簡 JSON 送出，減少 prompt token 數）
+        threats_summary = []
+        for threat in threats_data[:10]:  # 最多處理前 10 筆
+            row = {
+                'cve_id': threat.get('cve_id'),
+                'title': (threat.get('title') or '')[:AI_SUMMARY_TITLE_MAX],
+                'risk_score': threat.get('risk_score'),
+                'hostname': threat.get('hostname')
+            }
+            threats_summary.append({k: v for k, v in row.items() if v not in _EMPTY_PROMPT_VALUES})
+        payload = json.dumps(threats_summary, ensure_ascii=False, separators=(',', ':'), default=str)
+        
+        prompt = f"""你是一位企業資安諮詢顧問。請用 150 字內的繁體中文，總結以下威脅對本公司（一家擁有對外文件倉儲系統的公司）的潛在業務衝擊，並建議本週的管理層應關注的焦點。
+
+威脅列表：
+{payload}
+
+請以專業、簡潔的方式回應，重點強調業務風險和行動建議。"""
+        messages = [
+            {"role": "system", "content": AI_SUMMARY_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ]
+        
+        # 模型與完整提示（含威脅清單）皆與上次相同時直接沿用摘要，不再呼叫 API；
+        # 調整模型或提示文字會產生不同的快取鍵，不會誤用舊摘要
+        cache_key = json.dumps([AI_SUMMARY_MODEL, messages], ensure_ascii=False, separators=(',', ':'))
+        digest = hashlib.blake2b(cache_key.encode('utf-8'), digest_size=16).hexdigest()
+        cached = _load_ai_summary_cache().get(digest)
+        if cached:
+            print(f"[AI 摘要] 模型與威脅清單未變更，使用快取摘要（{len(cached)} 字）")
+            return cached
+        
+        client = _get_openai_client(openai_key)
+        response = client.chat.completions.create(
+            model=AI_SUMMARY_MODEL,
+            messages=messages,
+            max_tokens=200,
+            temperature=0.7
+        )
         
-        template = Template(html_template)
-        return template.render(**report_data)
+        summary = response.choices[0].message.content.strip()
+        print(f"[AI 摘要] 成功生成摘要（{len(summary)} 字）")
+        _store_ai_summary(digest, summary)
+        return summary
+    
+    except Exception as e:
+        print(f"[AI 摘要] 生成摘要時發生錯誤：{e}")
+        return None
+
+
+def generate_ciso_weekly_report(db_conn, config, days: int = 7,
+                                settings: Optional[CisoReportSettings] = None) -> Dict:
+    """
+    生成 CISO 威脅情資週報（管理層）
+    
+    Args:
+        db_conn: 資料庫連線
+        config: 設定檔
+        days: 報告涵蓋天數（預設 7 天）
+        settings: 預先解析的週報設定（為 None 時由 config 解析）
+    
+    Returns:
+        報告資料字典
+    """
+    print(f"\n[報告生成] 開始生成 CISO 週報（過去 {days} 天）...")
+    
+    # 計算日期範圍（使用 Asia/Taipei 時區）
+    end_date = get_taipei_time()
+    start_date = end_date - timedelta(days=days)
+    
+    # 各分類只取報告會列出的筆數（LIMIT 於 SQL 端完成），以 kind 區分：
+    # - 'asset'：Top 5 曝險最嚴重的資產（期間內所有威脅）
+    # - 'critical' / 'high' / 'medium'：各風險分類前幾筆威脅（risk_score >= 4.0）
+    # - 'unresolved'：未修復的嚴重威脅
+    # week 只取 id 與排序欄位；選出的少數威脅再回頭 JOIN 取完整欄位
+    query = """
+        WITH week AS (
+            SELECT vt.id, vt.risk_score, vt.status
+            FROM T_Validated_Threats vt
+            JOIN T_Raw_Intel ri ON vt.intel_id = ri.id
+            JOIN T_Assets a ON vt.asset_id = a.id
+            WHERE vt.timestamp >= :start 
+              AND vt.risk_score >= 4.0
+        ),
+        picked AS (
+            SELECT * FROM (
+                SELECT 'critical' AS kind, id FROM week
+                WHERE risk_score >= 9.0 ORDER BY risk_score DESC LIMIT :critical
+            )
+            UNION ALL
+            SELECT * FROM (
+                SELECT 'high', id FROM week
+                WHERE risk_score >= 7.0 AND risk_score < 9.0 ORDER BY risk_score DESC LIMIT :high
+            )
+            UNION ALL
+            SELECT * FROM (
+                SELECT 'medium', id FROM week
+                WHERE risk_score < 7.0 ORDER BY risk_score DESC LIMIT :medium
+            )
+            UNION ALL
+            SELECT * FROM (
+                SELECT 'unresolved', id FROM week
+                WHERE risk_score >= 9.0 AND status != 'remediated' ORDER BY risk_score DESC LIMIT :unresolved
+            )
+        ),
+        top_assets AS (
+            SELECT 
+                a.id,
+                a.hostname,
+                a.ip_address,
+                a.business_criticality,
+                COUNT(vt.id) as threat_count,
+                AVG(vt.risk_score) as avg_risk_score,
+                MAX(vt.risk_score) as max_risk_score
+            FROM T_Assets a
+            JOIN T_Validated_Threats vt ON a.id = vt.asset_id
+            WHERE vt.timestamp >= :start
+            GROUP BY a.id
+            ORDER BY max_risk_score DESC, threat_count DESC
+            LIMIT 5
+        )
+        SELECT 
+            'asset' AS kind,
+            id, NULL AS intel_id, NULL AS asset_id, NULL AS risk_score, NULL AS status, NULL AS timestamp,
+            NULL AS cve_id, NULL AS title, NULL AS source, NULL AS cvss_score,
+            hostname, ip_address, NULL AS is_public, business_criticality, NULL AS owner,
+            threat_count, avg_risk_score, max_risk_score
+        FROM top_assets
+        UNION ALL
+        SELECT 
+            p.kind,
+            vt.id,
+            vt.intel_id,
+            vt.asset_id,
+            vt.risk_score,
+            vt.status,
+            vt.timestamp,
+            ri.cve_id,
+            ri.title,
+            ri.source,
+            ri.cvss_score,
+            a.hostname,
+            a.ip_address,
+            a.is_public,
+            a.business_criticality,
+            a.owner,
+            NULL, NULL, NULL
+        FROM picked p
+        JOIN T_Validated_Threats vt ON vt.id = p.id
+        JOIN T_Raw_Intel ri ON vt.intel_id = ri.id
+        JOIN T_Assets a ON vt.asset_id = a.id
+        ORDER BY kind, max_risk_score DESC, threat_count DESC, risk_score DESC
+    """
+    
+    # 各分類筆數與狀態統計（只回傳一列彙總值）
+    stats_query = """
+        SELECT 
+            COUNT(*) AS total_threats,
+            COALESCE(SUM(vt.risk_score >= 9.0), 0) AS critical_count,
+            COALESCE(SUM(vt.risk_score >= 7.0 AND vt.risk_score < 9.0), 0) AS high_count,
+            COALESCE(SUM(vt.risk_score < 7.0), 0) AS medium_count,
+            COALESCE(SUM(vt.status = 'remediated'), 0) AS remediated_count,
+            COALESCE(SUM(vt.status = 'new'), 0) AS new_count
+        FROM T_Validated_Threats vt
+        JOIN T_Raw_Intel ri ON vt.intel_id = ri.id
+        JOIN T_Assets a ON vt.asset_id = a.id
+        WHERE vt.timestamp >= ? 
+          AND vt.risk_score >= 4.0
+    """
+    
+    ensure_validated_threat_indexes(db_conn)
+    cursor = db_conn.cursor()
+    cursor.row_factory = sqlite3.Row
+    
+    params = dict(CISO_TOP_THREATS, start=start_date.isoformat(), unresolved=CISO_TOP_UNRESOLVED)
+    top_assets = []
+    top_threats = {'critical': [], 'high': [], 'medium': []}
+    unresolved_critical = []
+    for r in cursor.execute(query, params):
+        kind = r['kind']
+        if kind == 'asset':
+            top_assets.append({k: r[k] for k in _TOP_ASSET_COLUMNS})
+        elif kind == 'unresolved':
+            unresolved_critical.append({k: r[k] for k in _THREAT_COLUMNS})
+        else:
+            top_threats[kind].append({k: r[k] for k in _THREAT_COLUMNS})
+    critical_threats, high_threats = top_threats['critical'], top_threats['high']
+    
+    counts = cursor.execute(stats_query, (start_date.isoformat(),)).fetchone()
+    
+    # 統計資料
+    stats = {
+        'total_threats': counts['total_threats'],
+        'critical_count': counts['critical_count'],
+        'high_count': counts['high_count'],
+        'medium_count': counts['medium_count'],
+        'remediated_count': counts['remediated_count'],
+        'new_count': counts['new_count'],
+        'date_range': {
+            'start': start_date.strftime('%Y-%m-%d'),
+            'end': end_date.strftime('%Y-%m-%d')
+        }
+    }
+    
+    # 準備 AI 摘要資料（前 10 筆高風險威脅）
+    ai_summary_data = (critical_threats[:5] + high_threats[:5])[:10]
     
-    return ""
+    # 生成 AI 摘要（如果啟用）
+    ai_summary = None
+    if settings is None:
+        settings = CisoReportSettings.from_config(config)
+    # 沒有高風險以上的威脅時不呼叫 AI（無內容可摘要）
+    if ai_summary_data and settings.include_ai_summary:
+        ai_summary = generate_ai_summary(ai_summary_data, config)
+    
+    report_data = {
+        'report_type': 'CISO Weekly Report',
+        'generated_at': get_taipei_time().strftime('%Y-%m-%d %H:%M:%S'),
+        'stats': stats,
+        'threats': top_threats,
+        'top_assets': top_assets,
+        'unresolved_critical': unresolved_critical,
+        'ai_summary': ai_summary
+    }
+    
+    print(f"[報告生成] CISO 週報資料準備完成：{stats['total_threats']} 筆威脅")
+    return report_data
+
+
+def _get_html_template(report_data: Dict, template_name: str):
+    """依模板檔名取得已編譯模板；週報期間內沒有任何威脅時改用精簡模板"""
+    if (template_name == 'ciso_weekly.html'
+            and report_data.get('stats', {}).get('total_threats') == 0
+            and not report_data.get('top_assets')):
+        return _CISO_WEEKLY_EMPTY_TEMPLATE
+    return _HTML_TEMPLATES.get(template_name)
+
+
+def render_html_report(report_data: Dict, template_name: str = 'ciso_weekly.html') -> str:
+    """
+    使用 Jinja2 渲染 HTML 報告
+    
+    Args:
+        report_data: 報告資料
+        template_name: 模板檔名
+    
+    Returns:
+        HTML 字串（未知的模板名稱回傳空字串）
+    """
+    template = _get_html_template(report_data, template_name)
+    if template is None:
+        return ""
+    return template.render(**report_data)
 
 
-def generate_it_ticket(validated_threat: Dict, asset_data: Dict, intel_data: Dict, config: Dict) -> Dict:
+def generate_it_ticket(validated_threat: Dict, asset_data: Dict, intel_data: Dict, config: Dict,
+                       now: Optional[datetime] = None) -> Dict:
     """
     生成 IT 維運工單（技術層）
     
@@ -379,12 +666,15 @@ def generate_it_ticket(validated_threat: Dict, asset_data: Dict, intel_data: Dic
         asset_data: 資產資料
         intel_data: 情資資料
         config: 設定檔
+        now: 工單建立時間（批次生成時傳入同一時間；為 None 時取目前時間）
     
     Returns:
         工單資料字典（可用於 Email、JSON 等格式）
     """
+    if now is None:
+        now = get_taipei_time()
     ticket_data = {
-        'ticket_id': f"AETIM-{validated_threat['id']}-{get_taipei_time().strftime('%Y%m%d%H%M%S')}",
+        'ticket_id': f"AETIM-{validated_threat['id']}-{now.strftime('%Y%m%d%H%M%S')}",
         'priority': 'P0' if validated_threat['risk_score'] >= 9.0 else 'P1',
         'title': f"資安威脅：{intel_data.get('cve_id', 'N/A')} - {asset_data.get('hostname', 'N/A')}",
         'affected_asset': {
@@ -400,7 +690,7 @@ def generate_it_ticket(validated_threat: Dict, asset_data: Dict, intel_data: Dic
             'cvss_score': intel_data.get('cvss_score', 'N/A')
         },
         'recommendations': generate_recommendations(intel_data, asset_data),
-        'created_at': get_taipei_time().isoformat()
+        'created_at': now.isoformat()
     }
     
     return ticket_data
@@ -419,33 +709,43 @@ def generate_recommendations(intel_data: Dict, asset_data: Dict) -> str:
     """
     cve_id = intel_data.get('cve_id', '')
     source = intel_data.get('source', '')
+    os_version = str(asset_data.get('os_version', ''))
+    applications = str(asset_data.get('applications', ''))
     
     recommendations = []
-    
-    if cve_id:
-        recommendations.append(f"1. 查閱 CVE 詳細資訊：https://nvd.nist.gov/vuln/detail/{cve_id}")
-    
-    if source == 'CISA_KEV':
-        recommendations.append("2. 此漏洞已被 CISA 列入已知遭利用漏洞列表，建議立即修補")
-        recommendations.append("3. 參考 CISA KEV Catalog：https://www.cisa.gov/known-exploited-vulnerabilities-catalog")
-    
-    if 'Windows' in str(asset_data.get('os_version', '')):
-        recommendations.append("4. 檢查 Windows Update 是否有相關安全性更新")
-        recommendations.append("5. 參考 Microsoft Security Response Center (MSRC) 公告")
-    
-    if 'VMware' in str(asset_data.get('applications', '')) or 'VMware' in str(asset_data.get('os_version', '')):
-        recommendations.append("4. 參考 VMware Security Advisories (VMSA)")
-        recommendations.append("5. 檢查 VMware 支援頁面是否有修補程式")
+    for matches, lines in _RECOMMENDATION_RULES:
+        if matches(cve_id, source, os_version, applications):
+            recommendations.extend(line.format(cve_id=cve_id) for line in lines)
     
     if not recommendations:
-        recommendations.append("1. 請查閱相關廠商的安全公告")
-        recommendations.append("2. 聯絡資產負責人進行威脅評估")
-        recommendations.append("3. 考慮實施臨時緩解措施")
+        recommendations.extend(_DEFAULT_RECOMMENDATIONS)
     
     return "\n".join(recommendations)
 
 
-def save_report(report_data: Dict, report_type: str, format: str = 'html') -> Optional[str]:
+def _format_it_ticket_text(ticket: Dict) -> str:
+    """將單張 IT 工單格式化為文字報告（以模板一次組出，不逐段累加字串）"""
+    asset = ticket.get('affected_asset', {})
+    threat = ticket.get('threat', {})
+    cvss_score = threat.get('cvss_score')
+    return _IT_TICKET_TEXT_TEMPLATE.format(
+        ticket_id=ticket.get('ticket_id', 'N/A'),
+        priority=ticket.get('priority', 'N/A'),
+        title=ticket.get('title', 'N/A'),
+        created_at=ticket.get('created_at', 'N/A'),
+        hostname=asset.get('hostname', 'N/A'),
+        ip_address=asset.get('ip_address', 'N/A'),
+        owner=asset.get('owner', 'N/A'),
+        cve_id=threat.get('cve_id', 'N/A'),
+        threat_title=threat.get('title', 'N/A'),
+        risk_score=threat.get('risk_score', 'N/A'),
+        source=threat.get('source', 'N/A'),
+        cvss_line=f"CVSS 分數：{cvss_score}\n" if cvss_score else '',
+        recommendations=ticket.get('recommendations', 'N/A'),
+    )
+
+
+def save_report(report_data: Dict, report_type: str, format: str = 'html', compact: bool = True) -> Optional[str]:
     """
     儲存報告到檔案
     報告將按照年月目錄結構儲存：reports/yyyy/yyyymm/
@@ -454,6 +754,7 @@ def save_report(report_data: Dict, report_type: str, format: str = 'html') -> Op
         report_data: 報告資料
         report_type: 報告類型（'ciso_weekly' 或 'it_ticket'）
         format: 格式（'html', 'text', 'json'）
+        compact: JSON 是否以精簡格式輸出（供程式讀取；需人工閱讀時設為 False 以縮排輸出）
     
     Returns:
         檔案路徑，如果失敗則返回 None
@@ -467,7 +768,7 @@ def save_report(report_data: Dict, report_type: str, format: str = 'html') -> Op
         # 建立年月目錄結構：reports/yyyy/yyyymm/
         base_dir = os.path.join(os.path.dirname(__file__), 'reports')
         output_dir = os.path.join(base_dir, year, year_month)
-        os.makedirs(output_dir, exist_ok=True)
+        _ensure_dir(output_dir)
         
         # 生成檔名（使用 Asia/Taipei 時區的時間戳記）
         timestamp = now.strftime('%Y%m%d_%H%M%S')
@@ -475,55 +776,22 @@ def save_report(report_data: Dict, report_type: str, format: str = 'html') -> Op
         filepath = os.path.join(output_dir, filename)
         
         if format == 'html':
-            content = render_html_report(report_data, f"{report_type}.html")
+            template = _get_html_template(report_data, f"{report_type}.html")
             with open(filepath, 'w', encoding='utf-8') as f:
-                f.write(content)
+                if template is not None:
+                    # 逐段渲染並直接寫入檔案，不在記憶體中組出完整 HTML
+                    stream = template.stream(**report_data)
+                    stream.enable_buffering(HTML_STREAM_BUFFER_SIZE)
+                    stream.dump(f)
         
         elif format == 'json':
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(report_data, f, ensure_ascii=False, indent=2)
+            with open(filepath, 'wb') as f:
+                f.write(_json_bytes(report_data, compact))
         
         elif format == 'text':
             # 文字格式：針對 IT 工單進行格式化
             if report_type == 'it_ticket':
-                content = "=" * 80 + "\n"
-                content += "IT 維運工單 (IT Operational Ticket)\n"
-                content += "=" * 80 + "\n\n"
-                
-                content += f"工單編號：{report_data.get('ticket_id', 'N/A')}\n"
-                content += f"優先級：{report_data.get('priority', 'N/A')}\n"
-                content += f"標題：{report_data.get('title', 'N/A')}\n"
-                content += f"建立時間：{report_data.get('created_at', 'N/A')}\n\n"
-                
-                content += "-" * 80 + "\n"
-                content += "受影響資產 (Affected Asset)\n"
-                content += "-" * 80 + "\n"
-                asset = report_data.get('affected_asset', {})
-                content += f"主機名稱：{asset.get('hostname', 'N/A')}\n"
-                content += f"IP 地址：{asset.get('ip_address', 'N/A')}\n"
-                content += f"負責人：{asset.get('owner', 'N/A')}\n\n"
-                
-                content += "-" * 80 + "\n"
-                content += "威脅資訊 (Threat Information)\n"
-                content += "-" * 80 + "\n"
-                threat = report_data.get('threat', {})
-                content += f"CVE ID：{threat.get('cve_id', 'N/A')}\n"
-                content += f"威脅標題：{threat.get('title', 'N/A')}\n"
-                content += f"風險分數：{threat.get('risk_score', 'N/A')}\n"
-                content += f"威脅來源：{threat.get('source', 'N/A')}\n"
-                if threat.get('cvss_score'):
-                    content += f"CVSS 分數：{threat.get('cvss_score', 'N/A')}\n"
-                content += "\n"
-                
-                content += "-" * 80 + "\n"
-                content += "修補建議 (Recommendations)\n"
-                content += "-" * 80 + "\n"
-                recommendations = report_data.get('recommendations', 'N/A')
-                content += recommendations + "\n\n"
-                
-                content += "=" * 80 + "\n"
-                content += "報告結束\n"
-                content += "=" * 80 + "\n"
+                content = _format_it_ticket_text(report_data)
             else:
                 # 其他報告類型的文字格式
                 content = f"{report_data.get('report_type', 'Report')}\n"
@@ -541,6 +809,26 @@ def save_report(report_data: Dict, report_type: str, format: str = 'html') -> Op
         return None
 
 
+def save_tickets_batch(tickets: List[Dict], format: str = 'json') -> Optional[str]:
+    """
+    將一批 IT 工單彙總為單一報告檔案（一次開檔寫入，而非每張工單各存一個檔案）
+    
+    Args:
+        tickets: generate_it_tickets_for_high_risk 產生的工單列表
+        format: 格式（預設 'json'，notify_it_tickets 讀取此格式）
+    
+    Returns:
+        檔案路徑，如果失敗則返回 None
+    """
+    summary = {
+        'report_type': 'IT Weekly Tickets Summary',
+        'generated_at': datetime.now().isoformat(),
+        'total_tickets': len(tickets),
+        'tickets': tickets
+    }
+    return save_report(summary, 'it_ticket', format)
+
+
 def generate_weekly_report(db_conn, config):
     """
     生成週報主函數
@@ -550,16 +838,12 @@ def generate_weekly_report(db_conn, config):
     print("=" * 60)
     
     try:
-        report_data = generate_ciso_weekly_report(db_conn, config, days=7)
+        settings = CisoReportSettings.from_config(config)
+        report_data = generate_ciso_weekly_report(db_conn, config, days=7, settings=settings)
         
         # 儲存報告
-        reporting_config = config.get('reporting', {})
-        templates_config = reporting_config.get('templates', {}).get('ciso_weekly', {})
-        
-        if templates_config.get('enabled', True):
-            formats = templates_config.get('format', ['html'])
-            
-            for fmt in formats:
+        if settings.enabled:
+            for fmt in settings.formats:
                 if fmt == 'html':
                     save_report(report_data, 'ciso_weekly', 'html')
                 elif fmt == 'pdf':
@@ -617,10 +901,14 @@ def generate_it_tickets_for_high_risk(db_conn, config, risk_threshold: float = 7
         ORDER BY vt.risk_score DESC
     """
     
-    df_high_risk = pd.read_sql_query(query, db_conn, params=(risk_threshold,))
+    ensure_validated_threat_indexes(db_conn)
+    cursor = db_conn.cursor()
+    cursor.row_factory = sqlite3.Row
     
+    # 同一批工單使用相同的建立時間
+    now = get_taipei_time()
     tickets = []
-    for _, row in df_high_risk.iterrows():
+    for row in cursor.execute(query, (risk_threshold,)):
         validated_threat = {
             'id': row['id'],
             'risk_score': row['risk_score'],
@@ -643,7 +931,7 @@ def generate_it_tickets_for_high_risk(db_conn, config, risk_threshold: float = 7
             'raw_data': row['raw_data']
         }
         
-        ticket = generate_it_ticket(validated_threat, asset_data, intel_data, config)
+        ticket = generate_it_ticket(validated_threat, asset_data, intel_data, config, now=now)
         tickets.append(ticket)
     
     print(f"[報告生成] 生成 {len(tickets)} 個 IT 工單")
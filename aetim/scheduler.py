@@ -1,20 +1,43 @@
-import time
 import sys
 import os
+import re
 import signal
+import logging
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from zoneinfo import ZoneInfo
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 from apscheduler.triggers.cron import CronTrigger
-from utils import get_db_connection, load_config
+from utils import acquire_db_connection, release_db_connection, load_config, configure_logging, RateLimitFilter, ensure_raw_intel_indexes, WEEKDAY_MAP
 import collectors
-from job_events import start_event, update_event
+import correlation_engine
+import reporting_engine
+import notification_handler
+from job_events import start_event, EventRecorder
+
+# 任務例外經由 logging 輸出：堆疊僅在 handler 實際輸出時才格式化；handler 與限流於 __main__ 設定
+logger = logging.getLogger('aetim.scheduler')
 
 # 全域變數：用於信號處理
 scheduler_instance = None
+# 排程與診斷輸出固定使用台北時區（只建構一次）
+TAIPEI_TZ = ZoneInfo("Asia/Taipei")
+# 主執行緒等待此事件；停止信號（SIGTERM/SIGINT）設定後即結束服務
+stop_event = threading.Event()
+# 最近一次套用的週報排程設定 (enabled, day, hour, minute)
+_LAST_WEEKLY_SIG = None
 SCHEDULER_PID_FILE = os.path.join(os.path.dirname(__file__), 'scheduler.pid')
 
-VALID_DAYS = {'mon','tue','wed','thu','fri','sat','sun'}
+VALID_DAYS = frozenset(WEEKDAY_MAP)
+# 舊版字串排程（如 "monday 08:00"、"Mon 8:00"）；星期取前三字即為縮寫
+_LEGACY_SCHEDULE_RE = re.compile(
+    r'^(mon(?:day)?|tue(?:sday)?|wed(?:nesday)?|thu(?:rsday)?|fri(?:day)?|sat(?:urday)?|sun(?:day)?)'
+    r'\s+([01]?\d|2[0-3]):([0-5]?\d)$',
+    re.IGNORECASE
+)
 
 def get_weekly_schedule_from_config(config):
     """
@@ -36,25 +59,9 @@ def get_weekly_schedule_from_config(config):
         # 向後相容：嘗試解析舊字串 "monday 08:00"
         legacy = weekly.get('schedule')
         if isinstance(legacy, str):
-            parts = legacy.strip().split()
-            if len(parts) == 2:
-                day_map = {
-                    'monday':'mon','tuesday':'tue','wednesday':'wed',
-                    'thursday':'thu','friday':'fri','saturday':'sat','sunday':'sun',
-                    'mon':'mon','tue':'tue','wed':'wed','thu':'thu','fri':'fri','sat':'sat','sun':'sun'
-                }
-                d = day_map.get(parts[0].lower())
-                if d:
-                    hm = parts[1]
-                    if ':' in hm:
-                        try:
-                            h, m = hm.split(':')
-                            h = int(h)
-                            m = int(m)
-                            if 0 <= h <= 23 and 0 <= m <= 59:
-                                return d, h, m
-                        except Exception:
-                            pass
+            m = _LEGACY_SCHEDULE_RE.match(legacy.strip())
+            if m:
+                return m.group(1)[:3].lower(), int(m.group(2)), int(m.group(3))
         # 預設值
         return 'mon', 8, 0
     except Exception:
@@ -69,6 +76,14 @@ def reschedule_weekly_report(scheduler):
         reporting = config.get('reporting', {})
         weekly = reporting.get('weekly_report', {})
         enabled = weekly.get('enabled', False)
+        day, hour, minute = get_weekly_schedule_from_config(config)
+
+        # 設定與上次套用的相同且排程狀態一致時，不重新註冊任務
+        global _LAST_WEEKLY_SIG
+        sig = (enabled, day, hour, minute)
+        if sig == _LAST_WEEKLY_SIG and (not enabled or scheduler.get_job("job_weekly_report")):
+            print("--- 週報排程：設定未變更，維持現有排程 ---")
+            return
 
         # 先移除既有 job（若存在）
         try:
@@ -77,23 +92,21 @@ def reschedule_weekly_report(scheduler):
             pass
 
         if not enabled:
+            _LAST_WEEKLY_SIG = sig
             print("--- 週報排程：未啟用（enabled=false），不建立 weekly job ---")
             return
 
-        # 取得新設定
-        day, hour, minute = get_weekly_schedule_from_config(config)
-
         def generate_weekly_report_job():
             """週報生成任務"""
             db_conn = None
-            ev = None
+            rec = None
             try:
-                from zoneinfo import ZoneInfo
-                taipei_tz = ZoneInfo("Asia/Taipei")
-                trigger_time = datetime.now(taipei_tz)
+                trigger_time = datetime.now(TAIPEI_TZ)
                 print(f"\n[{trigger_time.strftime('%Y-%m-%d %H:%M:%S %Z')}] --- 觸發週報生成任務 ---")
                 print(f"[週報] 排程觸發時間：{trigger_time.isoformat()}")
                 ev = start_event({'phase': 'scheduled', 'message': '週報排程已觸發'})
+                # 短暫的階段更新先累積於記憶體；生成報告與發送通知等耗時階段開始時立即寫入，最終結果於 finally 寫入
+                rec = EventRecorder(ev['id'])
                 cfg = load_config()
                 
                 # 檢查週報通知是否啟用
@@ -104,71 +117,65 @@ def reschedule_weekly_report(scheduler):
                 email_enabled = notification_config.get('email', {}).get('enabled', False)
                 
                 if not weekly_enabled:
-                    update_event(ev['id'], {
-                        'phase': 'done',
-                        'status': 'skipped',
-                        'message': '週報通知未啟用（notification.types.weekly_report.enabled = false）'
-                    })
+                    rec.phase(
+                        'done',
+                        '週報通知未啟用（notification.types.weekly_report.enabled = false）',
+                        status='skipped'
+                    )
                     print("[週報] 週報通知未啟用，跳過執行")
                     return
                 
                 if not email_enabled:
-                    update_event(ev['id'], {
-                        'phase': 'done',
-                        'status': 'skipped',
-                        'message': 'Email 通知未啟用（notification.email.enabled = false）'
-                    })
+                    rec.phase(
+                        'done',
+                        'Email 通知未啟用（notification.email.enabled = false）',
+                        status='skipped'
+                    )
                     print("[週報] Email 通知未啟用，跳過執行")
                     return
                 
-                db_conn = get_db_connection()
+                db_conn = acquire_db_connection()
                 if not db_conn:
-                    update_event(ev['id'], {
-                        'phase': 'done',
-                        'status': 'error',
-                        'message': '無法獲取資料庫連線'
-                    })
+                    rec.phase(
+                        'done',
+                        '無法獲取資料庫連線',
+                        status='error'
+                    )
                     print("[週報] 錯誤：無法獲取資料庫連線")
                     return
                 
-                update_event(ev['id'], {'phase': 'collect', 'message': '開始收集/分析/報告'})
+                rec.phase('collect', '開始收集/分析/報告')
                 # 這裡假設收集與分析已由排程主流程執行；週報任務聚焦於報告+通知
-                import reporting_engine
-                import notification_handler
                 
                 # 先取得收件者列表和類型（用於決定生成哪種報告）
                 rec_groups = weekly_cfg.get('recipients', [])
                 recipients_map = notification_config.get('recipients', {})
-                target_emails = []
-                recipient_types = {}  # {email: ['ciso', 'it']}
+                recipient_types = defaultdict(set)  # {email: {'ciso', 'it'}}，依設定順序、每個地址一筆
                 
                 for g in rec_groups:
                     addr = recipients_map.get(g)
                     if addr:
-                        target_emails.append(addr)
-                        if addr not in recipient_types:
-                            recipient_types[addr] = []
-                        recipient_types[addr].append(g)
+                        recipient_types[addr].add(g)
                 
                 # 相容舊結構
-                if not target_emails:
+                if not recipient_types:
                     to_addr = notification_config.get('email', {}).get('to_address', '')
                     if to_addr:
-                        target_emails = [to_addr]
-                        recipient_types[to_addr] = ['ciso']  # 預設為 CISO
+                        recipient_types[to_addr].add('ciso')  # 預設為 CISO
                 
+                target_emails = list(recipient_types)
                 if not target_emails:
-                    update_event(ev['id'], {
-                        'phase': 'done',
-                        'status': 'error',
-                        'message': '沒有指定收件者'
-                    })
+                    rec.phase(
+                        'done',
+                        '沒有指定收件者',
+                        status='error'
+                    )
                     print("[週報] 錯誤：沒有指定收件者")
                     return
                 
                 # 決定需要生成哪些報告
-                needs_ciso_report = any('ciso' in recipient_types.get(addr, []) for addr in target_emails)
-                needs_it_tickets = any('it' in recipient_types.get(addr, []) for addr in target_emails)
+                needs_ciso_report = any('ciso' in types for types in recipient_types.values())
+                needs_it_tickets = any('it' in types for types in recipient_types.values())
                 
                 print(f"[週報] 報告需求：CISO週報={needs_ciso_report}, IT工單={needs_it_tickets}")
                 print(f"[週報] 收件者：{', '.join(target_emails)}")
@@ -176,7 +183,7 @@ def reschedule_weekly_report(scheduler):
                 # 生成 CISO 週報（如果需要）
                 ciso_report_filepath = None
                 if needs_ciso_report:
-                    update_event(ev['id'], {'phase': 'report', 'message': '生成 CISO 週報'})
+                    rec.phase('report', '生成 CISO 週報', flush=True)
                     report_data = reporting_engine.generate_weekly_report(db_conn, cfg)
                     if report_data:
                         ciso_report_filepath = reporting_engine.save_report(
@@ -193,23 +200,13 @@ def reschedule_weekly_report(scheduler):
                 it_tickets = []
                 it_report_filepath = None
                 if needs_it_tickets:
-                    update_event(ev['id'], {'phase': 'report', 'message': '生成 IT 工單'})
+                    rec.phase('report', '生成 IT 工單', flush=True)
                     # 生成高風險威脅的 IT 工單（風險分數 >= 7.0）
                     it_tickets = reporting_engine.generate_it_tickets_for_high_risk(db_conn, cfg, risk_threshold=7.0)
                     if it_tickets:
                         print(f"[週報] 已生成 {len(it_tickets)} 個 IT 工單")
                         # 將 IT 工單彙總為一個報告檔案（JSON 格式）
-                        import json
-                        from datetime import datetime
-                        it_report_data = {
-                            'report_type': 'IT Weekly Tickets Summary',
-                            'generated_at': datetime.now().isoformat(),
-                            'total_tickets': len(it_tickets),
-                            'tickets': it_tickets
-                        }
-                        it_report_filepath = reporting_engine.save_report(
-                            it_report_data, 'it_ticket', 'json'
-                        )
+                        it_report_filepath = reporting_engine.save_tickets_batch(it_tickets, 'json')
                         if it_report_filepath:
                             print(f"[週報] IT 工單報告已生成：{it_report_filepath}")
                         else:
@@ -224,18 +221,17 @@ def reschedule_weekly_report(scheduler):
                 if it_report_filepath:
                     report_filepaths.append(it_report_filepath)
                 if report_filepaths:
-                    update_event(ev['id'], {'report_filepath': '; '.join(report_filepaths)})
+                    rec.update(report_filepath='; '.join(report_filepaths))
                 
                 # 發送通知
-                update_event(ev['id'], {'phase': 'notify', 'message': '開始發送週報通知'})
+                rec.phase('notify', '開始發送週報通知', flush=True)
                 
                 try:
                     # 根據收件者類型發送對應的報告
                     success_count = 0
                     error_messages = []
                     
-                    for addr in target_emails:
-                        addr_types = recipient_types.get(addr, [])
+                    for addr, addr_types in recipient_types.items():
                         try:
                             # 決定發送哪些報告
                             send_ciso = 'ciso' in addr_types and ciso_report_filepath
@@ -260,51 +256,46 @@ def reschedule_weekly_report(scheduler):
                             print(f"[週報] {error_msg}", file=sys.stderr)
                     
                     if success_count > 0:
-                        update_event(ev['id'], {
-                            'phase': 'done',
-                            'status': 'success',
-                            'message': f'週報生成並已寄出（{success_count} 封）',
-                            'recipients': target_emails,
-                            'email_result': 'success' if not error_messages else 'partial'
-                        })
+                        rec.phase(
+                            'done',
+                            f'週報生成並已寄出（{success_count} 封）',
+                            status='success',
+                            recipients=target_emails,
+                            email_result='success' if not error_messages else 'partial'
+                        )
                         print(f"[週報] 週報已成功發送至：{', '.join(target_emails)}")
                     else:
-                        update_event(ev['id'], {
-                            'phase': 'done',
-                            'status': 'error',
-                            'message': '所有發送均失敗：' + '; '.join(error_messages) if error_messages else '無報告可發送',
-                            'recipients': target_emails,
-                            'email_result': 'error'
-                        })
+                        rec.phase(
+                            'done',
+                            '所有發送均失敗：' + '; '.join(error_messages) if error_messages else '無報告可發送',
+                            status='error',
+                            recipients=target_emails,
+                            email_result='error'
+                        )
                         print(f"[週報] 所有發送均失敗", file=sys.stderr)
                         
                 except Exception as ne:
                     error_msg = str(ne)
-                    update_event(ev['id'], {
-                        'phase': 'done',
-                        'status': 'error',
-                        'message': f'通知失敗：{error_msg}',
-                        'recipients': target_emails,
-                        'email_result': 'error'
-                    })
+                    rec.phase(
+                        'done',
+                        f'通知失敗：{error_msg}',
+                        status='error',
+                        recipients=target_emails,
+                        email_result='error'
+                    )
                     print(f"[週報] 通知失敗：{error_msg}", file=sys.stderr)
             except Exception as e:
                 error_msg = str(e)
-                print(f"週報生成任務發生錯誤：{error_msg}", file=sys.stderr)
-                import traceback
-                traceback.print_exc()
-                if ev:
-                    try:
-                        update_event(ev['id'], {
-                            'phase': 'done',
-                            'status': 'error',
-                            'message': f'例外：{error_msg}'
-                        })
-                    except Exception:
-                        pass
+                logger.exception("週報生成任務發生錯誤：%s", error_msg)
+                if rec:
+                    rec.phase('done', f'例外：{error_msg}', status='error')
             finally:
-                if db_conn:
-                    db_conn.close()
+                if rec:
+                    try:
+                        rec.flush()
+                    except Exception as fe:
+                        print(f"[週報] 事件記錄寫入失敗：{fe}", file=sys.stderr)
+                release_db_connection(db_conn)
 
         # 建立 CronTrigger（固定 Asia/Taipei）
         # 注意：APScheduler 的 day_of_week 參數支援 'mon', 'tue' 等格式
@@ -314,7 +305,7 @@ def reschedule_weekly_report(scheduler):
             day_of_week=day, 
             hour=hour, 
             minute=minute, 
-            timezone="Asia/Taipei"
+            timezone=TAIPEI_TZ
         )
         
         scheduler.add_job(
@@ -326,64 +317,29 @@ def reschedule_weekly_report(scheduler):
         )
         
         print(f"[週報排程] 任務已註冊到 APScheduler (job_id=job_weekly_report)")
+        _LAST_WEEKLY_SIG = sig
         
-        # 計算並顯示下次執行時間
-        from datetime import datetime, timedelta
-        from zoneinfo import ZoneInfo
-        taipei_tz = ZoneInfo("Asia/Taipei")
-        now = datetime.now(taipei_tz)
-        
-        # 計算下一個符合條件的時間
-        days_map = {'mon': 0, 'tue': 1, 'wed': 2, 'thu': 3, 'fri': 4, 'sat': 5, 'sun': 6}
-        target_weekday = days_map.get(day, 0)
-        current_weekday = now.weekday()
-        
-        # 計算到下一個目標星期幾的天數
-        days_ahead = target_weekday - current_weekday
-        if days_ahead < 0 or (days_ahead == 0 and (now.hour > hour or (now.hour == hour and now.minute >= minute))):
-            days_ahead += 7  # 下週
-        
-        # 使用當前時間的時區來建立目標時間
-        next_run = now.replace(hour=hour, minute=minute, second=0, microsecond=0) + timedelta(days=days_ahead)
-        # 確保時區正確
-        if next_run.tzinfo is None:
-            next_run = next_run.replace(tzinfo=taipei_tz)
-        
-        # 從 APScheduler 獲取實際的下次執行時間（更準確）
-        try:
-            # 等待一下讓 job 註冊完成
-            import time
-            time.sleep(0.1)
-            registered_job = scheduler.get_job("job_weekly_report")
-            if registered_job and registered_job.next_run_time:
-                next_run = registered_job.next_run_time
-                print(f"--- 週報排程已設定：每週 {day} {hour:02d}:{minute:02d} 生成 CISO 週報 ---")
-                print(f"--- 下次執行時間（APScheduler）：{next_run.strftime('%Y-%m-%d %H:%M:%S %Z')} ---")
-            else:
-                print(f"--- 週報排程已設定：每週 {day} {hour:02d}:{minute:02d} 生成 CISO 週報 ---")
-                print(f"--- 下次執行時間（計算值）：{next_run.strftime('%Y-%m-%d %H:%M:%S %Z')} ---")
-                print(f"--- 警告：APScheduler 尚未計算下次執行時間 ---")
-        except Exception as e:
-            print(f"--- 週報排程已設定：每週 {day} {hour:02d}:{minute:02d} 生成 CISO 週報 ---")
-            print(f"--- 下次執行時間（計算值）：{next_run.strftime('%Y-%m-%d %H:%M:%S %Z')} ---")
-            print(f"--- 無法從 APScheduler 獲取下次執行時間：{e} ---")
+        # 由 CronTrigger 直接計算下次執行時間（排程器尚未啟動時 job 仍無 next_run_time）
+        now = datetime.now(TAIPEI_TZ)
+        next_run = trigger.get_next_fire_time(None, now)
+        print(f"--- 週報排程已設定：每週 {day} {hour:02d}:{minute:02d} 生成 CISO 週報 ---")
+        print(f"--- 下次執行時間：{next_run.strftime('%Y-%m-%d %H:%M:%S %Z')} ---")
         
         print(f"--- 當前時間：{now.strftime('%Y-%m-%d %H:%M:%S %Z')} ---")
         
         # 輸出時區設定資訊以便診斷
-        import os as os_module
-        env_tz = os_module.environ.get('TZ', 'Not Set')
+        env_tz = os.environ.get('TZ', 'Not Set')
         system_tz_file = None
         try:
-            if os_module.path.exists('/etc/timezone'):
+            if os.path.exists('/etc/timezone'):
                 with open('/etc/timezone', 'r') as f:
                     system_tz_file = f.read().strip()
         except Exception:
             pass
         localtime_link = None
         try:
-            if os_module.path.islink('/etc/localtime'):
-                localtime_link = os_module.readlink('/etc/localtime')
+            if os.path.islink('/etc/localtime'):
+                localtime_link = os.readlink('/etc/localtime')
         except Exception:
             pass
         
@@ -395,11 +351,32 @@ def reschedule_weekly_report(scheduler):
             print(f"  /etc/localtime 連結: {localtime_link}")
         
         # 定期輸出當前時間以便診斷（每小時一次）
-        import sys
         sys.stdout.flush()  # 確保輸出立即寫入
     except Exception as e:
         print(f"警告：重排程 weekly_report 失敗：{e}", file=sys.stderr)
 
+# 各收集器抓取不同來源且互不相依，可並行執行（依 PIR 優先級排列）
+_COLLECTORS = (
+    ('CISA KEV', collectors.fetch_cisa_kev),  # P0
+    ('NVD', collectors.fetch_nvd),            # P1
+    ('RSS', collectors.fetch_rss_feeds),      # P1/P2
+)
+
+def _run_collector(name, fetch, config):
+    """
+    以獨立的資料庫連線執行單一收集器（同一連線不可同時供多個執行緒使用）
+    """
+    db_conn = acquire_db_connection()
+    if db_conn is None:
+        print(f"錯誤：{name} 收集器無法獲取資料庫連線，跳過。", file=sys.stderr)
+        return
+    try:
+        fetch(db_conn, config)
+    except Exception as e:
+        print(f"[錯誤] {name} 收集器執行失敗：{e}", file=sys.stderr)
+    finally:
+        release_db_connection(db_conn)
+
 def run_all_collectors():
     """
     執行所有收集器任務。
@@ -409,25 +386,22 @@ def run_all_collectors():
     db_conn = None
     try:
         config = load_config()
-        db_conn = get_db_connection()
+        db_conn = acquire_db_connection()
         
         if db_conn is None:
             print("錯誤：無法獲取資料庫連線，跳過此次執行。", file=sys.stderr)
             return
 
-        # 依照PIR優先級執行
-        # P0 (CISA) - 假設我們希望它更頻繁 (雖然這裡和大包一起跑)
-        collectors.fetch_cisa_kev(db_conn, config)
-        
-        # P1 (NVD)
-        collectors.fetch_nvd(db_conn, config)
+        # 並行前先建立索引（DDL 與提交只在此執行一次，不與收集器的寫入交易互搶鎖）
+        ensure_raw_intel_indexes(db_conn)
         
-        # P1/P2 (RSS Feeds)
-        collectors.fetch_rss_feeds(db_conn, config)
+        # 收集器以網路 I/O 為主，以執行緒並行抓取；全部完成後才進行關聯分析
+        with ThreadPoolExecutor(max_workers=len(_COLLECTORS)) as executor:
+            for name, fetch in _COLLECTORS:
+                executor.submit(_run_collector, name, fetch, config)
         
         # --- 關聯分析引擎 ---
         print("\n--- [Scheduler] 呼叫關聯分析引擎 (Correlation Engine) ---")
-        import correlation_engine
         correlation_engine.run_correlation_analysis(db_conn, config)
         # --- (關聯分析引擎完成) ---
         
@@ -436,9 +410,7 @@ def run_all_collectors():
     except Exception as e:
         print(f"排程任務 'run_all_collectors' 發生嚴重錯誤：{e}", file=sys.stderr)
     finally:
-        if db_conn:
-            db_conn.close()
-            print("資料庫連線已關閉。")
+        release_db_connection(db_conn)
 
 
 # --- 信號處理函式 ---
@@ -453,8 +425,46 @@ def signal_handler_reload(signum, frame):
     if scheduler_instance:
         reschedule_weekly_report(scheduler_instance)
 
+def signal_handler_stop(signum, frame):
+    """處理 SIGTERM/SIGINT 信號，喚醒主執行緒以關閉排程器"""
+    print(f"\n[{datetime.now()}] --- 收到信號 {signum}，準備停止服務 ---")
+    stop_event.set()
+
+# --- 定期健康檢查 ---
+def check_weekly_job_health():
+    """每小時由排程器呼叫，檢查週報排程是否正常運行"""
+    try:
+        # 輸出當前時間以便診斷
+        now_dt = datetime.now(TAIPEI_TZ)
+        print(f"[檢查] 當前時間：{now_dt.strftime('%Y-%m-%d %H:%M:%S %Z')}")
+
+        if not scheduler_instance:
+            return
+
+        # 檢查週報任務是否存在
+        weekly_job = scheduler_instance.get_job("job_weekly_report")
+        if weekly_job:
+            next_run = weekly_job.next_run_time
+            if next_run:
+                print(f"[檢查] 週報排程正常，下次執行：{next_run.strftime('%Y-%m-%d %H:%M:%S %Z')}")
+            else:
+                print("[警告] 週報排程存在但未設定下次執行時間", file=sys.stderr)
+        else:
+            # 檢查設定是否啟用
+            config = load_config()
+            weekly = config.get('reporting', {}).get('weekly_report', {})
+            if weekly.get('enabled', False):
+                print("[警告] 週報排程已啟用但任務不存在，嘗試重新設定...", file=sys.stderr)
+                reschedule_weekly_report(scheduler_instance)
+    except Exception as e:
+        print(f"[檢查] 檢查週報排程時發生錯誤：{e}", file=sys.stderr)
+    sys.stdout.flush()  # 確保輸出立即寫入
+
 # --- 主程式 ---
 if __name__ == "__main__":
+    configure_logging()
+    # 同一錯誤（如網路中斷造成的重複失敗）5 分鐘內只輸出一次堆疊
+    logger.addFilter(RateLimitFilter(interval=300))
     print("--- 啟動 AETIM 主排程器服務 ---")
     
     # 寫入 PID 檔，供 Web 進程訊號喚醒
@@ -483,28 +493,27 @@ if __name__ == "__main__":
         
         # 1.2 執行關聯分析
         print("[啟動] 開始執行關聯分析...")
-        db_conn = get_db_connection()
+        db_conn = acquire_db_connection()
         if db_conn:
-            import correlation_engine
-            correlation_engine.run_correlation_analysis(db_conn, config)
-            print("[啟動] 關聯分析完成")
+            try:
+                correlation_engine.run_correlation_analysis(db_conn, config)
+                print("[啟動] 關聯分析完成")
             
-            # 1.3 生成 CISO 報告
-            print("[啟動] 開始生成 CISO 報告...")
-            import reporting_engine
-            report_data = reporting_engine.generate_weekly_report(db_conn, config)
-            if report_data:
-                report_filepath = reporting_engine.save_report(
-                    report_data, 'ciso_weekly', 'html'
-                )
-                if report_filepath:
-                    print(f"[啟動] CISO 報告生成完成：{report_filepath}")
+                # 1.3 生成 CISO 報告
+                print("[啟動] 開始生成 CISO 報告...")
+                report_data = reporting_engine.generate_weekly_report(db_conn, config)
+                if report_data:
+                    report_filepath = reporting_engine.save_report(
+                        report_data, 'ciso_weekly', 'html'
+                    )
+                    if report_filepath:
+                        print(f"[啟動] CISO 報告生成完成：{report_filepath}")
+                    else:
+                        print("[啟動] CISO 報告生成失敗（無法儲存檔案）")
                 else:
-                    print("[啟動] CISO 報告生成失敗（無法儲存檔案）")
-            else:
-                print("[啟動] CISO 報告生成失敗（無資料）")
-            
-            db_conn.close()
+                    print("[啟動] CISO 報告生成失敗（無資料）")
+            finally:
+                release_db_connection(db_conn)
         else:
             print("[啟動] 無法獲取資料庫連線，跳過關聯分析和報告生成")
     except Exception as e:
@@ -513,7 +522,7 @@ if __name__ == "__main__":
     print("=" * 60)
     
     # 2. 設定排程器
-    scheduler = BackgroundScheduler(timezone="Asia/Taipei")
+    scheduler = BackgroundScheduler(timezone=TAIPEI_TZ)
     scheduler_instance = scheduler  # 儲存全域變數
     
     # 3. 讀取排程設定
@@ -550,6 +559,14 @@ if __name__ == "__main__":
     except Exception as e:
         print(f"警告：週報排程設定失敗：{e}", file=sys.stderr)
     
+    # 6.1 每小時檢查週報排程是否正常（由排程器喚醒，主執行緒無需輪詢）
+    scheduler.add_job(
+        check_weekly_job_health,
+        trigger=IntervalTrigger(hours=1),
+        id="job_health_check",
+        replace_existing=True
+    )
+    
     # 7. 設定信號處理器（支援立即觸發）
     # SIGUSR1: 立即執行收集任務（Unix/Linux）
     if hasattr(signal, 'SIGUSR1'):
@@ -559,6 +576,9 @@ if __name__ == "__main__":
     if hasattr(signal, 'SIGUSR2'):
         signal.signal(signal.SIGUSR2, signal_handler_reload)
         print(f"--- 已啟用信號觸發：發送 SIGUSR2 可重新載入週報排程 ---")
+    # SIGTERM/SIGINT: 停止服務（docker stop / Ctrl+C）
+    signal.signal(signal.SIGTERM, signal_handler_stop)
+    signal.signal(signal.SIGINT, signal_handler_stop)
     
     scheduler.start()
     print(f"--- 排程器已啟動，將每 {interval_display} 執行一次收集任務。 ---")
@@ -578,46 +598,12 @@ if __name__ == "__main__":
     print("--- 提示：使用 'docker-compose exec aetim python trigger_collectors.py' 可立即執行任務 ---")
 
     # 8. 保持主程式運行 (讓 Docker 容器保持 'up')
-    # 定期檢查週報排程是否正常運行
-    last_check_time = time.time()
-    check_interval = 3600  # 每小時檢查一次
-    
+    # 主執行緒阻塞於事件，直到收到停止信號；週報排程檢查由 job_health_check 負責
     try:
-        while True:
-            time.sleep(60) # 每分鐘檢查一次
-            
-            # 每小時檢查一次週報排程是否正常
-            current_time = time.time()
-            if current_time - last_check_time >= check_interval:
-                last_check_time = current_time
-                try:
-                    # 輸出當前時間以便診斷
-                    from zoneinfo import ZoneInfo
-                    taipei_tz = ZoneInfo("Asia/Taipei")
-                    now_dt = datetime.now(taipei_tz)
-                    print(f"[檢查] 當前時間：{now_dt.strftime('%Y-%m-%d %H:%M:%S %Z')}")
-                    
-                    # 檢查週報任務是否存在
-                    weekly_job = scheduler.get_job("job_weekly_report")
-                    if weekly_job:
-                        next_run = weekly_job.next_run_time
-                        if next_run:
-                            print(f"[檢查] 週報排程正常，下次執行：{next_run.strftime('%Y-%m-%d %H:%M:%S %Z')}")
-                        else:
-                            print("[警告] 週報排程存在但未設定下次執行時間", file=sys.stderr)
-                    else:
-                        # 檢查設定是否啟用
-                        config = load_config()
-                        weekly = config.get('reporting', {}).get('weekly_report', {})
-                        if weekly.get('enabled', False):
-                            print("[警告] 週報排程已啟用但任務不存在，嘗試重新設定...", file=sys.stderr)
-                            reschedule_weekly_report(scheduler)
-                except Exception as e:
-                    print(f"[檢查] 檢查週報排程時發生錯誤：{e}", file=sys.stderr)
-                import sys
-                sys.stdout.flush()  # 確保輸出立即寫入
-            
+        stop_event.wait()
     except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
         print("--- 服務停止中，關閉排程器... ---")
         scheduler.shutdown()
         print("--- 服務已停止 ---")
@@ -5,7 +5,7 @@ import os
 import sys
 import re
 # --- 步驟 1: 匯入 (取代舊的 load_config) ---
-from utils import load_config, get_db_connection
+from utils import load_config, get_db_connection, ensure_raw_intel_indexes, dedupe_raw_intel, ensure_validated_threat_indexes, SCHEMA_T_FEED_CACHE
 
 # --- 資料庫結構 (Schema) ---
 # 使用英文欄位名稱，保持資料庫最佳實踐
@@ -132,6 +132,11 @@ def create_database(): # 移除了 db_file 參數
         cursor.execute(SCHEMA_T_ASSETS)
         cursor.execute(SCHEMA_T_RAW_INTEL)
         cursor.execute(SCHEMA_T_VALIDATED_THREATS)
+        cursor.execute(SCHEMA_T_FEED_CACHE)
+        # 既有資料庫可能含重複情資（唯一索引建立前寫入），先清理才能建立唯一索引
+        dedupe_raw_intel(conn)
+        ensure_raw_intel_indexes(conn)
+        ensure_validated_threat_indexes(conn)
         
         # 清空 T_Assets 以便重新匯入
         cursor.execute("DELETE FROM T_Assets")
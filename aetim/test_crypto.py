@@ -47,8 +47,8 @@ def test_encryption_decryption():
             return False
         
         parts = encrypted.split(':')
-        if len(parts) != 4:
-            print("✗ 錯誤：加密字串格式不正確（應有 4 個部分）")
+        if len(parts) != 2:
+            print("✗ 錯誤：加密字串格式不正確（應為 ENCRYPTED:<blob>）")
             return False
         
         print(f"✓ 加密字串格式正確")
@@ -67,6 +67,21 @@ def test_encryption_decryption():
         
         print(f"✓ 密碼匹配正確")
         
+        # 向後相容：舊格式 ENCRYPTED:<ciphertext>:<nonce>:<tag>
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        nonce = secrets.token_bytes(12)
+        sealed = AESGCM(test_key).encrypt(nonce, test_password.encode('utf-8'), None)
+        legacy = "ENCRYPTED:{}:{}:{}".format(
+            base64.b64encode(sealed[:-16]).decode('utf-8'),
+            base64.b64encode(nonce).decode('utf-8'),
+            base64.b64encode(sealed[-16:]).decode('utf-8'),
+        )
+        if decrypt_password(legacy) != test_password:
+            print("✗ 錯誤：舊格式加密字串解密失敗")
+            return False
+        
+        print(f"✓ 舊格式加密字串解密正確")
+        
         # 清理
         del os.environ['AETIM_ENCRYPTION_KEY']
         
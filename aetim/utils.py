@@ -1,7 +1,17 @@
 import yaml
 import os
+import re
 import sys
+import time
+import logging
 import sqlite3
+import queue
+import atexit
+import functools
+import threading
+from dataclasses import dataclass
+from typing import Optional, Pattern, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from sqlite3 import Error
 from crypto_utils import get_smtp_password
 
@@ -9,10 +19,176 @@ CONFIG_FILE = 'config.yaml'
 APP_DIR_DOCKER = "/app"
 APP_DIR_LOCAL = os.path.dirname(__file__)  # 支援本機直接執行（非 Docker）
 
-def load_config():
+# 排程執行緒與信號處理可能同時載入設定；確保設定檔變更後只解析一次，各執行緒取得同一份 dict
+_CONFIG_LOCK = threading.Lock()
+
+# 排程任務重複使用的 SQLite 連線池上限；同一連線同一時間只交給一個執行緒使用
+DB_POOL_MAX = 8
+_DB_POOL = queue.LifoQueue(maxsize=DB_POOL_MAX)
+
+# 連線建立時套用的 SQLite 效能設定：WAL 讓讀寫互不阻塞，synchronous=NORMAL 在 WAL 下僅於 checkpoint 時 fsync
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",   # 256 MB
+    "PRAGMA cache_size=-65536",     # 64 MB
+    "PRAGMA busy_timeout=30000",    # 並行收集器同時寫入時最多等待 30 秒取得寫入鎖（預設 5 秒）
+)
+
+# T_Raw_Intel 去重用的唯一索引：收集器改以 INSERT OR IGNORE 寫入，由資料庫負責去重
+RAW_INTEL_UNIQUE_INDEXES = (
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_raw_intel_cve ON T_Raw_Intel(cve_id) WHERE cve_id IS NOT NULL",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_raw_intel_title ON T_Raw_Intel(title)",
+)
+
+# 已嘗試建立 T_Raw_Intel 索引的資料庫檔案 → 是否全部成功
+_RAW_INTEL_INDEX_READY = {}
+_RAW_INTEL_INDEX_LOCK = threading.Lock()
+
+# 關聯分析依狀態取出新情資（WHERE status='new' ORDER BY timestamp DESC）用的索引
+RAW_INTEL_INDEXES = RAW_INTEL_UNIQUE_INDEXES + (
+    "CREATE INDEX IF NOT EXISTS idx_raw_intel_status_ts ON T_Raw_Intel(status, timestamp DESC)",
+)
+
+# 通知與 IT 工單查詢（status='new' AND risk_score > ?）、週報查詢（timestamp >= ? AND risk_score >= ?）用的覆蓋索引，
+# 以及依情資/資產查詢威脅的索引
+VALIDATED_THREATS_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_vt_status_score_ts ON T_Validated_Threats(status, risk_score, timestamp, intel_id, asset_id)",
+    "CREATE INDEX IF NOT EXISTS idx_vt_ts_score ON T_Validated_Threats(timestamp, risk_score, status, intel_id, asset_id)",
+    "CREATE INDEX IF NOT EXISTS idx_vt_intel_asset ON T_Validated_Threats(intel_id, asset_id)",
+)
+
+# 外部 feed 的 HTTP 快取驗證資訊（ETag / Last-Modified），供條件式 GET 使用
+SCHEMA_T_FEED_CACHE = """
+CREATE TABLE IF NOT EXISTS T_Feed_Cache (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+# 週排程星期代碼 → datetime.weekday()
+WEEKDAY_MAP = {'mon': 0, 'tue': 1, 'wed': 2, 'thu': 3, 'fri': 4, 'sat': 5, 'sun': 6}
+DEFAULT_TIMEZONE = 'Asia/Taipei'
+
+# RSS 來源名稱 → config['threat_feeds'] 的鍵
+RSS_FEED_KEYS = (
+    ('VMware', 'vmware_vmsa'),
+    ('MSRC', 'msrc_rss'),
+    ('TWCERT_Alert', 'twcert_rss'),
+    ('TWCERT_CC', 'twcert_cc_rss'),
+)
+
+# 各模組 logger 輸出時加上的前綴（維持原本 print 的輸出格式）
+LOG_PREFIXES = {'aetim.notification': '[通知] '}
+
+class _PrefixFormatter(logging.Formatter):
+    def format(self, record):
+        return LOG_PREFIXES.get(record.name, '') + super().format(record)
+
+def configure_logging(level=logging.INFO):
     """
-    載入設定檔並替換環境變數 (從 .env 讀取)
+    由進入點（scheduler.py、web_app.py 等）呼叫一次，將 aetim.* 模組的 logging 輸出至 stdout
+    各模組只取得 logger、不自行加 handler；已設定 root handler 時不重複設定
     """
+    root = logging.getLogger()
+    if root.handlers:
+        return
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(_PrefixFormatter('%(message)s'))
+    root.addHandler(handler)
+    root.setLevel(level)
+
+class RateLimitFilter(logging.Filter):
+    """
+    相同訊息（logger 名稱、格式字串與參數相同）在 interval 秒內只輸出一次，避免重複錯誤洗版
+    """
+
+    def __init__(self, interval=300):
+        super().__init__()
+        self.interval = interval
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.msg, str(record.args))
+        now = time.monotonic()
+        with self._lock:
+            last = self._last.get(key)
+            if last is not None and now - last < self.interval:
+                return False
+            self._last[key] = now
+        return True
+
+@functools.lru_cache(maxsize=8)
+def compile_keyword_pattern(keywords):
+    """
+    將 PIR 關鍵字轉小寫並編譯為單一正規表示式（每組關鍵字只處理一次）
+    
+    Args:
+        keywords: config['pir_keywords'] 的 tuple
+    
+    Returns:
+        編譯後的 Pattern，若沒有關鍵字則返回 None
+    """
+    if not keywords:
+        return None
+    return re.compile('|'.join(re.escape(k.lower()) for k in keywords))
+
+@dataclass(frozen=True, slots=True)
+class AppConfig:
+    """
+    收集器與排程常用設定的型別化檢視（載入時一次解析，之後以屬性存取）
+    """
+    cisa_kev_url: str
+    rss_feeds: Tuple[Tuple[str, str], ...]
+    nvd_api_key: str
+    pir_keywords: Tuple[str, ...]
+    keyword_pattern: Optional[Pattern]
+    weekly_enabled: bool
+    weekly_day_name: str
+    weekly_day: int
+    weekly_hour: Optional[int]
+    weekly_minute: Optional[int]
+    weekly_tz_name: str
+    weekly_tz: ZoneInfo
+
+    @classmethod
+    def from_dict(cls, config):
+        """由 load_config() 的 dict 建立 AppConfig"""
+        threat_feeds = config.get('threat_feeds') or {}
+        api_keys = config.get('api_keys') or {}
+        pir_keywords = tuple(config.get('pir_keywords') or ())
+        weekly = (config.get('reporting') or {}).get('weekly_report') or {}
+        schedule_struct = weekly.get('schedule_struct') or {}
+        day_name = str(schedule_struct.get('day_of_week', '')).lower()
+        tz_name = schedule_struct.get('timezone', DEFAULT_TIMEZONE)
+        try:
+            tz = ZoneInfo(tz_name)
+        except (ZoneInfoNotFoundError, ValueError, TypeError):
+            print(f"警告：無效的時區設定 '{tz_name}'，改用 {DEFAULT_TIMEZONE}。", file=sys.stderr)
+            tz_name = DEFAULT_TIMEZONE
+            tz = ZoneInfo(tz_name)
+        return cls(
+            cisa_kev_url=threat_feeds.get('cisa_kev', ''),
+            rss_feeds=tuple(
+                (name, threat_feeds[key]) for name, key in RSS_FEED_KEYS if threat_feeds.get(key)
+            ),
+            nvd_api_key=api_keys.get('nvd') or '',
+            pir_keywords=pir_keywords,
+            keyword_pattern=compile_keyword_pattern(pir_keywords),
+            weekly_enabled=bool(weekly.get('enabled', False)),
+            weekly_day_name=day_name,
+            weekly_day=WEEKDAY_MAP.get(day_name, 0),
+            weekly_hour=schedule_struct.get('hour'),
+            weekly_minute=schedule_struct.get('minute'),
+            weekly_tz_name=tz_name,
+            weekly_tz=tz,
+        )
+
+def _resolve_config_path():
     # 先嘗試 Docker 目錄，若不存在則回退至本機模組目錄
     config_path_docker = os.path.join(APP_DIR_DOCKER, CONFIG_FILE)
     config_path_local = os.path.join(APP_DIR_LOCAL, CONFIG_FILE)
@@ -20,7 +196,50 @@ def load_config():
     if not os.path.exists(config_path):
         print(f"錯誤：找不到設定檔（嘗試 {config_path_docker} 與 {config_path_local}）。", file=sys.stderr)
         sys.exit(1)
-        
+    return config_path
+
+def _config_signature(config_path):
+    """設定檔的變更識別（一次 stat）：修改時間（奈秒）、大小與 inode，編輯器以新檔取代時亦可偵測"""
+    st = os.stat(config_path)
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def load_config():
+    """
+    載入設定檔並替換環境變數 (從 .env 讀取)
+    設定檔未變更（修改時間、大小、inode 皆相同）時直接返回快取結果；返回的 dict 為共用物件，呼叫端若需修改請先 deepcopy
+    """
+    config_path = _resolve_config_path()
+    signature = _config_signature(config_path)
+    with _CONFIG_LOCK:
+        return _load_config_cached(config_path, signature)
+
+def get_app_config(config=None):
+    """
+    取得型別化設定
+    
+    Args:
+        config: load_config() 返回的 dict；為 None 或即為共用快取物件時返回快取的 AppConfig，
+                否則（例如呼叫端自行修改過的副本）即時建立
+    
+    Returns:
+        AppConfig
+    """
+    config_path = _resolve_config_path()
+    signature = _config_signature(config_path)
+    with _CONFIG_LOCK:
+        if config is None or config is _load_config_cached(config_path, signature):
+            return _load_app_config_cached(config_path, signature)
+    return AppConfig.from_dict(config)
+
+@functools.lru_cache(maxsize=1)
+def _load_app_config_cached(config_path, signature):
+    return AppConfig.from_dict(_load_config_cached(config_path, signature))
+
+@functools.lru_cache(maxsize=1)
+def _load_config_cached(config_path, signature):
+    """
+    實際解析設定檔（以路徑與檔案識別為快取鍵，檔案變更後自動重新載入）
+    """
     try:
         with open(config_path, 'r', encoding='utf-8') as f:
             raw_config = f.read()
@@ -59,9 +278,12 @@ def load_config():
         print(f"載入設定時發生未知錯誤：{e}", file=sys.stderr)
         sys.exit(1)
 
-def get_db_connection():
+def get_db_connection(check_same_thread=True):
     """
     建立並回傳一個 SQLite 資料庫連線
+    
+    Args:
+        check_same_thread: 為 False 時允許連線在不同執行緒間傳遞（供連線池使用）
     """
     config = load_config()
     # 先用 Docker 目錄，若不存在則回退本機目錄
@@ -70,10 +292,191 @@ def get_db_connection():
     db_file = db_file_docker if os.path.exists(db_file_docker) else db_file_local
     conn = None
     try:
-        conn = sqlite3.connect(db_file)
+        conn = sqlite3.connect(db_file, check_same_thread=check_same_thread)
         conn.row_factory = sqlite3.Row # 讓查詢結果可以像字典一樣用欄位名存取
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
         print(f"資料庫連線成功：{db_file}")
     except Error as e:
         print(f"資料庫連線失敗：{e}", file=sys.stderr)
         
     return conn
+
+def acquire_db_connection():
+    """
+    從連線池取得資料庫連線；池中沒有閒置連線時建立新連線
+    使用完畢後以 release_db_connection() 歸還
+    """
+    try:
+        return _DB_POOL.get_nowait()
+    except queue.Empty:
+        return get_db_connection(check_same_thread=False)
+
+def release_db_connection(conn):
+    """
+    將連線歸還連線池；未提交的交易先回滾，池已滿或連線異常時直接關閉
+    """
+    if conn is None:
+        return
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+        _DB_POOL.put_nowait(conn)
+    except (queue.Full, Error):
+        conn.close()
+
+def close_db_pool():
+    """關閉連線池中所有閒置連線（程序結束時自動呼叫）"""
+    while True:
+        try:
+            _DB_POOL.get_nowait().close()
+        except queue.Empty:
+            break
+
+atexit.register(close_db_pool)
+
+def _database_file(conn):
+    """回傳連線的主資料庫檔案路徑（記憶體資料庫為空字串）"""
+    return conn.execute("PRAGMA database_list").fetchone()[2]
+
+def ensure_raw_intel_indexes(conn):
+    """
+    建立 T_Raw_Intel 的唯一索引與狀態查詢索引
+    每個資料庫檔案在同一程序內只嘗試一次（收集器每次執行都會呼叫，不重複 DDL 與警告）；
+    既有重複資料導致唯一索引無法建立時，執行 python setup_database.py（會先呼叫 dedupe_raw_intel）清理
+    
+    Args:
+        conn: 資料庫連線
+    
+    Returns:
+        bool: 所有索引皆已就緒則返回 True
+    """
+    db_file = _database_file(conn)
+    with _RAW_INTEL_INDEX_LOCK:
+        if db_file and db_file in _RAW_INTEL_INDEX_READY:
+            return _RAW_INTEL_INDEX_READY[db_file]
+        ok = True
+        for ddl in RAW_INTEL_INDEXES:
+            try:
+                conn.execute(ddl)
+            except sqlite3.IntegrityError as e:
+                # 既有資料已含重複值，無法建立唯一索引（收集器仍以記憶體比對去重）
+                ok = False
+                print(f"警告：建立唯一索引失敗（資料中已有重複情資，請執行 python setup_database.py 清理後重新啟動服務）：{e}", file=sys.stderr)
+            except Error as e:
+                ok = False
+                print(f"警告：建立 T_Raw_Intel 索引失敗：{e}", file=sys.stderr)
+        conn.commit()
+        if db_file:
+            _RAW_INTEL_INDEX_READY[db_file] = ok
+        return ok
+
+def dedupe_raw_intel(conn):
+    """
+    移除 T_Raw_Intel 中 cve_id 或 title 重複的情資（保留 id 最小的一筆），
+    並將 T_Validated_Threats 中指向被移除情資的 intel_id 改指向保留的那筆，讓唯一索引得以建立
+    
+    Args:
+        conn: 資料庫連線
+    
+    Returns:
+        int: 移除的情資筆數
+    """
+    removed = 0
+    with conn:
+        for column in ('cve_id', 'title'):
+            # 每組重複值保留 id 最小者；以 UPDATE/DELETE 開頭，確保 sqlite3 自動開啟交易、兩步驟一起提交
+            duplicates = f"""
+                SELECT id FROM T_Raw_Intel
+                WHERE {column} IS NOT NULL
+                  AND id NOT IN (SELECT MIN(id) FROM T_Raw_Intel WHERE {column} IS NOT NULL GROUP BY {column})
+            """
+            conn.execute(f"""
+                UPDATE T_Validated_Threats
+                SET intel_id = (
+                    SELECT MIN(k.id) FROM T_Raw_Intel k
+                    WHERE k.{column} = (SELECT r.{column} FROM T_Raw_Intel r WHERE r.id = T_Validated_Threats.intel_id)
+                )
+                WHERE intel_id IN ({duplicates})
+            """)
+            cursor = conn.execute(f"DELETE FROM T_Raw_Intel WHERE id IN ({duplicates})")
+            removed += max(cursor.rowcount, 0)
+    if removed:
+        print(f"已移除 {removed} 筆重複情資。")
+    return removed
+
+def ensure_validated_threat_indexes(conn):
+    """
+    建立 T_Validated_Threats 的通知與報告查詢索引（可重複呼叫；新建索引時更新統計資訊）
+    
+    Args:
+        conn: 資料庫連線
+    
+    Returns:
+        bool: 所有索引皆已就緒則返回 True
+    """
+    index_sql = "SELECT COUNT(*) FROM sqlite_master WHERE type = 'index' AND tbl_name = 'T_Validated_Threats'"
+    try:
+        before = conn.execute(index_sql).fetchone()[0]
+        for ddl in VALIDATED_THREATS_INDEXES:
+            conn.execute(ddl)
+        if conn.execute(index_sql).fetchone()[0] != before:
+            conn.execute("ANALYZE T_Validated_Threats")
+        conn.commit()
+        return True
+    except Error as e:
+        print(f"警告：建立 T_Validated_Threats 索引失敗：{e}", file=sys.stderr)
+        return False
+
+def get_feed_cache_headers(conn, url):
+    """
+    依上次抓取記錄組出條件式 GET 標頭
+    
+    Args:
+        conn: 資料庫連線
+        url: feed URL
+    
+    Returns:
+        dict: If-None-Match / If-Modified-Since 標頭（無記錄時為空 dict）
+    """
+    headers = {}
+    try:
+        conn.execute(SCHEMA_T_FEED_CACHE)
+        row = conn.execute(
+            "SELECT etag, last_modified FROM T_Feed_Cache WHERE url = ?", (url,)
+        ).fetchone()
+    except Error as e:
+        print(f"警告：讀取 T_Feed_Cache 失敗：{e}", file=sys.stderr)
+        return headers
+    if row:
+        if row[0]:
+            headers['If-None-Match'] = row[0]
+        if row[1]:
+            headers['If-Modified-Since'] = row[1]
+    return headers
+
+def save_feed_cache(conn, url, response):
+    """
+    記錄回應的 ETag / Last-Modified（處理成功後才呼叫）
+    
+    Args:
+        conn: 資料庫連線
+        url: feed URL
+        response: requests 回應物件
+    """
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if not etag and not last_modified:
+        return
+    try:
+        with conn:
+            conn.execute(SCHEMA_T_FEED_CACHE)
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO T_Feed_Cache (url, etag, last_modified, updated_at)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                """,
+                (url, etag, last_modified)
+            )
+    except Error as e:
+        print(f"警告：寫入 T_Feed_Cache 失敗：{e}", file=sys.stderr)
@@ -16,7 +16,7 @@ from zoneinfo import ZoneInfo
 from flask import Flask, render_template, request, jsonify
 from flask_cors import CORS
 import signal
-from utils import get_db_connection, load_config
+from utils import get_db_connection, load_config, configure_logging
 import collectors
 import correlation_engine
 import reporting_engine
@@ -1256,6 +1256,8 @@ def startup_tasks():
 
 
 if __name__ == '__main__':
+    configure_logging()
+    
     # 執行啟動任務
     startup_tasks()
     